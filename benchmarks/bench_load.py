@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+"""Concurrent clone, fetch, ls-remote and push load over all protocols
+
+A synthetic repository is generated with git fast-import, then the
+servers are created with the three create_factory functions and listen
+on ephemeral ports. They run in a forked child, so the peak RSS, file
+descriptors and processes measured are those of the server alone.
+For each protocol and operation, --clients git clients run --rounds
+operations each.
+
+    $ python benchmarks/bench_load.py [--commits N] [--files N]
+          [--refs N] [--clients N] [--rounds N] [--output FILE]
+          [--baseline FILE]
+
+With --baseline, results are compared with an earlier --output and the
+exit code is 1 if latency, throughput or peak RSS regressed by more
+than --tolerance or more operations failed.
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import shutil
+import random
+import tempfile
+import optparse
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+PROTOCOLS = ['git', 'http', 'ssh']
+OPERATIONS = ['ls-remote', 'clone', 'fetch', 'push']  # push changes refs
+
+USER = 'bench'
+PASSWORD = 'bench'
+
+
+def run(args, **kwargs):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(args, stdout=devnull, **kwargs)
+
+
+def build_repository(path, commits, files, file_size, changes, refs):
+    """Create a bare repository with fast-import
+
+    The first commit adds all files, each further commit changes some
+    of them. bench-base points to the second to last commit (fetches
+    start from there) and refs tags are spread over the history."""
+    run(['git', 'init', '-q', '--bare', path])
+
+    def content():
+        return os.urandom(file_size // 2).encode('hex') + '\n'
+
+    stream = []
+    for i in xrange(commits):
+        message = 'Commit %d\n' % i
+        stream.append('commit refs/heads/master\nmark :%d\n'
+                      'committer Bench <bench@example.com> %d +0000\n'
+                      'data %d\n%s' % (i + 1, 1300000000 + i, len(message),
+                                       message))
+        if i > 0:
+            stream.append('from :%d\n' % i)
+            changed = random.sample(xrange(files), min(changes, files))
+        else:
+            changed = xrange(files)
+        for f in changed:
+            data = content()
+            stream.append('M 100644 inline dir%d/file%d.txt\ndata %d\n%s\n'
+                          % (f % 10, f, len(data), data))
+        stream.append('\n')
+
+    base = max(commits - 1, 1)
+    stream.append('reset refs/heads/bench-base\nfrom :%d\n\n' % base)
+    for i in xrange(refs):
+        stream.append('reset refs/tags/t%d\nfrom :%d\n\n' %
+                      (i, 1 + i * commits // max(refs, 1)))
+
+    p = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path,
+                         stdin=subprocess.PIPE)
+    p.communicate(''.join(stream))
+    if p.returncode != 0:
+        raise RuntimeError("git fast-import failed")
+    run(['git', 'update-server-info'], cwd=path)
+
+
+def serve(workdir, caches, ready):
+    """Run the servers, called in the forked child"""
+    os.chdir(workdir)
+
+    from twisted.internet import reactor
+    from twisted.conch.ssh import keys
+
+    import gitserverglue
+    from gitserverglue import git, http, ssh
+    from gitserverglue.immutable import OpenFileCache
+    from gitserverglue.packcache import PackCache
+    from gitserverglue.pathcache import CachingPathLookup
+    from gitserverglue.refs import AdvertisementCache, RefAdvertiser
+    from gitserverglue.scheduler import ProcessScheduler
+    from gitserverglue.streamingweb import make_site_streaming
+
+    authnz = gitserverglue.TestAuthnz()
+    git_configuration = gitserverglue.TestGitConfiguration()
+    if caches:
+        git_configuration.path_lookup = CachingPathLookup(
+                        git_configuration.path_lookup)
+        git_configuration.pack_cache = PackCache(
+                        os.path.join(workdir, 'packcache'))
+        git_configuration.advertisement_cache = AdvertisementCache()
+        git_configuration.process_scheduler = ProcessScheduler()
+        git_configuration.ref_advertiser = RefAdvertiser(
+                        git_configuration.advertisement_cache)
+        git_configuration.open_files = OpenFileCache()
+
+    key = keys.Key.fromFile(os.path.join(workdir, 'host_key'))
+    ssh_factory = ssh.create_factory(public_keys={'ssh-rsa': key},
+                                     private_keys={'ssh-rsa': key},
+                                     authnz=authnz,
+                                     git_configuration=git_configuration)
+    http_factory = make_site_streaming(http.create_factory(
+                        authnz=authnz, git_configuration=git_configuration))
+    git_factory = git.create_factory(authnz=authnz,
+                                     git_configuration=git_configuration)
+
+    ports = {}
+    for name, factory in [('git', git_factory), ('http', http_factory),
+                          ('ssh', ssh_factory)]:
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        ports[name] = port.getHost().port
+    os.write(ready, json.dumps(ports) + '\n')
+    os.close(ready)
+    reactor.run()
+
+
+def start_server(workdir, caches):
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            serve(workdir, caches, write)
+        finally:
+            os._exit(0)
+
+    os.close(write)
+    f = os.fdopen(read)
+    line = f.readline()
+    f.close()
+    if not line:
+        raise RuntimeError("The server did not start")
+    return pid, json.loads(line)
+
+
+class Sampler(threading.Thread):
+    """Samples RSS, open fds and descendants of a process"""
+
+    interval = 0.1
+
+    def __init__(self, pid):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pid = pid
+        self.peak_rss_kb = 0
+        self.peak_fds = 0
+        self.peak_processes = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.sample()
+            except (IOError, OSError):
+                pass
+            self.stopped.wait(self.interval)
+
+    def sample(self):
+        with open('/proc/%d/status' % self.pid) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    self.peak_rss_kb = max(self.peak_rss_kb,
+                                           int(line.split()[1]))
+        self.peak_fds = max(self.peak_fds,
+                            len(os.listdir('/proc/%d/fd' % self.pid)))
+        self.peak_processes = max(self.peak_processes,
+                                  len(self.descendants()))
+
+    def descendants(self):
+        children = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open('/proc/%s/stat' % entry) as f:
+                    stat = f.read()
+            except IOError:
+                continue
+            # the command may contain spaces, the ppid follows it
+            ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+            children.setdefault(ppid, []).append(int(entry))
+
+        found = []
+        pending = [self.pid]
+        while pending:
+            for child in children.get(pending.pop(), []):
+                found.append(child)
+                pending.append(child)
+        return found
+
+
+class Client(object):
+    """Runs git commands against the servers for one protocol"""
+
+    def __init__(self, workdir, ports, protocol, protocol_version):
+        self.workdir = workdir
+        self.protocol = protocol
+        self.env = dict(os.environ, HOME=workdir, GIT_CONFIG_NOSYSTEM='1',
+                        GIT_TERMINAL_PROMPT='0', GIT_AUTHOR_NAME='Bench',
+                        GIT_AUTHOR_EMAIL='bench@example.com',
+                        GIT_COMMITTER_NAME='Bench',
+                        GIT_COMMITTER_EMAIL='bench@example.com')
+        self.git = ['git', '-c', 'protocol.version=%d' % protocol_version]
+
+        if protocol == 'git':
+            self.url = 'git://127.0.0.1:%d/bench.git' % ports['git']
+            self.push_url = None  # git:// is read-only
+        elif protocol == 'http':
+            self.url = 'http://127.0.0.1:%d/bench.git' % ports['http']
+            self.push_url = 'http://%s:%s@127.0.0.1:%d/bench.git' % (
+                                            USER, PASSWORD, ports['http'])
+        else:
+            self.url = self.push_url = 'ssh://%s@127.0.0.1:%d/bench.git' % (
+                                            USER, ports['ssh'])
+            self.env['GIT_SSH_COMMAND'] = (
+                'ssh -i %s -o StrictHostKeyChecking=no '
+                '-o UserKnownHostsFile=/dev/null -o LogLevel=ERROR '
+                '-o HostKeyAlgorithms=+ssh-rsa '
+                '-o PubkeyAcceptedKeyTypes=+ssh-rsa'
+                % os.path.join(workdir, 'client_key'))
+
+    def supports(self, operation):
+        return operation != 'push' or self.push_url is not None
+
+    def prepare(self, operation, scratch, worker):
+        """Untimed setup of an operation, returns the arguments of run"""
+        if operation == 'ls-remote':
+            return [self.url]
+
+        target = os.path.join(scratch, 'repo')
+        if operation == 'clone':
+            return [self.url, target]
+
+        # fetch and push start from a copy of the bench-base clone
+        shutil.copytree(os.path.join(self.workdir, 'base.git'), target)
+        if operation == 'fetch':
+            return [target]
+
+        commit = self._commit(target, worker)
+        return [target, commit, worker]
+
+    def run(self, operation, args):
+        if operation == 'ls-remote':
+            self._git(['ls-remote', args[0]])
+        elif operation == 'clone':
+            self._git(['clone', '-q', '--bare', args[0], args[1]])
+        elif operation == 'fetch':
+            self._git(['fetch', '-q', self.url,
+                       'refs/heads/master:refs/heads/master'], cwd=args[0])
+        else:
+            target, commit, worker = args
+            self._git(['push', '-q', '-f', self.push_url,
+                       '%s:refs/heads/bench-push-%s-%d' %
+                       (commit, self.protocol, worker)], cwd=target)
+
+    def _commit(self, repository, worker):
+        blob = self._output(['hash-object', '-w', '--stdin'], repository,
+                            os.urandom(4096).encode('hex'))
+        tree = self._output(['mktree'], repository,
+                            '100644 blob %s\tpush-%d.txt\n' % (blob, worker))
+        return self._output(['commit-tree', tree, '-p', 'bench-base',
+                             '-m', 'push'], repository, '')
+
+    def _git(self, args, cwd=None):
+        p = subprocess.Popen(self.git + args, cwd=cwd, env=self.env,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        err = p.communicate()[1]
+        if p.returncode != 0:
+            raise RuntimeError("git %s failed: %s" % (
+                args[0], (err.strip().splitlines() or [''])[0]))
+
+    def _output(self, args, cwd, stdin):
+        p = subprocess.Popen(self.git + args, cwd=cwd, env=self.env,
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out = p.communicate(stdin)[0]
+        if p.returncode != 0:
+            raise RuntimeError("git %s failed" % args[0])
+        return out.strip()
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    rank = max(int(round(p / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def scenario(client, operation, clients, rounds):
+    """Run clients workers doing rounds operations each"""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(n):
+        for unused in xrange(rounds):
+            scratch = tempfile.mkdtemp(dir=client.workdir)
+            try:
+                args = client.prepare(operation, scratch, n)
+                start = time.time()
+                client.run(operation, args)
+                elapsed = time.time() - start
+            except (RuntimeError, EnvironmentError) as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            finally:
+                shutil.rmtree(scratch, ignore_errors=True)
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=worker, args=(n,))
+               for n in xrange(clients)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.time() - start
+
+    latencies.sort()
+    return {
+        'operations': len(latencies),
+        'errors': len(errors),
+        'seconds': wall,
+        'throughput': len(latencies) / wall if wall else 0.0,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'first_error': errors[0] if errors else None,
+    }
+
+
+def setup(workdir, options):
+    print 'Building repository in %s' % workdir
+    repository = os.path.join(workdir, 'bench.git')
+    build_repository(repository, options.commits, options.files,
+                     options.file_size, options.changes, options.refs)
+    run(['git', 'clone', '-q', '--bare', '--single-branch', '-b',
+         'bench-base', repository, os.path.join(workdir, 'base.git')])
+
+    run(['ssh-keygen', '-q', '-t', 'rsa', '-m', 'PEM', '-N', '',
+         '-f', os.path.join(workdir, 'host_key')])
+    run(['ssh-keygen', '-q', '-t', 'rsa', '-N', '',
+         '-f', os.path.join(workdir, 'client_key')])
+    with open(os.path.join(workdir, 'client_key.pub')) as f:
+        public_key = f.read()
+    with open(os.path.join(workdir, '.rsakeys'), 'w') as f:
+        f.write('%s: %s' % (USER, public_key))
+    with open(os.path.join(workdir, '.repoperms'), 'w') as f:
+        f.write('[bench.git]\n%s = rw\nanonymous = r\n' % USER)
+
+    from passlib.apache import HtpasswdFile
+    htpasswd = HtpasswdFile(os.path.join(workdir, '.htpasswd'), new=True)
+    htpasswd.set_password(USER, PASSWORD)
+    htpasswd.save()
+
+
+def compare(results, baseline, tolerance):
+    """Print regressions against a baseline, returns their number"""
+    regressions = 0
+    for name, result in sorted(results['scenarios'].items()):
+        old = baseline['scenarios'].get(name)
+        if old is None:
+            continue
+        if result['errors'] > old['errors']:
+            print 'REGRESSION %s errors: %d -> %d' % (
+                name, old['errors'], result['errors'])
+            regressions += 1
+        if not result['operations']:
+            continue
+        for key in ('p50', 'p99'):
+            if old[key] and result[key] > old[key] * (1 + tolerance):
+                print 'REGRESSION %s %s: %.3fs -> %.3fs' % (
+                    name, key, old[key], result[key])
+                regressions += 1
+        if result['throughput'] < old['throughput'] * (1 - tolerance):
+            print 'REGRESSION %s throughput: %.2f/s -> %.2f/s' % (
+                name, old['throughput'], result['throughput'])
+            regressions += 1
+
+    old_rss = baseline['server']['peak_rss_kb']
+    new_rss = results['server']['peak_rss_kb']
+    if new_rss > old_rss * (1 + tolerance):
+        print 'REGRESSION peak RSS: %d kB -> %d kB' % (old_rss, new_rss)
+        regressions += 1
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--commits', type='int', default=200)
+    parser.add_option('--files', type='int', default=200)
+    parser.add_option('--file-size', type='int', default=4096)
+    parser.add_option('--changes', type='int', default=5,
+                      help='files changed per commit')
+    parser.add_option('--refs', type='int', default=100)
+    parser.add_option('--clients', type='int', default=8)
+    parser.add_option('--rounds', type='int', default=5)
+    parser.add_option('--protocols', default=','.join(PROTOCOLS))
+    parser.add_option('--operations', default=','.join(OPERATIONS))
+    parser.add_option('--protocol-version', type='int', default=0)
+    parser.add_option('--no-caches', action='store_false', dest='caches',
+                      default=True, help='plain git_configuration')
+    parser.add_option('--output', help='write the results as JSON')
+    parser.add_option('--baseline', help='compare with earlier results')
+    parser.add_option('--tolerance', type='float', default=0.2)
+    parser.add_option('--keep', action='store_true',
+                      help='keep the working directory')
+    options, unused_args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='gitserverglue-bench-')
+    pid = None
+    try:
+        setup(workdir, options)
+        pid, ports = start_server(workdir, options.caches)
+        sampler = Sampler(pid)
+        sampler.start()
+
+        scenarios = {}
+        print '%-20s %6s %6s %9s %8s %8s' % ('scenario', 'ops', 'errors',
+                                             'ops/s', 'p50', 'p99')
+        for operation in options.operations.split(','):
+            for protocol in options.protocols.split(','):
+                client = Client(workdir, ports, protocol,
+                                options.protocol_version)
+                if not client.supports(operation):
+                    continue
+                name = '%s/%s' % (protocol, operation)
+                result = scenario(client, operation, options.clients,
+                                  options.rounds)
+                scenarios[name] = result
+                print '%-20s %6d %6d %9.2f %7.3fs %7.3fs' % (
+                    name, result['operations'], result['errors'],
+                    result['throughput'], result['p50'] or 0,
+                    result['p99'] or 0)
+                if result['first_error']:
+                    print '    %s' % result['first_error']
+
+        sampler.stopped.set()
+        sampler.join()
+        results = {
+            'options': vars(options),
+            'scenarios': scenarios,
+            'server': {
+                'peak_rss_kb': sampler.peak_rss_kb,
+                'peak_fds': sampler.peak_fds,
+                'peak_processes': sampler.peak_processes,
+            },
+        }
+        print 'server: peak RSS %(peak_rss_kb)d kB, peak fds ' \
+              '%(peak_fds)d, peak processes %(peak_processes)d' % \
+              results['server']
+    finally:
+        if pid is not None:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        if options.keep:
+            print 'Kept %s' % workdir
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, options.tolerance):
+            sys.exit(1)
+        print 'No regressions against %s' % options.baseline
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+"""Compares gitserverglue.pktline with the string based code it replaced
+
+Decoding feeds a negotiation of many have lines in chunks of the given
+size, as a client would send it, and counts the decoded packets.
+
+    $ python benchmarks/bench_pktline.py [--haves N] [--chunk BYTES]
+"""
+
+import os
+import sys
+import time
+import hashlib
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from gitserverglue import pktline
+
+
+def old_git_packet(data=None):
+    if data is None:
+        return '0000'
+    return str(hex(len(data) + 4)[2:].rjust(4, '0')) + data
+
+
+class OldDecoder(object):
+    """The string buffer of GitProtocol.dataReceived before pktline"""
+
+    def __init__(self):
+        self.buffer = ''
+        self.packets = 0
+        self.size = 0
+
+    def dataReceived(self, data):
+        self.buffer = self.buffer + data
+
+        while len(self.buffer) >= 4:
+            pktlen = int(self.buffer[:4], 16)
+            if pktlen == 0:
+                pktlen = 4
+            if pktlen > len(self.buffer):
+                return
+            packet = self.buffer[:pktlen]
+            self.buffer = self.buffer[pktlen:]
+            self.packets += 1
+            self.size += len(packet)
+
+
+class NewDecoder(object):
+    """Packet by packet like GitProtocol.dataReceived"""
+
+    def __init__(self):
+        self.decoder = pktline.PacketDecoder()
+        self.packets = 0
+        self.size = 0
+
+    def dataReceived(self, data):
+        self.decoder.feed(data)
+        while True:
+            packet = self.decoder.next_packet()
+            if packet is None:
+                return
+            self.packets += 1
+            self.size += len(packet)
+
+
+class BatchDecoder(NewDecoder):
+    def dataReceived(self, data):
+        self.decoder.feed(data)
+        for packet in self.decoder.packets():
+            self.packets += 1
+            self.size += len(packet)
+
+
+def negotiation(haves):
+    lines = ['want %s multi_ack_detailed side-band-64k ofs-delta\n'
+             % hashlib.sha1('want').hexdigest(), None]
+    for i in xrange(haves):
+        lines.append('have %s\n' % hashlib.sha1(str(i)).hexdigest())
+        if i % 32 == 31:
+            lines.append(None)
+    lines.append('done\n')
+    return lines
+
+
+def measure(name, func, *args):
+    start = time.time()
+    result = func(*args)
+    elapsed = time.time() - start
+    print '%-40s %8.3fs' % (name, elapsed)
+    return elapsed, result
+
+
+def decode(decoder_class, data, chunk):
+    decoder = decoder_class()
+    for i in xrange(0, len(data), chunk):
+        decoder.dataReceived(data[i:i + chunk])
+    return decoder.packets, decoder.size
+
+
+def encode_old(lines):
+    return ''.join(old_git_packet(line) for line in lines)
+
+
+def encode_new(lines):
+    return pktline.encode_lines(lines, flush=False)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--haves', type='int', default=200000)
+    parser.add_option('--chunk', type='int', default=65536)
+    options, unused_args = parser.parse_args()
+
+    lines = negotiation(options.haves)
+    print '%d lines, chunks of %d bytes' % (len(lines), options.chunk)
+
+    old_time, old_data = measure('encode: git_packet', encode_old, lines)
+    new_time, new_data = measure('encode: pktline.encode_lines', encode_new,
+                                 lines)
+    assert old_data == new_data
+    print '%-40s %8.2fx' % ('speedup', old_time / new_time)
+
+    old_time, old_decoded = measure('decode: string buffer', decode,
+                                    OldDecoder, new_data, options.chunk)
+    new_time, new_decoded = measure('decode: PacketDecoder.next_packet',
+                                    decode, NewDecoder, new_data,
+                                    options.chunk)
+    batch_time, batch_decoded = measure('decode: PacketDecoder.packets',
+                                        decode, BatchDecoder, new_data,
+                                        options.chunk)
+    assert old_decoded == new_decoded == batch_decoded
+    assert old_decoded[0] == len(lines) and old_decoded[1] == len(new_data)
+    print '%-40s %8.2fx' % ('speedup next_packet', old_time / new_time)
+    print '%-40s %8.2fx' % ('speedup packets', old_time / batch_time)
+
+
+if __name__ == '__main__':
+    main()
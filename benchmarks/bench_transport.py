@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+"""Measures what relaying data between clients and git costs
+
+The microbenchmarks push data through the methods relaying it, with
+sinks instead of sockets and processes:
+
+- GitProtocol.dataReceived, client to git, pkt-lines of have lines
+- GitProcessProtocol.outReceived, git to client
+- StreamingRequest.handleContentChunk, HTTP request body to git
+- FileLikeProducer._writeloop, buffered HTTP request body to git
+
+The chunk sizes default to what twisted reads at once from sockets
+(64 KiB) and from process pipes (8 KiB). The overhead per chunk (in
+microseconds) is the time spent beyond writing the chunks directly
+into the sink.
+
+With --relay, the servers are started with benchmarks/fake_git.py as
+git, and --clients clients fetch --megabytes each over git://, http://
+and ssh:// (if ssh and ssh-keygen are available). The CPU time of the
+server process per GB is the cost of the twisted relay. --rate limits
+all responses to that many MB/s with a BandwidthShaper; with bandwidth
+shared evenly, the first client finishes shortly before the last.
+
+    $ python benchmarks/bench_transport.py [--megabytes N] [--chunk BYTES]
+          [--relay] [--clients N] [--rate MB/s]
+"""
+
+import os
+import sys
+import time
+import socket
+import shutil
+import httplib
+import tempfile
+import optparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from gitserverglue import git, http, ssh
+from gitserverglue import TestGitConfiguration
+from gitserverglue.http import FileLikeProducer, GitCommand
+from gitserverglue.metrics import untracked
+from gitserverglue.pktline import encode, encode_lines, FLUSH
+from gitserverglue.shaping import BandwidthShaper
+from gitserverglue.streamingweb import StreamingRequest, make_site_streaming
+from gitserverglue.tracing import unsampled
+
+import fake_git
+
+SOCKET_READ = 2 ** 16
+PIPE_READ = 8192
+
+
+class NullSink(object):
+    """Transport, process and consumer which only counts bytes"""
+
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+
+    def writeSequence(self, seq):
+        for data in seq:
+            self.write(data)
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
+
+    def loseConnection(self):
+        pass
+
+    def getPeer(self):
+        return None
+
+    def getHost(self):
+        return None
+
+
+class NullChannel(object):
+    def __init__(self):
+        self.transport = NullSink()
+
+    def getPeer(self):
+        return None
+
+    def getHost(self):
+        return None
+
+
+class StubProcess(object):
+    def __init__(self, transport):
+        self.transport = transport
+
+
+class StubGitProtocol(object):
+    """What GitProcessProtocol needs from a GitProtocol"""
+    span = unsampled
+    tracker = untracked
+
+    def __init__(self, transport):
+        self.transport = transport
+
+
+def cpu_time():
+    user, system = os.times()[:2]
+    return user + system
+
+
+def measure(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def report(name, total, chunks, elapsed, direct):
+    print '%-36s %9.1f %10.2f %10.2f %8.3f' % (
+        name, total / elapsed / 1024 ** 2, elapsed / chunks * 1e6,
+        (elapsed - direct) / chunks * 1e6, elapsed / total * 1024 ** 3)
+
+
+def split(data, size):
+    return [data[i:i + size] for i in xrange(0, len(data), size)]
+
+
+def direct_writes(chunks):
+    sink = NullSink()
+    return measure(lambda: map(sink.write, chunks))
+
+
+def bench_data_received(options):
+    lines = ['have %040x\n' % i
+             for i in xrange(options.megabytes * 1024 ** 2 // 50)]
+    data = encode_lines(lines)
+    chunks = split(data, options.chunk or SOCKET_READ)
+
+    sink = NullSink()
+    proto = git.GitProtocol(None, TestGitConfiguration())
+    proto.transport = NullSink()
+    proto.requestReceived = True
+    proto.process = StubProcess(sink)
+    elapsed = measure(lambda: map(proto.dataReceived, chunks))
+    assert sink.bytes == len(data)
+    report('GitProtocol.dataReceived', len(data), len(chunks), elapsed,
+           direct_writes(chunks))
+
+
+def bench_out_received(options):
+    chunk = 'x' * (options.chunk or PIPE_READ)
+    chunks = [chunk] * (options.megabytes * 1024 ** 2 // len(chunk))
+
+    sink = NullSink()
+    process = git.GitProcessProtocol(StubGitProtocol(sink))
+    elapsed = measure(lambda: map(process.outReceived, chunks))
+    report('GitProcessProtocol.outReceived', sink.bytes, len(chunks),
+           elapsed,
+           direct_writes(chunks))
+
+
+def bench_handle_content_chunk(options):
+    chunk = 'x' * (options.chunk or SOCKET_READ)
+    chunks = [chunk] * (options.megabytes * 1024 ** 2 // len(chunk))
+
+    sink = NullSink()
+    request = StreamingRequest(NullChannel())
+    request._fallbackToBuffered = False
+    request.resource = GitCommand('git', ['git', 'upload-pack'])
+    request.resource.process = sink
+    elapsed = measure(lambda: map(request.handleContentChunk, chunks))
+    report('StreamingRequest.handleContentChunk', sink.bytes, len(chunks),
+           elapsed,
+           direct_writes(chunks))
+
+
+def bench_writeloop(options):
+    size = options.chunk or SOCKET_READ
+    # bodies of more than 100000 bytes are buffered in a temporary file
+    content = tempfile.TemporaryFile()
+    for unused in xrange(options.megabytes):
+        content.write('x' * 1024 ** 2)
+    total = content.tell()
+
+    def direct():
+        content.seek(0)
+        sink = NullSink()
+        while True:
+            data = content.read(size)
+            if not data:
+                break
+            sink.write(data)
+    direct_elapsed = measure(direct)
+
+    content.seek(0)
+    sink = NullSink()
+    producer = FileLikeProducer(content, sink, readSize=size)
+    elapsed = measure(lambda: list(producer._writeloop(sink)))
+    assert sink.bytes == total
+    report('FileLikeProducer._writeloop', total, total // size, elapsed,
+           direct_elapsed)
+
+    # the loop is driven by a twisted.internet.task.Cooperator
+    from twisted.internet import reactor
+    content.seek(0)
+    sink = NullSink()
+    producer = FileLikeProducer(content, sink, readSize=size)
+
+    def run():
+        producer.startProducing()
+        producer._task.whenDone().addBoth(lambda ignored: reactor.stop())
+        reactor.run()
+    elapsed = measure(run)
+    report('FileLikeProducer (cooperator)', total, total // size, elapsed,
+           direct_elapsed)
+    content.close()
+
+
+class OpenAuthnz(object):
+    def can_read(self, username, path_info):
+        return path_info['repository_fs_path'] is not None
+
+    def can_write(self, username, path_info):
+        return False
+
+    def check_publickey(self, username, keyblob):
+        return True
+
+
+def fetch_request():
+    return (encode('want %s side-band-64k\n' % fake_git.fake_sha(0)) +
+            FLUSH + encode('done\n'))
+
+
+def drain(read):
+    total = 0
+    while True:
+        data = read(SOCKET_READ)
+        if not data:
+            return total
+        total += len(data)
+
+
+def git_client(ports, workdir):
+    s = socket.create_connection(('127.0.0.1', ports['git']))
+    s.sendall(encode('git-upload-pack /bench.git\0host=localhost\0') +
+              fetch_request())
+    return drain(s.recv)
+
+
+def http_client(ports, workdir):
+    connection = httplib.HTTPConnection('127.0.0.1', ports['http'])
+    connection.request('POST', '/bench.git/git-upload-pack',
+                       fetch_request(), {
+                           'Content-Type':
+                                'application/x-git-upload-pack-request'})
+    return drain(connection.getresponse().read)
+
+
+def ssh_client(ports, workdir):
+    p = subprocess.Popen([
+        'ssh', '-p', str(ports['ssh']), '-T', '-i',
+        os.path.join(workdir, 'client_key'), '-o', 'BatchMode=yes',
+        '-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null',
+        '-o', 'LogLevel=ERROR', '-o', 'HostKeyAlgorithms=+ssh-rsa',
+        '-o', 'PubkeyAcceptedKeyTypes=+ssh-rsa', 'bench@127.0.0.1',
+        "git-upload-pack '/bench.git'"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    p.stdin.write(fetch_request())
+    p.stdin.flush()
+    return drain(p.stdout.read)
+
+
+def has_ssh():
+    with open(os.devnull, 'w') as devnull:
+        for command in (['ssh', '-V'], ['ssh-keygen', '--help']):
+            try:
+                subprocess.call(command, stdout=devnull, stderr=devnull)
+            except OSError:
+                return False
+    return True
+
+
+def relay(options):
+    from twisted.conch.ssh import keys
+    from twisted.internet import reactor, threads, defer
+
+    workdir = tempfile.mkdtemp(prefix='gitserverglue-bench-')
+    os.chdir(workdir)
+    os.mkdir('bench.git')
+    wrapper = os.path.join(workdir, 'fake-git')
+    fake_git.install(wrapper, options)
+
+    git_configuration = TestGitConfiguration()
+    git_configuration.git_binary = wrapper
+    git_configuration.git_shell_binary = wrapper
+    if options.rate:
+        git_configuration.bandwidth_shaper = BandwidthShaper(
+                        int(options.rate * 1024 ** 2))
+    authnz = OpenAuthnz()
+
+    factories = [
+        ('git', git.create_factory(authnz, git_configuration), git_client),
+        ('http', make_site_streaming(http.create_factory(
+                        authnz, git_configuration)), http_client),
+    ]
+    if has_ssh():
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['ssh-keygen', '-q', '-t', 'rsa', '-m',
+                                   'PEM', '-N', '', '-f', 'host_key'],
+                                  stdout=devnull)
+            subprocess.check_call(['ssh-keygen', '-q', '-t', 'rsa', '-N', '',
+                                   '-f', 'client_key'], stdout=devnull)
+        key = keys.Key.fromFile('host_key')
+        factories.append(('ssh', ssh.create_factory(
+                            public_keys={'ssh-rsa': key},
+                            private_keys={'ssh-rsa': key},
+                            authnz=authnz,
+                            git_configuration=git_configuration),
+                          ssh_client))
+    else:
+        print 'ssh or ssh-keygen not found, skipping ssh://'
+
+    ports = {}
+    for name, factory, unused_client in factories:
+        ports[name] = reactor.listenTCP(0, factory,
+                                        interface='127.0.0.1').getHost().port
+
+    def fork_client(client):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                expected = options.megabytes * 1024 ** 2
+                code = 0 if client(ports, workdir) > expected else 1
+            finally:
+                os._exit(code)
+        d = threads.deferToThread(os.waitpid, pid, 0)
+        return d.addCallback(lambda (pid, status): (status, time.time()))
+
+    @defer.inlineCallbacks
+    def run():
+        print '%-6s %8s %8s %8s %9s %10s' % ('', 'seconds', 'first s',
+                                             'MB/s', 'CPU s', 'CPU s/GB')
+        for name, unused_factory, client in factories:
+            wall, cpu = time.time(), cpu_time()
+            results = yield defer.gatherResults(
+                [fork_client(client) for unused in xrange(options.clients)])
+            first = min(finished for unused, finished in results) - wall
+            wall, cpu = time.time() - wall, cpu_time() - cpu
+            total = options.megabytes * options.clients * 1024 ** 2
+            failed = len([r for r in results if r[0] != 0])
+            print '%-6s %8.2f %8.2f %8.1f %9.2f %10.2f%s' % (
+                name, wall, first, total / wall / 1024 ** 2, cpu,
+                cpu / total * 1024 ** 3,
+                ' (%d clients failed)' % failed if failed else '')
+
+    def done(result):
+        reactor.stop()
+        return result
+
+    reactor.callWhenRunning(lambda: run().addBoth(done))
+    try:
+        reactor.run()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--megabytes', type='int', default=100)
+    parser.add_option('--chunk', type='int', default=None,
+                      help='bytes per call, default depends on the method')
+    parser.add_option('--relay', action='store_true',
+                      help='fetch from servers using fake_git instead')
+    parser.add_option('--clients', type='int', default=4)
+    parser.add_option('--refs', type='int', default=100)
+    parser.add_option('--rate', type='float', metavar='MB/s',
+                      help='limit the bandwidth of the relay servers')
+    options, unused_args = parser.parse_args()
+
+    if options.relay:
+        return relay(options)
+
+    print '%d MB per method' % options.megabytes
+    print '%-36s %9s %10s %10s %8s' % ('', 'MB/s', 'us/chunk', 'overhead',
+                                      's/GB')
+    bench_data_received(options)
+    bench_out_received(options)
+    bench_handle_content_chunk(options)
+    bench_writeloop(options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+"""A stand-in for git_binary and git_shell_binary which costs no time
+
+upload-pack advertises --refs refs, reads the client request until
+done and answers with --megabytes of side-band data. The data is not a
+valid pack, so it is meant for clients which only count bytes.
+receive-pack advertises the refs, reads everything the client sends
+and reports success.
+
+git processes are spawned with a fixed environment and arguments, so
+the options are baked into a wrapper script:
+
+    $ python benchmarks/fake_git.py --megabytes 100 --refs 1000 \\
+          --install /tmp/fake-git
+
+and git_configuration.git_binary and git_shell_binary are set to
+/tmp/fake-git.
+"""
+
+import os
+import sys
+import optparse
+
+CAPABILITIES = ('multi_ack_detailed side-band-64k ofs-delta thin-pack '
+                'no-progress report-status delete-refs')
+
+# importing gitserverglue would slow down every spawn, so the few
+# pkt-line functions needed are repeated here
+FLUSH = '0000'
+BAND_PAYLOAD = 65515  # side-band-64k data per packet
+
+
+def encode(data):
+    return '%04x%s' % (len(data) + 4, data)
+
+
+def ref_name(i):
+    return 'refs/heads/master' if i == 0 else 'refs/tags/t%d' % i
+
+
+def fake_sha(i):
+    return ('%040x' % (0x1000 + i))[-40:]
+
+
+def advertisement(refs):
+    lines = []
+    for i in xrange(max(refs, 1)):
+        line = '%s %s' % (fake_sha(i), ref_name(i))
+        if i == 0:
+            line += '\0' + CAPABILITIES
+        lines.append(encode(line + '\n'))
+    return ''.join(lines) + FLUSH
+
+
+def write(data):
+    while data:
+        data = data[os.write(1, data):]
+
+
+def read_exactly(n):
+    data = ''
+    while len(data) < n:
+        chunk = os.read(0, n - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def read_request(until):
+    """Read packets from stdin until a packet for which until returns
+    True or the end of input, returns all packets"""
+    packets = []
+    while True:
+        header = read_exactly(4)
+        if header is None:
+            return packets
+        length = int(header, 16)
+        packet = header
+        if length > 4:
+            packet += read_exactly(length - 4) or ''
+        packets.append(packet)
+        if until(packet):
+            return packets
+
+
+def upload_pack(options, stateless):
+    if not stateless:
+        write(advertisement(options.refs))
+
+    request = read_request(lambda p: p[4:].rstrip('\n') == 'done' or
+                           (p == FLUSH and not stateless))
+    if not request or request == [FLUSH]:
+        return  # ls-remote
+
+    write(encode('NAK\n'))
+    remaining = options.megabytes * 1024 ** 2
+    packet = encode('\1' + 'x' * BAND_PAYLOAD)
+    while remaining > BAND_PAYLOAD:
+        write(packet)
+        remaining -= BAND_PAYLOAD
+    write(encode('\1' + 'x' * remaining) + FLUSH)
+
+
+def receive_pack(options, stateless):
+    if not stateless:
+        write(advertisement(options.refs))
+
+    commands = read_request(lambda p: p == FLUSH)
+    commands = [c for c in commands if c != FLUSH]
+    if not commands:
+        return
+    while os.read(0, 65536):
+        pass  # the pack
+
+    lines = ['unpack ok\n']
+    for command in commands:
+        ref = command[4:].split('\0')[0].split()[2]
+        lines.append('ok %s\n' % ref)
+    write(''.join(encode(line) for line in lines) + FLUSH)
+
+
+def install(path, options):
+    """Write a wrapper script running fake_git with options"""
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\nexec %s %s --megabytes %d --refs %d -- "$@"\n'
+                % (sys.executable, os.path.abspath(__file__),
+                   options.megabytes, options.refs))
+    os.chmod(path, 0755)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] -- git arguments')
+    parser.add_option('--megabytes', type='int', default=10,
+                      help='side-band data sent for a fetch')
+    parser.add_option('--refs', type='int', default=100)
+    parser.add_option('--install', metavar='PATH',
+                      help='write a wrapper script to PATH and exit')
+    options, args = parser.parse_args()
+
+    if options.install:
+        return install(options.install, options)
+
+    if args[:1] == ['-c']:
+        # git-shell -c "git-upload-pack 'path'"
+        args = args[1].split(' ', 1)[0][4:].split()
+
+    command = args[0]
+    stateless = '--stateless-rpc' in args
+    if '--advertise-refs' in args:
+        write(advertisement(options.refs))
+    elif command == 'upload-pack':
+        upload_pack(options, stateless)
+    elif command == 'receive-pack':
+        receive_pack(options, stateless)
+    else:
+        sys.stderr.write('fake_git: %s is not supported\n' % command)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+"""A stub of a remote permission service for PermissionService
+
+Answers GET /?level=r&repository=test.git&user=test from a .repoperms
+file, after --delay seconds, so a server can be tested against a slow
+service:
+
+    $ python benchmarks/permission_service.py --delay 0.5 &
+    $ python -m gitserverglue --permission-service http://127.0.0.1:9300/
+
+GET /stats gives the number of permission requests answered so far,
+which shows how many checks of concurrent clones were coalesced.
+--fail answers all permission requests with 500.
+"""
+
+import os
+import sys
+import json
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from twisted.internet import reactor
+from twisted.python import log
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+
+from gitserverglue.acl import PermissionIndex
+
+
+class PermissionResource(Resource):
+    isLeaf = True
+
+    def __init__(self, permissions, delay, fail):
+        Resource.__init__(self)
+        self.permissions = permissions
+        self.delay = delay
+        self.fail = fail
+        self.requests = 0
+
+    def render_GET(self, request):
+        if request.postpath == ['stats']:
+            return json.dumps({'requests': self.requests})
+
+        self.requests += 1
+        level = request.args.get('level', [''])[0]
+        repository = request.args.get('repository', [''])[0]
+        username = request.args.get('user', [None])[0]
+        reactor.callLater(self.delay, self.answer, request, repository,
+                          username, level)
+        return NOT_DONE_YET
+
+    def answer(self, request, repository, username, level):
+        if request.finished or request.channel is None:
+            return  # the client gave up
+        if self.fail:
+            request.setResponseCode(500)
+            body = 'failing as asked to'
+        else:
+            allowed = bool(level) and self.permissions.allowed(
+                                            repository, username, level)
+            request.setHeader('Content-Type', 'application/json')
+            body = json.dumps({'allowed': allowed})
+        request.write(body)
+        request.finish()
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--port', type='int', default=9300)
+    parser.add_option('--delay', type='float', default=0.1,
+                      help='seconds to wait before answering')
+    parser.add_option('--fail', action='store_true',
+                      help='answer all permission requests with 500')
+    parser.add_option('--perms-file', default='.repoperms')
+    options, unused_args = parser.parse_args()
+
+    log.startLogging(sys.stderr)
+    resource = PermissionResource(PermissionIndex(options.perms_file),
+                                  options.delay, options.fail)
+    reactor.listenTCP(options.port, Site(resource), interface='127.0.0.1')
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
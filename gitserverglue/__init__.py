@@ -20,6 +20,7 @@
 import os
 import os.path
 import sys
+import optparse
 
 from twisted.internet import reactor
 from twisted.conch.ssh import keys
@@ -27,11 +28,28 @@ from twisted.python import log
 
 from Crypto.PublicKey import RSA
 
-from gitserverglue import ssh, http, git
+from gitserverglue import ssh, http, git, workers
+from gitserverglue.acl import PermissionIndex, PermissionService
+from gitserverglue.authcache import CachingAuthnz
+from gitserverglue.bundles import BundleStore
+from gitserverglue.compression import ResponseCompression
+from gitserverglue.immutable import OpenFileCache
+from gitserverglue.keystore import PublicKeyStore
+from gitserverglue.maintenance import MaintenanceScheduler
+from gitserverglue.metrics import ServerMetrics, create_admin_factory
+from gitserverglue.mirror import MirrorManager
+from gitserverglue.packcache import PackCache
+from gitserverglue.passwords import PasswordVerifier
+from gitserverglue.pathcache import CachingPathLookup
+from gitserverglue.proxy import Backend, BackendPool
+from gitserverglue.refs import AdvertisementCache, RefAdvertiser
+from gitserverglue.scheduler import ProcessScheduler
+from gitserverglue.shaping import BandwidthShaper
 from gitserverglue.streamingweb import make_site_streaming
+from gitserverglue.timeouts import Timeouts
+from gitserverglue.tracing import Tracer, LogSink
 from gitserverglue.wsgihelper import WSGIResource
 
-from ConfigParser import SafeConfigParser
 from passlib.apache import HtpasswdFile
 
 
@@ -39,10 +57,16 @@ class TestAuthnz(object):
     def __init__(self,
                  htpasswd_file=".htpasswd",
                  perms_file=".repoperms",
-                 keys_file=".rsakeys"):
+                 keys_file=".rsakeys",
+                 permission_service=None):
         self.htpasswd = HtpasswdFile(htpasswd_file)
-        self.perms_file = perms_file
-        self.keys_file = keys_file
+        self.password_verifier = PasswordVerifier(self.htpasswd.check_password)
+        if permission_service is not None:
+            # can_read and can_write return Deferreds
+            self.permissions = PermissionService(permission_service)
+        else:
+            self.permissions = PermissionIndex(perms_file)
+        self.public_keys = PublicKeyStore(keys_file)
 
     def can_read(self, username, path_info):
         return self._check_access(username, path_info, "r")
@@ -51,43 +75,42 @@ class TestAuthnz(object):
         return self._check_access(username, path_info, "w")
 
     def _check_access(self, username, path_info, level):
-        if username is None:
-            username = "anonymous"
-
-        if path_info['repository_fs_path'] is None:
-            return False
-
-        repo = os.path.basename(path_info['repository_fs_path'])
-
-        config = SafeConfigParser()
-        config.read(self.perms_file)
-
-        if not config.has_option(repo, username):
+        if path_info.get('repository_backend') is not None:
+            repo = path_info['repository_name']
+        elif path_info['repository_fs_path'] is None:
             return False
-
-        return level in config.get(repo, username)
+        else:
+            repo = os.path.basename(path_info['repository_fs_path'])
+        return self.permissions.allowed(repo, username, level)
 
     def check_password(self, username, password):
-        self.htpasswd.load_if_changed()
-        return self.htpasswd.check_password(username, password)
+        if self.htpasswd.load_if_changed():
+            self.password_verifier.clear()
+        return self.password_verifier.verify(username, password)
 
     def check_publickey(self, username, keyblob):
-        with open(self.keys_file, 'rb') as f:
-            for line in f:
-                try:
-                    user, key = line.split(':', 1)
-                    if (username == user.strip() and
-                        keyblob == keys.Key.fromString(data=key.strip()
-                                                       ).blob()):
-                        return True
-                except:
-                    log.err(None, "Loading key failed")
-        return False
+        return self.public_keys.allowed(username, keyblob)
 
 
 class TestGitConfiguration(object):
     git_binary = 'git'
     git_shell_binary = 'git-shell'
+    pack_cache = None
+    advertisement_cache = None
+    process_scheduler = None
+    bandwidth_shaper = None
+    bundle_store = None
+    maintenance_scheduler = None
+    response_compression = None
+    ref_advertiser = None
+    open_files = None
+    metrics = None
+    tracer = None
+    worker = None
+    trusted_proxies = ()
+    backends = None  # a BackendPool serving all repositories
+    mirror_manager = None
+    upstream = None  # URL prefix of the repositories to mirror
 
     def path_lookup(self, url, protocol_hint=None):
         res = {
@@ -98,6 +121,22 @@ class TestGitConfiguration(object):
 
         pathparts = url.strip('/').split('/')
 
+        if self.backends is not None:
+            res['repository_base_fs_path'] = None
+            if len(pathparts) > 0 and pathparts[0].endswith('.git'):
+                res['repository_backend'] = self.backends
+                res['repository_name'] = pathparts[0]
+            return res
+
+        if self.upstream is not None:
+            if len(pathparts) > 0 and pathparts[0].endswith('.git'):
+                # cloned by the mirror_manager when first read
+                res['repository_fs_path'] = os.path.join('./mirrors',
+                                                         pathparts[0])
+                res['repository_upstream'] = '%s/%s' % (
+                                    self.upstream.rstrip('/'), pathparts[0])
+            return res
+
         if len(pathparts) > 0 and pathparts[0].endswith('.git'):
             p = os.path.join('./', pathparts[0])
             if os.path.exists(p):
@@ -136,9 +175,13 @@ def find_git_viewer():
         pass
 
 
-def main():
-    log.startLogging(sys.stderr)
+# ports of the test servers
+PORTS = {'ssh': 5522, 'http': 8080, 'git': 9418}
+ADMIN_PORT = 9180
 
+
+def load_host_key():
+    """Load the SSH host key, generating it on first use"""
     keylocation = os.path.expanduser(
                     os.path.join('~', '.gitserverglue', 'key.pem'))
     key = None
@@ -162,25 +205,237 @@ def main():
         except:
             log.err(None, "Failed to write key to " + keylocation)
 
+    return key
+
+
+def parse_backends(spec):
+    """Parse host:git_port:http_port,... into a BackendPool"""
+    backends = []
+    for node in spec.split(','):
+        host, git_port, http_port = node.split(':')
+        backends.append(Backend(host, int(git_port), int(http_port)))
+    return BackendPool(backends)
+
+
+def parse_timeouts(spec):
+    """Parse name=seconds,... into arguments of Timeouts, 0 disables
+    a timeout"""
+    timeouts = {}
+    for item in spec.split(','):
+        name, seconds = item.split('=')
+        if name not in ('idle', 'handshake', 'inactivity', 'duration'):
+            raise ValueError("Unknown timeout %s" % name)
+        timeouts[name] = float(seconds) or None
+    return timeouts
+
+
+def parse_bandwidth(spec):
+    """Parse name=bytes_per_second,... into arguments of BandwidthShaper,
+    names are all, user, address and repository"""
+    arguments = {'all': 'rate', 'user': 'per_user', 'address': 'per_address',
+                 'repository': 'per_repository'}
+    limits = {}
+    for item in spec.split(','):
+        name, rate = item.split('=')
+        if name not in arguments:
+            raise ValueError("Unknown bandwidth limit %s" % name)
+        limits[arguments[name]] = int(rate)
+    return limits
+
+
+def create_servers(pack_cache_directory, backends=None, trusted_proxies=(),
+                   upstream=None, timeouts=None, permission_service=None,
+                   permission_cache=0, bandwidth=None, bundles=False,
+                   maintenance=False):
+    """Set up the test configuration, returns (git_configuration,
+    metrics, factories) with the server factories by name
+
+    With a BackendPool as backends, all repositories are served by its
+    nodes. trusted_proxies are the addresses of proxies (servers with
+    backends) whose requests are trusted. With an upstream URL prefix,
+    the repositories below it are mirrored in ./mirrors. timeouts are
+    the arguments of the Timeouts of the connections. With the URL of
+    a permission_service, it is asked instead of .repoperms and its
+    answers are cached for permission_cache seconds. bandwidth are the
+    arguments of a BandwidthShaper limiting the responses. With bundles,
+    clone bundles are built in ~/.gitserverglue/bundles. With
+    maintenance, repositories are maintained after pushes."""
+    metrics = ServerMetrics()
+    git_configuration = TestGitConfiguration()
+    git_configuration.metrics = metrics
+    git_configuration.trusted_proxies = trusted_proxies
+    if backends is not None:
+        git_configuration.backends = backends
+        backends.start()
+        metrics.watch_backends(backends)
+    if upstream is not None:
+        git_configuration.upstream = upstream
+        git_configuration.mirror_manager = MirrorManager(
+                    git_configuration.git_binary,
+                    git_configuration=git_configuration)
+        metrics.watch_mirrors(git_configuration.mirror_manager)
+    git_configuration.tracer = Tracer(LogSink())
+    git_configuration.path_lookup = metrics.timed_path_lookup(
+                    CachingPathLookup(git_configuration.path_lookup))
+    git_configuration.pack_cache = PackCache(pack_cache_directory)
+    git_configuration.advertisement_cache = AdvertisementCache()
+    git_configuration.process_scheduler = ProcessScheduler()
+    metrics.watch_scheduler(git_configuration.process_scheduler)
+    git_configuration.ref_advertiser = RefAdvertiser(
+                    git_configuration.advertisement_cache)
+    git_configuration.open_files = OpenFileCache()
+    git_configuration.response_compression = ResponseCompression()
+    if bandwidth is not None:
+        git_configuration.bandwidth_shaper = BandwidthShaper(**bandwidth)
+        metrics.watch_shaper(git_configuration.bandwidth_shaper)
+    if bundles:
+        git_configuration.bundle_store = BundleStore(
+                    os.path.expanduser(os.path.join('~', '.gitserverglue',
+                                                    'bundles')),
+                    git_configuration.git_binary)
+        git_configuration.bundle_store.start()
+        metrics.watch_bundles(git_configuration.bundle_store)
+    if maintenance:
+        git_configuration.maintenance_scheduler = MaintenanceScheduler(
+                    git_configuration.git_binary)
+        metrics.watch_maintenance(git_configuration.maintenance_scheduler)
+
+    authnz = CachingAuthnz(TestAuthnz(
+                    permission_service=permission_service),
+                    ttl=permission_cache, negative_ttl=permission_cache)
+    metrics.watch_authz(authnz)
+    key = load_host_key()
+
     ssh_factory = ssh.create_factory(
         public_keys={'ssh-rsa': key},
         private_keys={'ssh-rsa': key},
-        authnz=TestAuthnz(),
-        git_configuration=TestGitConfiguration()
+        authnz=authnz,
+        git_configuration=git_configuration
     )
 
     http_factory = http.create_factory(
-        authnz=TestAuthnz(),
-        git_configuration=TestGitConfiguration(),
+        authnz=authnz,
+        git_configuration=git_configuration,
         git_viewer=find_git_viewer()
     )
 
     git_factory = git.create_factory(
-        authnz=TestAuthnz(),
-        git_configuration=TestGitConfiguration()
+        authnz=authnz,
+        git_configuration=git_configuration
     )
 
-    reactor.listenTCP(5522, ssh_factory)
-    reactor.listenTCP(8080, make_site_streaming(http_factory))
-    reactor.listenTCP(9418, git_factory)
+    http_factory = make_site_streaming(http_factory)
+    http_factory.timeOut = None  # see Timeouts
+
+    factories = {
+        'ssh': metrics.wrap_factory(ssh_factory, 'ssh'),
+        'http': metrics.wrap_factory(http_factory, 'http'),
+        'git': metrics.wrap_factory(git_factory, 'git'),
+    }
+    timeouts = Timeouts(**(timeouts or {}))
+    metrics.watch_timeouts(timeouts)
+    for name, factory in factories.items():
+        factories[name] = timeouts.wrap_factory(factory, name)
+    return git_configuration, metrics, factories
+
+
+def create_worker_servers(slot):
+    """create_servers for worker processes, see gitserverglue.workers"""
+    # each worker has a pack cache of its own
+    return create_servers(os.path.expanduser(os.path.join(
+                    '~', '.gitserverglue', 'packcache', 'worker-%d' % slot)))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--workers', type='int', default=0,
+                      help='serve from this many worker processes')
+    parser.add_option('--max-worker-rss', type='int', metavar='MB',
+                      help='replace workers using more memory')
+    parser.add_option('--port-offset', type='int', default=0, metavar='N',
+                      help='add N to all ports, to run several servers')
+    parser.add_option('--backends', metavar='HOST:GIT:HTTP,...',
+                      help='serve all repositories from these nodes')
+    parser.add_option('--trusted-proxies', default='', metavar='ADDR,...',
+                      help='trust the users proxies at these addresses '
+                           'authenticated')
+    parser.add_option('--upstream', metavar='URL',
+                      help='mirror the repositories below this URL')
+    parser.add_option('--timeouts', metavar='NAME=SECONDS,...',
+                      help='change the idle, handshake, inactivity or '
+                           'duration timeout, 0 disables one')
+    parser.add_option('--permission-service', metavar='URL',
+                      help='ask this HTTP service for permissions')
+    parser.add_option('--permission-cache', type='float', default=0,
+                      metavar='SECONDS',
+                      help='cache the answers of the permission service')
+    parser.add_option('--bandwidth', metavar='NAME=BYTES,...',
+                      help='limit the bytes per second sent to all, per '
+                           'user, address or repository')
+    parser.add_option('--bundles', action='store_true', default=False,
+                      help='offer clone bundles to git clients')
+    parser.add_option('--maintenance', action='store_true', default=False,
+                      help='repack repositories and update their '
+                           'commit-graph after pushes')
+    options, unused_args = parser.parse_args()
+    if options.workers > 0 and (options.backends or
+                                options.trusted_proxies or
+                                options.upstream or options.timeouts or
+                                options.permission_service or
+                                options.bandwidth or options.bundles or
+                                options.maintenance):
+        parser.error('--backends, --trusted-proxies, --upstream, '
+                     '--timeouts, --permission-service, --bandwidth, '
+                     '--bundles and --maintenance are not supported with '
+                     '--workers')
+    timeouts = None
+    if options.timeouts:
+        try:
+            timeouts = parse_timeouts(options.timeouts)
+        except ValueError as e:
+            parser.error('--timeouts: %s' % e)
+    bandwidth = None
+    if options.bandwidth:
+        try:
+            bandwidth = parse_bandwidth(options.bandwidth)
+        except ValueError as e:
+            parser.error('--bandwidth: %s' % e)
+    if options.backends and options.upstream:
+        parser.error('--backends and --upstream are mutually exclusive')
+    ports = dict((name, port + options.port_offset)
+                 for name, port in PORTS.items())
+
+    log.startLogging(sys.stderr)
+    load_host_key()  # before workers would generate it concurrently
+
+    if options.workers > 0:
+        max_rss = None
+        if options.max_worker_rss is not None:
+            max_rss = options.max_worker_rss * 1024 ** 2
+        supervisor = workers.Supervisor(
+                        'gitserverglue.create_worker_servers', ports,
+                        options.workers, max_rss)
+        supervisor.start()
+        reactor.listenTCP(ADMIN_PORT + options.port_offset,
+                          workers.create_admin_factory(supervisor),
+                          interface='127.0.0.1')
+        reactor.run()
+        return
+
+    backends = None
+    if options.backends:
+        backends = parse_backends(options.backends)
+    unused_config, metrics, factories = create_servers(
+                    os.path.expanduser(os.path.join('~', '.gitserverglue',
+                                                    'packcache')),
+                    backends,
+                    [a for a in options.trusted_proxies.split(',') if a],
+                    options.upstream, timeouts,
+                    options.permission_service, options.permission_cache,
+                    bandwidth, options.bundles, options.maintenance)
+    for name, factory in factories.items():
+        reactor.listenTCP(ports[name], factory)
+    reactor.listenTCP(ADMIN_PORT + options.port_offset,
+                      create_admin_factory(metrics),
+                      interface='127.0.0.1')
     reactor.run()
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+import re
+import json
+import urllib
+import fnmatch
+from ConfigParser import SafeConfigParser, Error as ConfigError
+
+from twisted.internet import reactor
+from twisted.python import log
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+
+from gitserverglue.common import WatchedFile
+
+ANONYMOUS = 'anonymous'
+GROUPS_SECTION = 'groups'
+
+_wildcard = re.compile(r'[*?[]')
+
+
+class CompiledPermissions(object):
+    """Immutable index of a parsed permission file"""
+
+    def __init__(self, config):
+        self.groups = {}  # user -> set of groups
+        self.exact = {}  # repository -> {principal: levels}
+        # (regex, {principal: levels}), most specific pattern first
+        self.patterns = []
+
+        if config.has_section(GROUPS_SECTION):
+            for group, members in config.items(GROUPS_SECTION):
+                for member in members.split(','):
+                    member = member.strip().lower()
+                    if member:
+                        self.groups.setdefault(member, set()).add(group)
+
+        patterns = []
+        for section in config.sections():
+            if section == GROUPS_SECTION:
+                continue
+            rules = dict((principal, levels.strip())
+                         for principal, levels in config.items(section))
+            match = _wildcard.search(section)
+            if match is None:
+                self.exact[section] = rules
+            else:
+                # a longer literal prefix is more specific
+                patterns.append((-match.start(), -len(section), section,
+                                 rules))
+
+        for unused_prefix, unused_len, section, rules in sorted(patterns):
+            self.patterns.append((re.compile(fnmatch.translate(section)),
+                                  rules))
+
+    def resolve(self, repository, username):
+        """Get the permission levels of a user for a repository
+
+        The most specific section mentioning the user (directly, through
+        one of the groups or as *) decides, the levels of all matching
+        entries within that section are combined."""
+        principals = [username]
+        principals.extend('@' + g for g in self.groups.get(username, ()))
+        if username != ANONYMOUS:
+            principals.append('*')
+
+        candidates = []
+        if repository in self.exact:
+            candidates.append(self.exact[repository])
+        candidates.extend(rules for regex, rules in self.patterns
+                          if regex.match(repository))
+
+        for rules in candidates:
+            levels = [rules[p] for p in principals if p in rules]
+            if levels:
+                return ''.join(sorted(set(''.join(levels))))
+        return ''
+
+
+class PermissionIndex(object):
+    """In-memory index of an ini-style permission file
+
+    Sections are repositories or shell-style patterns of repositories,
+    options map users, groups (@name) and all authenticated users (*)
+    to levels like rw. Groups are defined in a [groups] section as
+    comma separated member lists. The file is only parsed again once
+    its inode, size or mtime changed and lookups are cached."""
+
+    def __init__(self, perms_file, check_interval=2, max_cached=65536,
+                 clock=reactor):
+        self.perms_file = perms_file
+        self.max_cached = max_cached
+        self.watched = WatchedFile(perms_file, check_interval, clock)
+        self.reloads = 0
+
+        self._compiled = CompiledPermissions(SafeConfigParser())
+        self._resolved = {}
+        self.reload_if_changed()
+
+    def reload_if_changed(self):
+        if not self.watched.changed():
+            return
+
+        config = SafeConfigParser()
+        try:
+            config.read(self.perms_file)
+            compiled = CompiledPermissions(config)
+        except (ConfigError, re.error):
+            log.err(None, "Loading %s failed, keeping the old permissions"
+                          % self.perms_file)
+            return
+
+        # swap both at once so no lookup sees a mix of old and new
+        self._compiled, self._resolved = compiled, {}
+        self.reloads += 1
+
+    def levels(self, repository, username):
+        """Get the permission levels of a user (None for anonymous)"""
+        self.reload_if_changed()
+
+        if username is None:
+            username = ANONYMOUS
+        key = (repository, username.lower())
+
+        levels = self._resolved.get(key)
+        if levels is None:
+            levels = self._compiled.resolve(*key)
+            if len(self._resolved) >= self.max_cached:
+                self._resolved = {}
+            self._resolved[key] = levels
+        return levels
+
+    def allowed(self, repository, username, level):
+        return level in self.levels(repository, username)
+
+
+class PermissionServiceError(Exception):
+    """A permission service gave no usable answer"""
+
+
+class PermissionService(object):
+    """Asks a remote HTTP service for permissions
+
+    A drop-in for PermissionIndex whose allowed returns a Deferred.
+    It sends GET url?level=...&repository=...&user=... (no user for
+    anonymous) and the service answers 200 with a JSON object like
+    {"allowed": true}. Other answers, connection errors and requests
+    taking longer than timeout seconds fail with PermissionServiceError
+    or the error. Connections to the service are kept open."""
+
+    def __init__(self, url, timeout=10, clock=reactor):
+        self.url = url
+        self.timeout = timeout
+        self.clock = clock
+        self.agent = Agent(reactor, connectTimeout=timeout,
+                           pool=HTTPConnectionPool(reactor))
+        self.requests = 0
+
+    def allowed(self, repository, username, level):
+        query = [('level', level), ('repository', repository)]
+        if username is not None:
+            query.append(('user', username))
+        separator = '&' if '?' in self.url else '?'
+        self.requests += 1
+
+        d = self.agent.request('GET', self.url + separator +
+                               urllib.urlencode(query))
+        d.addCallback(self._received)
+        d.addTimeout(self.timeout, self.clock)
+        return d
+
+    def _received(self, response):
+        d = readBody(response)
+        d.addCallback(self._decide, response.code)
+        return d
+
+    def _decide(self, body, code):
+        if code != 200:
+            raise PermissionServiceError("%s answered %d" % (self.url, code))
+        try:
+            return json.loads(body)['allowed'] is True
+        except (ValueError, TypeError, KeyError):
+            raise PermissionServiceError("%s answered %r" % (self.url,
+                                                             body[:100]))
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+"""Coalescing and caching of asynchronous checks, see CachingAuthnz"""
+
+from collections import OrderedDict
+
+from twisted.internet import reactor, defer
+from twisted.python.failure import Failure
+
+
+class Coalescer(object):
+    """Shares the result of a call among concurrent callers
+
+    While a call returning a Deferred is in flight for a key, calls
+    for the same key wait for its result instead of calling again.
+    Results which are no Deferreds are returned as they are, so
+    synchronous implementations stay synchronous."""
+
+    def __init__(self):
+        self.coalesced = 0
+        self._pending = {}  # key -> Deferreds waiting for the call
+
+    def __len__(self):
+        return len(self._pending)
+
+    def call(self, key, f, *args, **kwargs):
+        waiting = self._pending.get(key)
+        if waiting is not None:
+            self.coalesced += 1
+        else:
+            result = f(*args, **kwargs)
+            if not isinstance(result, defer.Deferred) or result.called:
+                return result
+            waiting = self._pending[key] = []
+            result.addBoth(self._fired, key)
+
+        # cancelling a caller leaves the call to the others
+        d = defer.Deferred(waiting.remove)
+        waiting.append(d)
+        return d
+
+    def _fired(self, result, key):
+        for d in self._pending.pop(key):
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        # failures were passed on to the callers
+
+
+def repository_key(path_info):
+    """Cache key of the repository of a path_info"""
+    return (path_info.get('repository_fs_path'),
+            path_info.get('repository_name'))
+
+
+class CachingAuthnz(object):
+    """Coalesces and optionally caches can_read and can_write
+
+    can_read and can_write of the wrapped authnz may return Deferreds,
+    e.g. when asking a remote permission service. Concurrent checks of
+    the same user, access and repository (see key_func) share a single
+    call. If ttl is set, answers granting access are cached for ttl
+    seconds and denials for negative_ttl seconds, bounded to
+    max_entries. Nothing is cached by default, so revoked permissions
+    apply at once. All other attributes are those of authnz."""
+
+    def __init__(self, authnz, ttl=0, negative_ttl=0, max_entries=10000,
+                 key_func=repository_key, clock=reactor):
+        self.authnz = authnz
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.key_func = key_func
+        self.clock = clock
+
+        self.hits = 0
+        self.misses = 0
+        self.coalescer = Coalescer()
+        self._entries = OrderedDict()  # key -> (expiry, allowed)
+
+    def __getattr__(self, name):
+        return getattr(self.authnz, name)
+
+    def can_read(self, username, path_info):
+        return self._check(self.authnz.can_read, 'r', username, path_info)
+
+    def can_write(self, username, path_info):
+        return self._check(self.authnz.can_write, 'w', username, path_info)
+
+    def invalidate(self):
+        """Drop all cached answers, e.g. after permissions changed"""
+        self._entries.clear()
+
+    def _check(self, check, level, username, path_info):
+        key = (level, username, self.key_func(path_info))
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry[0] > self.clock.seconds():
+            self._entries[key] = entry  # most recently used
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        return self.coalescer.call(key, self._call, check, username,
+                                   path_info, key)
+
+    def _call(self, check, username, path_info, key):
+        allowed = check(username, path_info)
+        if isinstance(allowed, defer.Deferred):
+            return allowed.addCallback(self._store, key)
+        return self._store(allowed, key)
+
+    def _store(self, allowed, key):
+        ttl = self.ttl if allowed else self.negative_ttl
+        if ttl:
+            self._entries[key] = (self.clock.seconds() + ttl, allowed)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return allowed
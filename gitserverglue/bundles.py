@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+"""Clone bundles, see BundleStore"""
+
+import os
+import re
+import hashlib
+import tempfile
+
+from twisted.internet import reactor
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python import log
+
+from gitserverglue.common import protocol_version
+from gitserverglue.refs import ref_state_fingerprint
+
+BUNDLE_NAME = re.compile(r'^[0-9a-f]{40}$')
+
+
+def config_parameters(items):
+    """Format (key, value) pairs for GIT_CONFIG_PARAMETERS"""
+    quote = lambda s: "'%s'" % s.replace("'", "'\\''")
+    return ' '.join('%s=%s' % (quote(key), quote(value))
+                    for key, value in items)
+
+
+def advertise_bundle(git_configuration, path_info, env):
+    """Get the environment env for git-upload-pack extended by the
+    config advertising the bundle of a repository through the
+    bundle-uri command of protocol v2 (git ignores it if too old)"""
+    store = getattr(git_configuration, 'bundle_store', None)
+    if store is None or protocol_version(env) != 2:
+        return env
+
+    url = path_info.get('repository_clone_urls', {}).get('http')
+    name = store.bundle(path_info['repository_fs_path'])
+    if url is None or name is None:
+        return env
+
+    env = dict(env)
+    env['GIT_CONFIG_PARAMETERS'] = config_parameters([
+        ('uploadpack.advertiseBundleURIs', 'true'),
+        ('bundle.version', '1'),
+        ('bundle.mode', 'all'),
+        ('bundle.%s.uri' % name, '%s/bundles/%s.bundle' % (url.rstrip('/'),
+                                                            name)),
+    ])
+    return env
+
+
+class BundleProcess(ProcessProtocol):
+    """Runs git bundle create for BundleStore"""
+
+    def __init__(self, store, repo_path, name, tmpname):
+        self.store = store
+        self.repo_path = repo_path
+        self.name = name
+        self.tmpname = tmpname
+        self.errors = []
+
+    def errReceived(self, data):
+        self.errors.append(data)
+
+    def processEnded(self, reason):
+        self.store._bundleEnded(self, reason.value.exitCode,
+                                ''.join(self.errors))
+
+
+class BundleStore(object):
+    """Keeps a git bundle of each repository for clones to start from
+
+    Bundles are created in the background, one at a time: the first
+    time a bundle of a repository is asked for, after a number of
+    pushes to it and every interval seconds for the repositories which
+    changed since. Clients download the bundle as a static file and
+    only fetch what changed since from git.
+
+    Bundles are named after the ref state they were created for, which
+    lets several worker processes share the directory. The bundle
+    before the latest one is kept for downloads in progress."""
+
+    def __init__(self, directory, git_binary='git', pushes=10,
+                 interval=6 * 3600, clock=reactor):
+        self.directory = directory
+        self.git_binary = git_binary
+        self.pushes = pushes
+        self.interval = interval
+        self.clock = clock
+
+        self.created = 0
+        self.failed = 0
+        self._latest = {}  # repo_path -> name of the latest bundle
+        self._pushes = {}  # repo_path -> pushes since the latest bundle
+        self._failures = {}  # repo_path -> ref state it failed for
+        self._queue = []
+        self._running = None
+        self._call = None
+
+    def start(self):
+        """Start refreshing bundles every interval seconds"""
+        self._call = self.clock.callLater(self.interval, self._refresh)
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def bundle(self, repo_path):
+        """Get the name of the latest bundle of a repository, None if
+        there is none yet (one is created then)"""
+        name = self._latest.get(repo_path)
+        if name is None or self.path(repo_path, name) is None:
+            name = self._find(repo_path)
+            if name is None:
+                self._latest.pop(repo_path, None)
+                self.create(repo_path)
+                return None
+            self._latest[repo_path] = name
+        return name
+
+    def path(self, repo_path, name):
+        """Get the path of a bundle of a repository, None if there is no
+        such bundle"""
+        if not BUNDLE_NAME.match(name):
+            return None
+        fs_path = os.path.join(self.directory, self._repo_id(repo_path),
+                               name + '.bundle')
+        if not os.path.exists(fs_path):
+            return None
+        return fs_path
+
+    def repository_updated(self, repo_path):
+        """Count a push, creating a new bundle once there were enough"""
+        pushes = self._pushes.get(repo_path, 0) + 1
+        self._pushes[repo_path] = pushes
+        if pushes >= self.pushes:
+            self.create(repo_path)
+
+    def create(self, repo_path):
+        """Create a bundle of the current state of a repository"""
+        if repo_path in self._queue or (self._running is not None and
+                                        self._running.repo_path == repo_path):
+            return
+        self._queue.append(repo_path)
+        if self._running is None:
+            self._next()
+
+    def _repo_id(self, repo_path):
+        return hashlib.sha1(os.path.abspath(repo_path)).hexdigest()
+
+    def _repo_dir(self, repo_path):
+        repo_dir = os.path.join(self.directory, self._repo_id(repo_path))
+        if not os.path.isdir(repo_dir):
+            os.makedirs(repo_dir)
+        return repo_dir
+
+    def _bundles(self, repo_path):
+        """Get the names of the bundles of a repository, newest first"""
+        repo_dir = os.path.join(self.directory, self._repo_id(repo_path))
+        try:
+            names = [n[:-len('.bundle')] for n in os.listdir(repo_dir)
+                     if n.endswith('.bundle')]
+        except OSError:
+            return []
+        paths = dict((n, os.path.join(repo_dir, n + '.bundle'))
+                     for n in names if BUNDLE_NAME.match(n))
+        mtimes = {}
+        for name, fs_path in paths.items():
+            try:
+                mtimes[name] = os.stat(fs_path).st_mtime
+            except OSError:
+                pass  # removed meanwhile
+        return sorted(mtimes, key=mtimes.get, reverse=True)
+
+    def _find(self, repo_path):
+        bundles = self._bundles(repo_path)
+        if not bundles:
+            return None
+        return bundles[0]
+
+    def _refresh(self):
+        self._call = self.clock.callLater(self.interval, self._refresh)
+        for repo_path in list(self._latest):
+            self.create(repo_path)  # unless the refs are unchanged
+
+    def _next(self):
+        while self._queue:
+            repo_path = self._queue.pop(0)
+            if not os.path.isdir(repo_path):
+                continue
+
+            name = ref_state_fingerprint(repo_path)
+            if self.path(repo_path, name) is not None:
+                # unchanged or another worker created it already
+                self._created(repo_path, name)
+                continue
+            if self._failures.get(repo_path) == name:
+                continue  # e.g. empty, retried once the refs change
+
+            fd, tmpname = tempfile.mkstemp(prefix='.tmp-', suffix='.bundle',
+                                           dir=self._repo_dir(repo_path))
+            os.close(fd)
+            os.unlink(tmpname)  # git refuses to overwrite it
+
+            self._running = BundleProcess(self, repo_path, name, tmpname)
+            args = [os.path.basename(self.git_binary), 'bundle', 'create',
+                    '-q', tmpname, '--all']
+            log.msg("Creating bundle %s of %s" % (name, repo_path))
+            try:
+                reactor.spawnProcess(self._running, self.git_binary, args,
+                                     {}, path=repo_path)
+            except:
+                log.err(None, "Failed to create a bundle of " + repo_path)
+                self.failed += 1
+                self._running = None
+                continue
+            return
+
+    def _bundleEnded(self, process, exit_code, errors):
+        self._running = None
+        if exit_code == 0:
+            os.rename(process.tmpname,
+                      os.path.join(self._repo_dir(process.repo_path),
+                                   process.name + '.bundle'))
+            self.created += 1
+            self._created(process.repo_path, process.name)
+        else:
+            if os.path.exists(process.tmpname):
+                os.unlink(process.tmpname)
+            self._failures[process.repo_path] = process.name
+            log.msg("Creating a bundle of %s failed: %s" % (
+                        process.repo_path, errors.strip()))
+            self.failed += 1
+        self._next()
+
+    def _created(self, repo_path, name):
+        self._latest[repo_path] = name
+        self._pushes[repo_path] = 0
+        self._failures.pop(repo_path, None)
+
+        # keep the previous one for downloads in progress
+        repo_dir = os.path.join(self.directory, self._repo_id(repo_path))
+        bundles = [n for n in self._bundles(repo_path) if n != name]
+        for old in bundles[1:]:
+            try:
+                os.unlink(os.path.join(repo_dir, old + '.bundle'))
+            except OSError:
+                pass
@@ -17,21 +17,132 @@
 # You should have received a copy of the GNU General Public License
 # along with GitServerGlue.  If not, see http://www.gnu.org/licenses
 
+import os
+import re
+
 from twisted.cred import checkers, credentials, error
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from twisted.internet.error import ProcessTerminated
 from twisted.internet.interfaces import IProcessTransport
+from twisted.internet.protocol import ProcessProtocol
 from twisted.python.failure import Failure
 from zope.interface import implements
 
+from gitserverglue import pktline
+
+
+# kept for compatibility, see gitserverglue.pktline
+git_packet = pktline.encode
+
+# a parameter of GIT_PROTOCOL, e.g. version=2
+PROTOCOL_PARAMETER = re.compile(r'^[\w.-]+(=[\w.-]*)?\Z')
+
+
+def protocol_env(value):
+    """Get the environment passing the colon separated protocol
+    parameters a client sent (e.g. version=2) on to git
+
+    The parameters come from the extra parameters of a git:// request,
+    the Git-Protocol header or the GIT_PROTOCOL variable of an SSH
+    session. Malformed ones are dropped."""
+    parameters = [p for p in (value or '').split(':')
+                  if PROTOCOL_PARAMETER.match(p)]
+    if not parameters:
+        return {}
+    return {'GIT_PROTOCOL': ':'.join(parameters)}
+
+
+def protocol_version(env):
+    """Get the protocol version a protocol_env asks for, 0 by default"""
+    version = 0
+    for parameter in env.get('GIT_PROTOCOL', '').split(':'):
+        if parameter.startswith('version='):
+            try:
+                version = max(version, int(parameter[len('version='):]))
+            except ValueError:
+                pass
+    return version
+
+
+def repository_updated(git_configuration, repository_fs_path):
+    """Notify caches of git_configuration that a push to a repository
+    completed"""
+    invalidate_caches(git_configuration, repository_fs_path)
+    # counted once, by the worker process which received the push
+    bundle_store = getattr(git_configuration, 'bundle_store', None)
+    if bundle_store is not None:
+        bundle_store.repository_updated(repository_fs_path)
+    maintenance = getattr(git_configuration, 'maintenance_scheduler', None)
+    if maintenance is not None:
+        maintenance.repository_updated(repository_fs_path)
+    worker = getattr(git_configuration, 'worker', None)
+    if worker is not None:
+        # the caches of the other worker processes
+        worker.repository_updated(repository_fs_path)
+
+
+def invalidate_caches(git_configuration, repository_fs_path):
+    """Drop what the caches of git_configuration hold for a repository"""
+    pack_cache = getattr(git_configuration, 'pack_cache', None)
+    if pack_cache is not None:
+        pack_cache.invalidate(repository_fs_path)
+
+
+class WatchedFile(object):
+    """Tells if a file changed, checking at most every check_interval
 
-def git_packet(data=None):
-    """Format data as a git pktline
+    A file counts as changed when its inode, size or mtime differ from
+    the last check. A missing file is treated like an empty one."""
 
-    If data is None, a flush packet will be returned"""
-    if data is None:
-        return '0000'
-    return str(hex(len(data) + 4)[2:].rjust(4, '0')) + data
+    def __init__(self, fs_path, check_interval=2, clock=reactor):
+        self.fs_path = fs_path
+        self.check_interval = check_interval
+        self.clock = clock
+        self.signature = None
+        self.next_check = None
+
+    def changed(self):
+        now = self.clock.seconds()
+        if self.next_check is not None and now < self.next_check:
+            return False
+        self.next_check = now + self.check_interval
+
+        try:
+            st = os.stat(self.fs_path)
+            signature = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        except OSError:
+            signature = ()
+
+        if signature == self.signature:
+            return False
+        self.signature = signature
+        return True
+
+
+class ProcessProtocolProxy(ProcessProtocol):
+    """Forwards all process events to another process protocol
+
+    Subclasses can override single events to observe or modify
+    them without the wrapped protocol noticing."""
+
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+
+    def makeConnection(self, transport):
+        self.transport = transport
+        self.wrapped.makeConnection(transport)
+
+    def childDataReceived(self, childFD, data):
+        self.wrapped.childDataReceived(childFD, data)
+
+    def childConnectionLost(self, childFD):
+        self.wrapped.childConnectionLost(childFD)
+
+    def processExited(self, reason):
+        self.wrapped.processExited(reason)
+
+    def processEnded(self, reason):
+        self.wrapped.processEnded(reason)
 
 
 class ErrorProcess(object):
@@ -39,13 +150,24 @@ class ErrorProcess(object):
 
     Implements an IProcessTransport that simulates process
     termination with the given return code and writing
-    a message to stderr. Properly closes child FDs.
+    a message to stderr (if not None). Properly closes child FDs.
     """
     implements(IProcessTransport)
 
     def __init__(self, proto, code, message):
+        # ignore all unused methods, the protocol may already call
+        # them while the termination is simulated
+        noop = lambda *args, **kwargs: None
+        self.closeStdin = noop
+        self.closeStdout = noop
+        self.closeStderr = noop
+        self.writeToChild = noop
+        self.loseConnection = noop
+        self.signalProcess = noop
+
         proto.makeConnection(self)
-        proto.childDataReceived(2, message + '\n')
+        if message is not None:
+            proto.childDataReceived(2, message + '\n')
 
         proto.childConnectionLost(0)
         proto.childConnectionLost(1)
@@ -56,14 +178,60 @@ class ErrorProcess(object):
         proto.processExited(failure)
         proto.processEnded(failure)
 
-        # ignore all unused methods
-        noop = lambda *args, **kwargs: None
-        self.closeStdin = noop
-        self.closeStdout = noop
-        self.closeStderr = noop
-        self.writeToChild = noop
-        self.loseConnection = noop
-        self.signalProcess = noop
+
+class PendingProcess(object):
+    """Stands in for a process transport until the process is spawned
+
+    Input is buffered and replayed on the real process transport
+    once attach is called. If the connection is lost before, the
+    cancelled callback is called instead."""
+    implements(IProcessTransport)
+
+    pid = None
+    stdinClosed = False
+    lost = False
+
+    def __init__(self, cancelled=None):
+        self.cancelled = cancelled
+        self.buffer = []
+
+    def attach(self, transport):
+        if self.buffer:
+            transport.write(''.join(self.buffer))
+            self.buffer = []
+        if self.stdinClosed:
+            transport.closeStdin()
+
+    def write(self, data):
+        self.buffer.append(data)
+
+    def writeSequence(self, seq):
+        self.buffer.extend(seq)
+
+    def closeStdin(self):
+        self.stdinClosed = True
+
+    def loseConnection(self):
+        if not self.lost:
+            self.lost = True
+            if self.cancelled is not None:
+                self.cancelled()
+
+    def signalProcess(self, signalID):
+        self.loseConnection()
+
+    def closeStdout(self):
+        pass
+
+    def closeStderr(self):
+        pass
+
+    def closeChildFD(self, descriptor):
+        pass
+
+    def writeToChild(self, childFD, data):
+        if childFD == 0:
+            self.write(data)
 
 
 class PasswordChecker:
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+import zlib
+import tempfile
+
+from zope.interface import implements
+from twisted.internet.interfaces import IConsumer
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# decompressed size of request bodies, git compresses requests of up
+# to http.postBuffer (1 MiB by default), mostly have lines
+MAX_DECODED_SIZE = 64 * 1024 ** 2
+
+# request bodies are spooled to disk beyond this size, like twisted does
+SPOOL_SIZE = 100000
+
+DECODED_ENCODINGS = ('gzip', 'x-gzip', 'deflate')
+
+
+class BodyTooLarge(Exception):
+    """A request body decompressed to more than allowed"""
+
+
+class Decoder(object):
+    """Decompresses a gzip or deflate encoded request body as it arrives
+
+    The data is passed to write at most chunk_size bytes at a time, so
+    a small input never expands to a huge string. BodyTooLarge is
+    raised once more than max_size bytes came out, zlib.error if the
+    data is corrupt or, by finish, if it ends early."""
+
+    chunk_size = 2 ** 16
+
+    def __init__(self, write, max_size=MAX_DECODED_SIZE):
+        self._write = write
+        self.max_size = max_size
+        self.size = 0
+        # detects the gzip or zlib header
+        self._decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+
+    def write(self, data):
+        while True:
+            out = self._decompressor.decompress(data, self.chunk_size)
+            data = self._decompressor.unconsumed_tail
+            if out:
+                self.size += len(out)
+                if self.size > self.max_size:
+                    raise BodyTooLarge("Request body larger than %d bytes "
+                                       "once decompressed" % self.max_size)
+                self._write(out)
+            if not data and len(out) < self.chunk_size:
+                return
+
+    def finish(self):
+        """Check that the whole body was received"""
+        if not _stream_ended(self._decompressor):
+            raise zlib.error("Truncated compressed data")
+
+
+def _stream_ended(decompressor):
+    # zlib of python 2 has no eof attribute. Once the stream ended, any
+    # further input is left in unused_data, an incomplete stream cannot
+    # take two different bytes as its last one.
+    for probe in ('\0', '\1'):
+        copy = decompressor.copy()
+        try:
+            copy.decompress(probe)
+        except zlib.error:
+            return False
+        if copy.unused_data != probe:
+            return False
+    return True
+
+
+def content_decoder(headers, write, max_size=MAX_DECODED_SIZE):
+    """Get a Decoder for a request body with headers (a twisted Headers)
+    or None if it is not encoded in a way it can be decoded"""
+    encoding = headers.getRawHeaders('content-encoding')
+    if encoding is None or encoding[-1].strip().lower() not in \
+            DECODED_ENCODINGS:
+        return None
+    return Decoder(write, max_size)
+
+
+def decoded(headers, size):
+    """Mark a request body as decoded to size bytes"""
+    headers.removeHeader('content-encoding')
+    headers.setRawHeaders('content-length', [str(size)])
+
+
+def decode_content(request, max_size=MAX_DECODED_SIZE):
+    """Decode the body of a buffered twisted.web request in place
+
+    Raises BodyTooLarge or zlib.error, see Decoder."""
+    content = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+    decoder = content_decoder(request.requestHeaders, content.write,
+                              max_size)
+    if decoder is None:
+        return
+
+    request.content.seek(0)
+    while True:
+        data = request.content.read(Decoder.chunk_size)
+        if not data:
+            break
+        decoder.write(data)
+    decoder.finish()
+
+    content.seek(0)
+    request.content = content
+    decoded(request.requestHeaders, decoder.size)
+
+
+def add_vary(request, header):
+    """Add header to the Vary header of the response to request"""
+    headers = request.responseHeaders
+    vary = headers.getRawHeaders('vary', [])
+    if header not in vary:
+        headers.setRawHeaders('vary', vary + [header])
+
+
+def accepted_encodings(header):
+    """Parse an Accept-Encoding header into a dict of encodings and their
+    q-values"""
+    accepted = {}
+    for part in header.split(','):
+        params = part.split(';')
+        name = params[0].strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            key, unused_sep, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name == 'x-gzip':
+            name = 'gzip'
+        accepted[name] = q
+    return accepted
+
+
+class ResponseCompression(object):
+    """Compresses responses for clients accepting gzip or zstd
+
+    zstd is only offered if the zstandard module is available. The
+    compression level depends on the size of a response, responses
+    larger than large_size or of unknown size use a fast level to
+    spare CPU time.
+
+    Ref advertisements of info/refs are always compressed. Responses
+    of git-upload-pack are only compressed with upload_pack set, they
+    mostly consist of packs which are compressed already."""
+
+    large_size = 1024 ** 2
+    # (level for small responses, for large ones)
+    levels = {'gzip': (6, 1), 'zstd': (3, 1)}
+
+    def __init__(self, encodings=('zstd', 'gzip'), upload_pack=False):
+        self.encodings = [e for e in encodings
+                          if e != 'zstd' or zstandard is not None]
+        self.upload_pack = upload_pack
+
+    def negotiate(self, request):
+        """Get the encoding to use for request, or None"""
+        header = request.getHeader('accept-encoding')
+        if not header:
+            return None
+
+        accepted = accepted_encodings(header)
+        best = None
+        best_q = 0
+        for encoding in self.encodings:
+            q = accepted.get(encoding, accepted.get('*', 0))
+            if q > best_q:
+                best, best_q = encoding, q
+        return best
+
+    def compressor(self, encoding, size=None):
+        """Get an object with compress and flush methods like
+        zlib.compressobj for encoding and a response of size bytes"""
+        small, large = self.levels[encoding]
+        level = small
+        if size is None or size > self.large_size:
+            level = large
+
+        if encoding == 'zstd':
+            return zstandard.ZstdCompressor(level=level).compressobj()
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, encoding, data):
+        compressor = self.compressor(encoding, len(data))
+        return compressor.compress(data) + compressor.flush()
+
+    def wrap(self, request, consumer, encoding=None):
+        """Get a consumer compressing what is written to it for consumer,
+        which is returned itself if request accepts no encoding
+
+        The headers of request are set accordingly."""
+        add_vary(request, 'Accept-Encoding')
+        if encoding is None:
+            encoding = self.negotiate(request)
+        if encoding is None:
+            return consumer
+
+        request.setHeader('Content-Encoding', encoding)
+        request.responseHeaders.removeHeader('content-length')
+        return CompressingConsumer(consumer, self.compressor(encoding))
+
+
+class CompressingConsumer(object):
+    """Compresses what is written to it for a consumer, which is a
+    twisted.web request or takes its place
+
+    finish writes the rest of the compressed data and finishes
+    consumer."""
+    implements(IConsumer)
+
+    def __init__(self, consumer, compressor):
+        self.consumer = consumer
+        self.compressor = compressor
+
+    def registerProducer(self, producer, streaming):
+        self.consumer.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self.consumer.unregisterProducer()
+
+    def write(self, data):
+        data = self.compressor.compress(data)
+        if data:
+            self.consumer.write(data)
+
+    def writeSequence(self, seq):
+        self.write(''.join(seq))
+
+    def finish(self):
+        data = self.compressor.flush()
+        if data:
+            self.consumer.write(data)
+        self.consumer.finish()
@@ -20,14 +20,33 @@
 from zope.interface import implements
 from twisted.python import log
 
-from twisted.internet import reactor
+from twisted.internet import reactor, defer
 from twisted.internet.protocol import Protocol, ProcessProtocol, Factory
-from twisted.internet.interfaces import IPushProducer
-
-from gitserverglue.common import git_packet
+from twisted.internet.interfaces import IPushProducer, IHalfCloseableProtocol
+from twisted.protocols.basic import FileSender
+
+from gitserverglue.bundles import advertise_bundle
+from gitserverglue.common import protocol_env, protocol_version
+from gitserverglue.common import repository_updated
+from gitserverglue.metrics import track_request, untracked
+from gitserverglue.mirror import MirrorUnavailable
+from gitserverglue.pktline import PacketDecoder, PacketError, FLUSH, encode
+from gitserverglue.proxy import BackendConnection
+from gitserverglue.refs import ref_state_fingerprint, AdvertisementSkipper
+from gitserverglue.refs import ADVERTISED_UPLOAD_PACK_ENV
+from gitserverglue.scheduler import ServerBusy, PRIORITY_FETCH, PRIORITY_PUSH
+from gitserverglue.timeouts import connection_timer, untimed
+from gitserverglue.tracing import start_span
 
 
 class GitProcessProtocol(ProcessProtocol):
+    detached = False
+    cacheWriter = None
+    slot = None
+    skipper = None
+    initialInput = ''
+    waiting = True
+
     def __init__(self, gitprotocol):
         self.gitprotocol = gitprotocol
 
@@ -39,104 +58,521 @@ class GitProcessProtocol(ProcessProtocol):
             setattr(self.transport, "stopProducing",
                     lambda: self.transport.loseConnection())
 
+        self.gitprotocol.span.mark('spawn')
+        self.gitprotocol.timer.add_process(self.transport)
         self.transport.registerProducer(self.gitprotocol, True)
-        self.gitprotocol.transport.registerProducer(self.transport, True)
+        self.gitprotocol.output.registerProducer(self.transport, True)
+
+        if self.initialInput:
+            self.transport.write(self.initialInput)
+            self.initialInput = ''
 
         self.gitprotocol.resumeProducing()
+        if self.gitprotocol.inputClosed:
+            self.transport.closeStdin()
 
     def outReceived(self, data):
-        self.gitprotocol.transport.write(data)
+        if self.detached:
+            return
+        if self.skipper is not None:
+            data = self.skipper.feed(data)
+            if not data:
+                return
+        if self.cacheWriter is not None:
+            self.cacheWriter.write(data)
+        if self.waiting:
+            self.waiting = False
+            self.gitprotocol.span.mark('first_byte')
+            self.gitprotocol.tracker.first_byte()
+        self.gitprotocol.output.write(data)
 
     def errReceived(self, data):
-        self.gitprotocol.transport.write(data)
+        if self.detached:
+            return
+        self.gitprotocol.output.write(data)
 
     def processEnded(self, status):
         log.msg("Git ended with %r" % status)
-        self.gitprotocol.transport.unregisterProducer()
-        self.gitprotocol.transport.loseConnection()
+        self.gitprotocol.tracker.process_ended(status)
+        self.gitprotocol.timer.remove_process(self.transport)
+        if self.slot is not None:
+            self.slot.release()
+        if self.cacheWriter is not None:
+            if status.value.exitCode == 0:
+                self.cacheWriter.commit()
+            else:
+                self.cacheWriter.abort()
+        if self.gitprotocol.rpc == 'receive-pack' and \
+                status.value.exitCode == 0:
+            repository_updated(self.gitprotocol.git_configuration,
+                               self.gitprotocol.path_info[
+                                    'repository_fs_path'])
+        if self.detached:
+            return
+        self.gitprotocol.span.mark('stream')
+        self.gitprotocol.span.set('exit_code', status.value.exitCode)
+        self.gitprotocol.output.unregisterProducer()
+        self.gitprotocol.output.loseConnection()
+
+    def detach(self):
+        """Stop relaying between git and the client and let git exit"""
+        self.detached = True
+        self.transport.unregisterProducer()
+        self.gitprotocol.output.unregisterProducer()
+        self.transport.closeStdin()
 
 
 class GitProtocol(Protocol):
-    implements(IPushProducer)
+    implements(IPushProducer, IHalfCloseableProtocol)
 
-    __buffer = ''
     paused = False
     requestReceived = False
+    advertised = False
+    replaying = False
+    slotRequest = None
+    authorization = None  # waiting for path_lookup or authnz
+    refresh = None  # waiting for the MirrorManager
+    process = None
+    output = None  # the transport, possibly limited by a BandwidthShaper
+    protocol = {}  # environment passing the protocol version on to git
+    rpc = 'upload-pack'
+    username = None  # as authenticated by a trusted proxy
+    backend = None  # the BackendConnection of a proxied request
+    inputClosed = False
+    idle = True  # nothing received yet
+
+    # packets of a possibly cacheable request, see negotiationReceived
+    negotiation = None
+    negotiationSize = 0
+    maxNegotiationSize = 1024 ** 2
+    cacheWriter = None
+    initialInput = ''
+    tracker = untracked
+    timer = untimed
 
     def __init__(self, authnz, git_configuration):
         self.authnz = authnz
         self.git_configuration = git_configuration
+        self.decoder = PacketDecoder()
+        self.span = start_span(git_configuration, 'git')
 
-    def dataReceived(self, data):
-        self.__buffer = self.__buffer + data
+    def connectionMade(self):
+        self.output = self.transport
+        self.timer = connection_timer(self.transport)
 
-        while not self.paused and len(self.__buffer) >= 4:
+    def dataReceived(self, data):
+        self.idle = False
+        if self.backend is not None:
+            return self.backend.transport.write(data)
+        if self.rpc == 'receive-pack' and self.process is not None:
+            # the pack following the commands is no pkt-line
+            data = self.decoder.remaining() + data
+            if data:
+                self.process.transport.write(data)
+            return
+        self.decoder.feed(data)
+
+        while not self.paused:
             try:
-                pktlen = int(self.__buffer[:4], 16)
-            except ValueError:
-                return self.sendErrorAndDisconnect(
-                    "ERR Invalid Paket Length: " + self.__buffer[:4])
-
-            if pktlen == 0:  # flush packet 0000
-                pktlen = 4
+                packet = self.decoder.next_packet()
+            except PacketError as e:
+                return self.sendErrorAndDisconnect("ERR " + str(e))
 
-            # The git protocol specifies bounds for the packet length
-            if pktlen < 4 or pktlen > 65524:
-                return self.sendErrorAndDisconnect(
-                    "ERR Invalid Paket Length: " + self.__buffer[:4])
-
-            # Do we have the complete packet in the buffer?
-            if pktlen > len(self.__buffer):
+            if packet is None:
                 return
-
-            packet = self.__buffer[:pktlen]
-            self.__buffer = self.__buffer[pktlen:]
             self.packetReceived(packet)
 
     def packetReceived(self, data):
         if not self.requestReceived:
             payload = data[4:]
+            self.span.mark('request')
 
             # git:// would also support other RPC methods, but since
             # there is no authentication, only allow cloning aka
-            # git-upload-pack
-            if not payload.startswith("git-upload-pack"):
+            # git-upload-pack, unless a proxy authenticated the user
+            rpc, unused_sep, params = payload.partition(" ")
+            if rpc not in ("git-upload-pack", "git-receive-pack"):
                 return self.sendErrorAndDisconnect(
                     "ERR Request not supported. "
                     "Only git-upload-pack will be accepted")
 
-            try:
-                rpc_params = payload[len("git-upload-pack "):].split("\0")
-                path, unused_host, unused_eol = rpc_params
-            except ValueError:
+            # path\0host=...\0, optionally followed by \0 and extra
+            # parameters like version=2 each terminated by \0
+            rpc_params = params.split("\0")
+            if len(rpc_params) < 2 or rpc_params[-1]:
                 return self.sendErrorAndDisconnect(
                     "ERR Unable to parse request line")
-
-            path_info = self.git_configuration.path_lookup(path,
-                                                           protocol_hint='git')
-            if path_info is None or path_info['repository_fs_path'] is None:
-                return self.sendErrorAndDisconnect("ERR Repository not found")
-
-            if not self.authnz.can_read(None, path_info):
+            path = rpc_params[0]
+            extra = rpc_params[1:-1]
+            if extra and extra[0].startswith('host='):
+                extra = extra[1:]
+            if self._fromTrustedProxy():
+                # the user the proxy authenticated, see BackendConnection
+                for p in extra:
+                    if p.startswith('user='):
+                        self.username = p[len('user='):]
+            extra = [p for p in extra if p and not p.startswith('user=')]
+
+            if rpc == "git-receive-pack" and self.username is None:
                 return self.sendErrorAndDisconnect(
-                    "ERR Repository does not allow anonymous read access")
+                    "ERR Request not supported. "
+                    "Only git-upload-pack will be accepted")
+            self.rpc = rpc[len("git-"):]
+            self.protocol = protocol_env(':'.join(extra))
 
-            # wait with data until we have a connection to the process
-            self.pauseProducing()
             self.requestReceived = True
-            self.process = GitProcessProtocol(self)
-
-            gitbinary = self.git_configuration.git_binary
-            cmdargs = ['git', 'upload-pack', path_info['repository_fs_path']]
-            log.msg("Spawning %s with args %r" % (gitbinary, cmdargs))
-            reactor.spawnProcess(self.process, gitbinary, cmdargs)
+            # both may be asynchronous, e.g. asking a permission service
+            d = self.authorization = defer.maybeDeferred(
+                    self.git_configuration.path_lookup, path,
+                    protocol_hint='git')
+            d.addCallback(self._lookedUp)
+            d.addCallback(self._authorized, path)
+            d.addErrback(self._authorizationFailed)
+            if self.authorization is not None:
+                self.pauseProducing()  # until authorized
+
+        elif self.replaying:
+            pass  # nothing is expected from the client anymore
+
+        elif self.negotiation is not None:
+            self.negotiationReceived(data)
 
         else:
             self.process.transport.write(data)
 
+    def _lookedUp(self, path_info):
+        """Check the access to a looked up repository, giving
+        (path_info, allowed), or None if the request was rejected"""
+        self.span.mark('lookup')
+        if path_info is None or (
+                path_info['repository_fs_path'] is None and
+                path_info.get('repository_backend') is None):
+            return self.sendErrorAndDisconnect("ERR Repository not found")
+
+        if self.rpc == 'receive-pack' and \
+                path_info.get('repository_upstream') is not None:
+            return self.sendErrorAndDisconnect("ERR Mirrors are read only")
+        if self.rpc == 'receive-pack':
+            check = self.authnz.can_write
+        else:
+            check = self.authnz.can_read
+        d = defer.maybeDeferred(check, self.username, path_info)
+        return d.addCallback(lambda allowed: (path_info, allowed))
+
+    def _authorized(self, result, path):
+        self.authorization = None
+        if result is None or not self.transport.connected:
+            return
+        path_info, allowed = result
+        self.span.mark('authorize')
+        if not allowed and self.username is None:
+            return self.sendErrorAndDisconnect(
+                "ERR Repository does not allow anonymous read access")
+        if not allowed:
+            return self.sendErrorAndDisconnect(
+                "ERR You don't have %s access" % (
+                    'write' if self.rpc == 'receive-pack' else 'read'))
+
+        self.timer.request_started()
+        self.path_info = path_info
+        self.tracker = track_request(self.git_configuration, 'git',
+                                     self.rpc)
+        repository = path_info['repository_fs_path']
+        self.span.set('rpc', self.rpc)
+        self.span.set('repository', repository)
+
+        shaper = getattr(self.git_configuration, 'bandwidth_shaper', None)
+        if shaper is not None:
+            self.output = shaper.shape(
+                self.transport, self.username,
+                self.transport.getPeer().host, repository)
+
+        if path_info.get('repository_backend') is not None:
+            return self.proxyRequest(path)
+
+        mirrors = getattr(self.git_configuration, 'mirror_manager', None)
+        upstream = path_info.get('repository_upstream')
+        if mirrors is not None and upstream is not None:
+            self.pauseProducing()  # until the mirror is fresh
+            self.refresh = mirrors.refresh(repository, upstream)
+            self.refresh.addCallbacks(self._mirrorRefreshed,
+                                      self._mirrorFailed)
+            return
+
+        self.startRequest()
+        if self.advertised and self.paused:
+            self.resumeProducing()  # paused while authorizing
+
+    def _authorizationFailed(self, failure):
+        self.authorization = None
+        if failure.check(defer.CancelledError):
+            return
+        log.err(failure, "Authorizing %s failed" % self.rpc)
+        self.sendErrorAndDisconnect("ERR Authorization failed")
+
+    def startRequest(self):
+        """Advertise the refs or start git for an authorized request"""
+        repository = self.path_info['repository_fs_path']
+        if self.rpc == 'receive-pack':
+            return self.startGit()  # nothing to cache or advertise
+
+        self.pack_cache = getattr(self.git_configuration, 'pack_cache',
+                                  None)
+        advertiser = getattr(self.git_configuration, 'ref_advertiser',
+                             None)
+        version = protocol_version(self.protocol)
+        if version == 2:
+            # the client sends commands, git answers them all
+            self.pack_cache = None
+        if version != 0:
+            advertiser = None  # only knows the v0 advertisement
+        if self.pack_cache is not None or advertiser is not None:
+            self.fingerprint = ref_state_fingerprint(repository)
+        if advertiser is not None:
+            advertisement = advertiser.advertise(repository,
+                                                 self.fingerprint)
+            if advertisement is not None:
+                # git is only needed once the client wants objects
+                self.advertised = True
+                self.tracker.first_byte()
+                self.output.write(advertisement)
+                self.span.mark('advertise')
+        if self.pack_cache is not None or self.advertised:
+            self.negotiation = []
+
+        if not self.advertised:
+            self.startGit()
+
+    def startGit(self):
+        # wait with data until we have a connection to the process
+        self.pauseProducing()
+
+        scheduler = getattr(self.git_configuration, 'process_scheduler',
+                            None)
+        if scheduler is None:
+            self.spawnGit()
+        else:
+            priority = PRIORITY_FETCH
+            if self.rpc == 'receive-pack':
+                priority = PRIORITY_PUSH
+            self.slotRequest = scheduler.acquire(
+                            self.path_info['repository_fs_path'],
+                            self.username, priority)
+            self.slotRequest.addCallbacks(self.spawnGit,
+                                          self._slotFailed)
+
+    def spawnGit(self, slot=None):
+        if self.slotRequest is not None:
+            self.span.mark('queue')
+        self.slotRequest = None
+        self.process = GitProcessProtocol(self)
+        self.process.slot = slot
+        self.process.cacheWriter = self.cacheWriter
+        self.process.initialInput = self.initialInput
+
+        gitbinary = self.git_configuration.git_binary
+        cmdargs = ['git', self.rpc, self.path_info['repository_fs_path']]
+        env = self.protocol
+        if self.rpc == 'upload-pack':
+            env = advertise_bundle(self.git_configuration, self.path_info,
+                                   env)
+        if self.advertised:
+            # the client already got the advertisement upload-pack sends
+            self.process.skipper = AdvertisementSkipper()
+            env = dict(env, **ADVERTISED_UPLOAD_PACK_ENV)
+        log.msg("Spawning %s with args %r" % (gitbinary, cmdargs))
+        self.tracker.process_started()
+        try:
+            reactor.spawnProcess(self.process, gitbinary, cmdargs, env)
+        except:
+            if slot is not None:
+                slot.release()
+            raise
+
+    def _mirrorRefreshed(self, ignored):
+        self.refresh = None
+        self.span.mark('refresh')
+        if not self.transport.connected:
+            return
+        self.startRequest()
+        if self.advertised:
+            self.resumeProducing()  # otherwise once git is running
+
+    def _mirrorFailed(self, failure):
+        self.refresh = None
+        if failure.check(defer.CancelledError):
+            return
+        failure.trap(MirrorUnavailable)
+        log.msg("Rejecting %s: %s" % (self.rpc, failure.getErrorMessage()))
+        self.sendErrorAndDisconnect("ERR Upstream repository unavailable")
+
+    def _slotFailed(self, failure):
+        self.slotRequest = None
+        if failure.check(defer.CancelledError):
+            return
+        failure.trap(ServerBusy)
+        log.msg("Rejecting %s: %s" % (self.rpc, failure.value.message))
+        self.sendErrorAndDisconnect("ERR " + failure.value.message)
+
+    def connectionLost(self, reason):
+        if self.authorization is not None:
+            self.authorization.cancel()
+        if self.slotRequest is not None:
+            self.slotRequest.cancel()
+        if self.refresh is not None:
+            self.refresh.cancel()
+        if self.backend is not None:
+            self.backend.transport.loseConnection()
+        if self.idle:
+            return  # e.g. the health check of a BackendPool
+        self.span.mark('drain')
+        self.span.end()
+
+    def negotiationReceived(self, data):
+        """Collect the client request until it is known if it is cacheable
+
+        Clients without any objects send their wants, a flush and done
+        without waiting for a response. Once done is seen, the response
+        is served from the pack cache or git's response will be stored
+        in it. As soon as a have is seen, the request is not cacheable
+        and everything is handed to git. If the refs were advertised
+        without git, git is only spawned at that point."""
+        self.negotiation.append(data)
+        self.negotiationSize += len(data)
+        payload = data[4:].rstrip('\n')
+
+        if data == FLUSH and len(self.negotiation) == 1:
+            if self.advertised:
+                # the client only wanted to list the refs
+                self.replaying = True
+                self.output.loseConnection()
+                return
+            return self._forwardNegotiation()
+
+        if payload.startswith('have '):
+            return self._forwardNegotiation()
+
+        if self.negotiationSize > self.maxNegotiationSize:
+            return self._forwardNegotiation()
+
+        if data == FLUSH and (self.pack_cache is None or
+                               self._waitsForShallowInfo()):
+            return self._forwardNegotiation()
+
+        if payload != 'done':
+            return
+
+        request = ''.join(self.negotiation)
+        key = self.pack_cache.make_key(self.path_info['repository_fs_path'],
+                                       'git', self.fingerprint, request)
+        if key is None:
+            return self._forwardNegotiation()
+
+        f = self.pack_cache.open(key)
+        if f is None:
+            self.cacheWriter = self.pack_cache.writer(
+                            key, self.path_info['repository_fs_path'])
+            return self._forwardNegotiation()
+
+        log.msg("Sending cached response %s" % key)
+        self.span.mark('negotiate')
+        self.span.set('cached', True)
+        self.tracker.first_byte()
+        self.negotiation = None
+        self.replaying = True
+        if self.process is not None:
+            self.process.detach()
+
+        def finished(ignored):
+            f.close()
+            self.span.mark('stream')
+            self.output.loseConnection()
+        d = FileSender().beginFileTransfer(f, self.output)
+        d.addBoth(finished)
+
+    def _waitsForShallowInfo(self):
+        # shallow clients wait for the shallow-update after their wants
+        for packet in self.negotiation:
+            if packet[4:].startswith(('shallow ', 'deepen')):
+                return True
+        return False
+
+    def _forwardNegotiation(self):
+        packets, self.negotiation = self.negotiation, None
+        self.span.mark('negotiate')
+        if self.process is None:
+            self.initialInput = ''.join(packets)
+            self.startGit()
+        else:
+            self.process.cacheWriter = self.cacheWriter
+            self.process.transport.write(''.join(packets))
+
+    def proxyRequest(self, path):
+        """Pass the request on to a node of the BackendPool the path
+        lookup returned"""
+        self.pauseProducing()  # until connected
+        self.replaying = True  # packets are passed on as they are
+        pool = self.path_info['repository_backend']
+        connection = BackendConnection('git-' + self.rpc, path,
+                                       self.protocol, self.username)
+        connection.client = self
+        d = pool.connect(connection, write=self.rpc == 'receive-pack')
+        d.addCallbacks(self._backendConnected, self._backendFailed,
+                       callbackArgs=(connection,))
+
+    def _backendConnected(self, backend, connection):
+        self.span.set('backend', repr(backend))
+        self.span.mark('connect')
+        if not self.transport.connected:
+            return connection.transport.loseConnection()
+        self.backend = connection
+        remaining = self.decoder.remaining()
+        if remaining:
+            connection.transport.write(remaining)
+        if self.inputClosed:
+            connection.transport.loseWriteConnection()
+        connection.transport.registerProducer(self, True)
+        self.output.registerProducer(connection.transport, True)
+        self.resumeProducing()
+
+    def _backendFailed(self, failure):
+        log.msg("Proxying failed: %s" % failure.getErrorMessage())
+        if self.transport.connected:
+            self.sendErrorAndDisconnect("ERR Repository unavailable")
+
+    def backendDataReceived(self, data):
+        self.tracker.first_byte()
+        self.output.write(data)
+
+    def backendConnectionLost(self, reason):
+        self.span.mark('stream')
+        self.output.unregisterProducer()
+        self.output.loseConnection()
+
+    # IHalfCloseableProtocol
+    def readConnectionLost(self):
+        """The client is done sending, e.g. an SSH session proxied by
+        BackendProcess. Requests in progress are completed."""
+        self.inputClosed = True
+        if self.backend is not None:
+            self.backend.transport.loseWriteConnection()
+        elif self.process is not None:
+            if self.process.transport is not None:
+                self.process.transport.closeStdin()
+        elif self.authorization is None and self.slotRequest is None and \
+                self.refresh is None and not self.replaying:
+            self.output.loseConnection()  # nothing left to do
+
+    def writeConnectionLost(self):
+        pass
+
+    def _fromTrustedProxy(self):
+        trusted = getattr(self.git_configuration, 'trusted_proxies', ())
+        return self.transport.getPeer().host in trusted
+
     def sendErrorAndDisconnect(self, msg):
-        self.transport.write(git_packet(msg))
-        self.transport.loseConnection()
+        self.output.write(encode(msg))
+        self.output.loseConnection()
 
         # return None so it can be used
         # in a return statement in dataReceived for simplicity
@@ -19,8 +19,11 @@
 
 import os.path
 import re
+import zlib
+import hashlib
 import datetime
 import calendar
+import functools
 import email.utils
 
 from zope.interface import implements
@@ -35,13 +38,28 @@ from twisted.cred.checkers import AllowAnonymousAccess, ANONYMOUS
 from twisted.web.guard import HTTPAuthSessionWrapper, BasicCredentialFactory
 from twisted.web._auth.wrapper import UnauthorizedResource
 
-from twisted.web.static import File
+from twisted.web.static import File, NoRangeStaticProducer
+from twisted.web.http import CACHED
 from twisted.web.server import Site, NOT_DONE_YET
 from twisted.web.resource import Resource, IResource
-from twisted.web.resource import NoResource, ForbiddenResource
-
-from gitserverglue.common import PasswordChecker, git_packet
+from twisted.web.resource import NoResource, ForbiddenResource, ErrorPage
+from twisted.web.util import DeferredResource
+
+from gitserverglue.bundles import advertise_bundle
+from gitserverglue.common import PasswordChecker
+from gitserverglue.common import repository_updated
+from gitserverglue.common import protocol_env, protocol_version
+from gitserverglue.compression import BodyTooLarge, decode_content, add_vary
+from gitserverglue.immutable import ImmutableFile
+from gitserverglue.metrics import track_request, untracked
+from gitserverglue.mirror import MirrorUnavailable
+from gitserverglue.pktline import encode_lines
+from gitserverglue.proxy import ProxyResource
+from gitserverglue.refs import ref_state_fingerprint
+from gitserverglue.scheduler import ServerBusy, PRIORITY_FETCH, PRIORITY_PUSH
 from gitserverglue.streamingweb import StreamingRequest
+from gitserverglue.timeouts import untimed
+from gitserverglue.tracing import start_span, unsampled
 
 
 def get_date_header(dt=None):
@@ -60,16 +78,42 @@ dont_cache = lambda: [('Expires', 'Fri, 01 Jan 1980 00:00:00 GMT'),
               ('Pragma', 'no-cache'),
               ('Cache-Control', 'no-cache, max-age=0, must-revalidate')]
 
-file_headers = {
-    re.compile('.*/(HEAD)$'):                                   lambda: dict(dont_cache() + [('Content-Type', 'text/plain')]),
-    re.compile('.*/(objects/info/alternates)$'):                lambda: dict(dont_cache() + [('Content-Type', 'text/plain')]),
-    re.compile('.*/(objects/info/http-alternates)$'):           lambda: dict(dont_cache() + [('Content-Type', 'text/plain')]),
-    re.compile('.*/(objects/info/packs)$'):                     lambda: dict(dont_cache() + [('Content-Type', 'text/plain; charset=utf-8')]),
-    re.compile('.*/(objects/info/[^/]+)$'):                     lambda: dict(dont_cache() + [('Content-Type', 'text/plain')]),
-    re.compile('.*/(objects/[0-9a-f]{2}/[0-9a-f]{38})$'):       lambda: dict(cache_forever() + [('Content-Type', 'application/x-git-loose-object')]),
-    re.compile('.*/(objects/pack/pack-[0-9a-f]{40}\\.pack)$'):  lambda: dict(cache_forever() + [('Content-Type', 'application/x-git-packed-objects')]),
-    re.compile('.*/(objects/pack/pack-[0-9a-f]{40}\\.idx)$'):   lambda: dict(cache_forever() + [('Content-Type', 'application/x-git-packed-objects-toc')]),
-}
+# (name, pattern, headers, immutable) of files served for dumb clients,
+# more specific patterns first
+file_types = [
+    ('text', 'HEAD|objects/info/(?:http-)?alternates',
+     lambda: dict(dont_cache() + [('Content-Type', 'text/plain')]), False),
+    ('packs', 'objects/info/packs',
+     lambda: dict(dont_cache() + [('Content-Type',
+                                   'text/plain; charset=utf-8')]), False),
+    ('info', 'objects/info/[^/]+',
+     lambda: dict(dont_cache() + [('Content-Type', 'text/plain')]), False),
+    ('loose', 'objects/[0-9a-f]{2}/[0-9a-f]{38}',
+     lambda: dict(cache_forever() + [('Content-Type',
+                                      'application/x-git-loose-object')]),
+     True),
+    ('pack', 'objects/pack/pack-[0-9a-f]{40}\\.pack',
+     lambda: dict(cache_forever() + [('Content-Type',
+                                      'application/x-git-packed-objects')]),
+     True),
+    ('idx', 'objects/pack/pack-[0-9a-f]{40}\\.idx',
+     lambda: dict(cache_forever() + [
+                ('Content-Type', 'application/x-git-packed-objects-toc')]),
+     True),
+    # clone bundles of a BundleStore, named after the ref state
+    ('bundle', 'bundles/[0-9a-f]{40}\\.bundle',
+     lambda: dict(cache_forever() + [
+                ('Content-Type', 'application/x-git-bundle')]),
+     True),
+]
+
+# a single regular expression matching all of file_types, the name of
+# the matching group tells which one matched
+file_dispatcher = re.compile('.*/(?:%s)$' % '|'.join(
+                        '(?P<%s>%s)' % (name, pattern)
+                        for name, pattern, unused_h, unused_i in file_types))
+file_type_info = dict((name, (headers, immutable))
+                      for name, unused_p, headers, immutable in file_types)
 
 
 class FileLikeProducer(object):
@@ -131,27 +175,147 @@ class FileLikeProducer(object):
 
 
 class GitCommand(Resource):
-    """A resource returning content from a git process"""
+    """A resource returning content from a git process
+
+    If a ProcessScheduler is given, git is only spawned once a process
+    slot was acquired and 503 is returned if the server is too busy.
+    If a BandwidthShaper is given, the response is sent within its
+    limits, if a ResponseCompression is given, it is compressed for
+    clients accepting it (before shaping, so the limits apply to what
+    is actually sent). env is added to the environment of git."""
     implements(IProcessProtocol, IConsumer)
 
     isLeaf = True
     process = None
+    slot = None
+    span = unsampled
+    timer = untimed
+    waiting = True
+    output = None
     _producer = None
-
-    def __init__(self, cmd, args):
+    _slotRequest = None
+    _stdinClosed = False
+    _discardInput = False
+    _disconnected = False
+
+    def __init__(self, cmd, args, scheduler=None, repository=None,
+                 username=None, priority=PRIORITY_FETCH, tracker=untracked,
+                 shaper=None, compression=None, env=None):
         self.cmd = cmd
         self.args = args
+        self.env = env
+        self.scheduler = scheduler
+        self.shaper = shaper
+        self.compression = compression
+        self.repository = repository
+        self.username = username
+        self.priority = priority
+        self.tracker = tracker
+        self._pendingInput = []
 
     # Resource
     def render(self, request):
         self.request = request
-        reactor.spawnProcess(self, self.cmd, self.args)
+        self.span = getattr(request, 'span', unsampled)
+        if not self._decodeContent(request):
+            return NOT_DONE_YET
+        if self.output is None:
+            self.output = self._compress(request, self._shape(request))
+
+        request.notifyFinish().addErrback(self._requestLost)
+        if self.scheduler is None:
+            self.spawn()
+        else:
+            self._slotRequest = self.scheduler.acquire(self.repository,
+                                                       self.username,
+                                                       self.priority)
+            self._slotRequest.addCallbacks(self._slotAcquired,
+                                           self._slotFailed)
 
         return NOT_DONE_YET
 
+    def spawn(self):
+        self.tracker.process_started()
+        try:
+            reactor.spawnProcess(self, self.cmd, self.args, self.env or {})
+        except:
+            if self.slot is not None:
+                self.slot.release()
+            raise
+
+    def _slotAcquired(self, slot):
+        self.span.mark('queue')
+        self._slotRequest = None
+        self.slot = slot
+        self.spawn()
+
+    def _slotFailed(self, failure):
+        self._slotRequest = None
+        if failure.check(defer.CancelledError):
+            return
+        failure.trap(ServerBusy)
+
+        log.msg("Rejecting %r: %s" % (self.args, failure.value.message))
+        self.request.setResponseCode(503)
+        self.request.etag = None
+        self.request.responseHeaders.removeHeader('content-encoding')
+        self.request.setHeader('Retry-After', str(failure.value.retry_after))
+        self.request.setHeader('Content-Type', 'text/plain')
+
+        # keep reading a streamed request body so keep-alive works
+        self._discardInput = True
+        self._pendingInput = []
+        if self._producer is not None:
+            self._producer.resumeProducing()
+
+        self.request.write(failure.value.message + '\n')
+        self.request.finish()
+
+    def _requestLost(self, reason):
+        self._disconnected = True
+        if self._slotRequest is not None:
+            self._slotRequest.cancel()
+
+    def _decodeContent(self, request):
+        """Decompress the body of a buffered request, returns False if
+        it was rejected"""
+        if isinstance(request, StreamingRequest):
+            return True  # decompressed as it arrives
+
+        try:
+            decode_content(request)
+            return True
+        except BodyTooLarge as e:
+            request.setResponseCode(413)
+            message = str(e)
+        except zlib.error as e:
+            request.setResponseCode(400)
+            message = "Cannot decompress request body: %s" % e
+
+        log.msg("Rejecting %r: %s" % (self.args, message))
+        request.setHeader('Content-Type', 'text/plain')
+        request.write(message + '\n')
+        request.finish()
+        return False
+
+    def _shape(self, request):
+        if self.shaper is None:
+            return request
+        return self.shaper.shape(request, self.username,
+                                 request.getClientIP(), self.repository)
+
+    def _compress(self, request, consumer):
+        if self.compression is None:
+            return consumer
+        return self.compression.wrap(request, consumer)
+
     # IProcessProtocol
     def makeConnection(self, process):
         self.process = process
+        self.span.mark('spawn')
+        # killed if the connection times out
+        self.timer = getattr(self.request.channel, 'timer', untimed)
+        self.timer.add_process(process)
 
         # twisted.internet.process.Process seems to not fully
         # implement IPushProducer since stopProducing is missing
@@ -160,20 +324,33 @@ class GitCommand(Resource):
             setattr(process, "stopProducing",
                     lambda: process.loseConnection())
 
-        self.request.registerProducer(process, True)
+        self.output.registerProducer(process, True)
 
         if not isinstance(self.request, StreamingRequest):
             # twisted default request, does not support streaming contents
             producer = FileLikeProducer(self.request.content, process)
             producer.startProducing()
             process.registerProducer(producer, True)
+            return
+
+        # input received while waiting for the process
+        if self._pendingInput:
+            process.write(''.join(self._pendingInput))
+            self._pendingInput = []
 
-        elif self._producer is not None:
+        if self._producer is not None:
             self._producer.resumeProducing()
-            self.process.registerProducer(self._producer, True)
+            if not self._stdinClosed:
+                self.process.registerProducer(self._producer, True)
+
+        if self._stdinClosed:
+            process.closeStdin()
 
     def childDataReceived(self, childFD, data):
-        self.request.write(data)
+        if self.waiting:
+            self.waiting = False
+            self.span.mark('first_byte')
+        self.output.write(data)
 
     def childConnectionLost(self, childFD):
         pass
@@ -182,8 +359,16 @@ class GitCommand(Resource):
         pass
 
     def processEnded(self, reason):
-        self.request.unregisterProducer()
-        self.request.finish()
+        self.tracker.process_ended(reason)
+        self.timer.remove_process(self.process)
+        self.span.mark('stream')
+        self.span.set('exit_code', reason.value.exitCode)
+        if self.slot is not None:
+            self.slot.release()
+        if self._disconnected:
+            return  # the request is gone, nothing to finish
+        self.output.unregisterProducer()
+        self.output.finish()
 
     # IConsumer for StreamingRequest
     def registerProducer(self, producer, streaming):
@@ -208,18 +393,191 @@ class GitCommand(Resource):
     def unregisterProducer(self):
         if self.process:
             self.process.closeStdin()
+        else:
+            self._stdinClosed = True
 
     def write(self, data):
-        self.process.write(data)
+        if self.process is not None:
+            self.process.write(data)
+        elif not self._discardInput:
+            self._pendingInput.append(data)
+
+
+class ReceivePack(GitCommand):
+    """git-receive-pack RPC notifying caches once the push completed"""
+
+    def __init__(self, cmd, args, git_configuration, repository_fs_path,
+                 **kwargs):
+        GitCommand.__init__(self, cmd, args, **kwargs)
+        self.git_configuration = git_configuration
+        self.repository_fs_path = repository_fs_path
+
+    def processEnded(self, reason):
+        if reason.value.exitCode == 0:
+            repository_updated(self.git_configuration,
+                               self.repository_fs_path)
+        GitCommand.processEnded(self, reason)
+
+
+class CachedUploadPack(GitCommand):
+    """git-upload-pack RPC answered from a PackCache where possible
+
+    The request body is collected before git is spawned. If the
+    response for the request is cached, it is sent directly from disk,
+    otherwise git is spawned and its response stored in the cache."""
+
+    max_request_size = 1024 ** 2
+
+    def __init__(self, cmd, args, pack_cache, repository_fs_path, **kwargs):
+        GitCommand.__init__(self, cmd, args, **kwargs)
+        self.pack_cache = pack_cache
+        self.repository_fs_path = repository_fs_path
+        self.fingerprint = ref_state_fingerprint(repository_fs_path)
+        self._collecting = True
+        self._body = []
+        self._bodySize = 0
+        self._writer = None
+        self._streamProducer = None
+
+    def render(self, request):
+        self.request = request
+        if not self._decodeContent(request):
+            return NOT_DONE_YET
+        self.output = self._compress(request, self._shape(request))
+
+        if not isinstance(request, StreamingRequest):
+            # buffered request, the whole body is already available
+            body = request.content.read()
+            request.content.seek(0)
+            self._requestComplete(body)
+
+        # streaming request, wait for the body in write/unregisterProducer
+        return NOT_DONE_YET
+
+    def _requestComplete(self, body):
+        self._collecting = False
+        span = getattr(self.request, 'span', unsampled)
+        span.mark('body')
+
+        key = self.pack_cache.make_key(self.repository_fs_path, 'http',
+                                       self.fingerprint, body)
+        if key is not None:
+            f = self.pack_cache.open(key)
+            if f is not None:
+                log.msg("Sending cached response %s" % key)
+                span.set('cached', True)
+                if not self.request.responseHeaders.hasHeader(
+                        'content-encoding'):
+                    self.request.setHeader('Content-Length',
+                                           str(os.fstat(f.fileno()).st_size))
+                NoRangeStaticProducer(self.output, f).start()
+                return
+
+            self._writer = self.pack_cache.writer(key,
+                                                  self.repository_fs_path)
+
+        GitCommand.render(self, self.request)
+        if isinstance(self.request, StreamingRequest):
+            GitCommand.write(self, body)
+            GitCommand.unregisterProducer(self)
+
+    def childDataReceived(self, childFD, data):
+        if self._writer is not None and childFD == 1:
+            self._writer.write(data)
+        GitCommand.childDataReceived(self, childFD, data)
+
+    def processEnded(self, reason):
+        if self._writer is not None:
+            if reason.value.exitCode == 0:
+                self._writer.commit()
+            else:
+                self._writer.abort()
+        GitCommand.processEnded(self, reason)
+
+    def _slotFailed(self, failure):
+        if self._writer is not None:
+            self._writer.abort()
+        return GitCommand._slotFailed(self, failure)
+
+    # IConsumer for StreamingRequest
+    def registerProducer(self, producer, streaming):
+        if self._collecting:
+            self._streamProducer = producer  # keep it producing
+        else:
+            GitCommand.registerProducer(self, producer, streaming)
+
+    def unregisterProducer(self):
+        if self._collecting:
+            self._requestComplete(''.join(self._body))
+        else:
+            GitCommand.unregisterProducer(self)
+
+    def write(self, data):
+        if not self._collecting:
+            return GitCommand.write(self, data)
+
+        self._body.append(data)
+        self._bodySize += len(data)
+
+        if self._bodySize > self.max_request_size:
+            # no fresh clone, give up on caching and stream the rest
+            self._collecting = False
+            body, self._body = ''.join(self._body), []
+            GitCommand.registerProducer(self, self._streamProducer, True)
+            GitCommand.render(self, self.request)
+            GitCommand.write(self, body)
+
+
+class AdvertiseRefs(GitCommand):
+    """Ref advertisement, optionally stored in an AdvertisementCache
+
+    The advertisement is stored uncompressed, header is sent before the
+    output of git once it was spawned."""
+
+    def __init__(self, cmd, args, header, advertisement_cache=None,
+                 repository_fs_path=None, service=None, fingerprint=None,
+                 **kwargs):
+        GitCommand.__init__(self, cmd, args, **kwargs)
+        self.header = header
+        self.advertisement_cache = advertisement_cache
+        self.repository_fs_path = repository_fs_path
+        self.service = service
+        self.fingerprint = fingerprint
+        self._output = [header]
+
+    def makeConnection(self, process):
+        if self.header:
+            self.output.write(self.header)
+        GitCommand.makeConnection(self, process)
+
+    def childDataReceived(self, childFD, data):
+        if self.advertisement_cache is not None and childFD == 1:
+            self._output.append(data)
+        GitCommand.childDataReceived(self, childFD, data)
+
+    def processEnded(self, reason):
+        if self.advertisement_cache is not None and reason.value.exitCode == 0:
+            self.advertisement_cache.store(self.repository_fs_path,
+                                           self.service, self.fingerprint,
+                                           ''.join(self._output))
+        GitCommand.processEnded(self, reason)
 
 
 class InfoRefs(Resource):
     """Resource for handling git requests to /info/refs"""
     isLeaf = True
 
-    def __init__(self, gitpath, gitcommand='git'):
+    def __init__(self, gitpath, gitcommand='git', advertisement_cache=None,
+                 scheduler=None, username=None, tracker=untracked,
+                 compression=None, env=None):
         self.gitpath = gitpath
+        self.env = env or {}
         self.gitcommand = gitcommand
+        self.advertisement_cache = advertisement_cache
+        self.compression = compression
+        self.scheduler = scheduler
+        self.username = username
+        self.tracker = tracker
 
     def render_GET(self, request):
         if 'service' not in request.args:
@@ -239,12 +597,71 @@ class InfoRefs(Resource):
                 return "Invalid RPC: " + request.args['service'][0]
 
             rpc = request.args['service'][0][4:]
-            request.write(git_packet('# service=git-' + rpc) + git_packet())
+            for key, val in dont_cache():
+                request.setHeader(key, val)
+            request.setHeader('Content-Type',
+                              'application/x-git-%s-advertisement' % rpc)
+
+            # the advertisement depends on the protocol version, with
+            # version 2 only the capabilities are advertised
+            version = protocol_version(self.env)
+            add_vary(request, 'Git-Protocol')
+            service = rpc
+            if version != 0:
+                service += '-v%d' % version
+            config = self.env.get('GIT_CONFIG_PARAMETERS')
+            if config is not None:
+                # e.g. the bundle of advertise_bundle changes it as well
+                service += '-' + hashlib.sha1(config).hexdigest()[:12]
+
+            # the advertisement only changes with the refs, so
+            # unchanged repositories can be answered without git
+            fingerprint = ref_state_fingerprint(self.gitpath)
+            encoding = None
+            if self.compression is not None:
+                add_vary(request, 'Accept-Encoding')
+                encoding = self.compression.negotiate(request)
+            etag = '%s-%s' % (service, fingerprint)
+            if encoding is not None:
+                etag += '-' + encoding  # a different representation
+            if request.setETag('"%s"' % etag) == CACHED:
+                return ''
+
+            # like git http-backend, no service line for version 2
+            header = ''
+            if version != 2 or rpc != 'upload-pack':
+                header = encode_lines(['# service=git-' + rpc])
+            if self.advertisement_cache is not None:
+                if encoding is None:
+                    data = self.advertisement_cache.get(self.gitpath, service,
+                                                        fingerprint)
+                else:
+                    # compressed once for all clients while unchanged
+                    data = self.advertisement_cache.get_encoded(
+                        self.gitpath, service, fingerprint, encoding,
+                        functools.partial(self.compression.compress,
+                                          encoding))
+                if data is not None:
+                    if encoding is not None:
+                        request.setHeader('Content-Encoding', encoding)
+                    request.setHeader('Content-Length', str(len(data)))
+                    return data
+
             cmd = self.gitcommand
             args = [os.path.basename(cmd), rpc, '--stateless-rpc',
                     '--advertise-refs', self.gitpath]
+            priority = PRIORITY_FETCH
+            if rpc == 'receive-pack':
+                priority = PRIORITY_PUSH
 
-            return GitCommand(cmd, args).render(request)
+            return AdvertiseRefs(cmd, args, header, self.advertisement_cache,
+                                 self.gitpath, service, fingerprint,
+                                 env=self.env, scheduler=self.scheduler,
+                                 repository=self.gitpath,
+                                 username=self.username,
+                                 priority=priority,
+                                 tracker=self.tracker,
+                                 compression=self.compression).render(request)
 
 
 class GitResource(Resource):
@@ -270,27 +687,53 @@ class GitResource(Resource):
         - /foo/bar/HEAD -> file (dumb http)
         - /foo/bar/objects/* -> file (dumb http)
         """
+        span = getattr(request, 'span', unsampled)
+        span.mark('auth')
+        span.set('user', self.username)
+
         path = request.path  # alternatively use path + request.postpath
-        pathparts = path.split('/')
-        writerequired = False
-        script_name = '/'
-        new_path = path
-        resource = NoResource()
 
         # Path lookup / translation
         path_info = self.git_configuration.path_lookup(path,
                                                        protocol_hint='http')
+        return self._when(path_info, self._lookedUp, request, path)
+
+    def _lookedUp(self, path_info, request, path):
+        span = getattr(request, 'span', unsampled)
+        span.mark('lookup')
         if path_info is None:
             log.msg('User %s tried to access %s '
                     'but the lookup failed' % (self.username, path))
-            return resource
+            return NoResource()
 
         log.msg('Lookup of %s gave %r' % (path, path_info))
 
         if (path_info['repository_fs_path'] is None and
-            path_info['repository_base_fs_path'] is None):
+            path_info['repository_base_fs_path'] is None and
+            path_info.get('repository_backend') is None):
             log.msg('Neither a repository base nor a repository were returned')
-            return resource
+            return NoResource()
+
+        # since pretty much everything needs read access, check for it now
+        span.set('repository', path_info['repository_fs_path'])
+        allowed = self.authnz.can_read(self.username, path_info)
+        return self._when(allowed, self._readAllowed, request, path,
+                          path_info)
+
+    def _readAllowed(self, allowed, request, path, path_info):
+        getattr(request, 'span', unsampled).mark('authorize')
+        if not allowed:
+            if self.username is None:
+                return UnauthorizedResource(self.credentialFactories)
+            else:
+                return ForbiddenResource("You don't have read access")
+
+        pathparts = path.split('/')
+        writerequired = False
+        refresh = False  # the mirror, if the path is one
+        script_name = '/'
+        new_path = path
+        resource = NoResource()
 
         # split script_name / new_path according to path info
         if path_info['repository_base_url_path'] is not None:
@@ -298,64 +741,130 @@ class GitResource(Resource):
             script_name += path_info['repository_base_url_path'].strip('/')
             new_path = path[len(script_name.rstrip('/')):]
 
-        # since pretty much everything needs read access, check for it now
-        if not self.authnz.can_read(self.username, path_info):
-            if self.username is None:
-                return UnauthorizedResource(self.credentialFactories)
-            else:
-                return ForbiddenResource("You don't have read access")
+        # git processes are spawned once the scheduler (if any) allows it,
+        # responses are sent within the limits of the shaper (if any)
+        scheduler = getattr(self.git_configuration, 'process_scheduler', None)
+        admission = {
+            # the protocol version the client asks for, Git-Protocol
+            'env': protocol_env(request.getHeader('git-protocol')),
+            'scheduler': scheduler,
+            'repository': path_info['repository_fs_path'],
+            'username': self.username,
+            'shaper': getattr(self.git_configuration, 'bandwidth_shaper',
+                              None)
+        }
+
+        # ref advertisements are compressed for clients accepting it,
+        # upload-pack responses only if configured so
+        compression = getattr(self.git_configuration, 'response_compression',
+                              None)
+
+        # repositories of a backend node, everything is passed on
+        if path_info.get('repository_backend') is not None:
+            writerequired = (
+                pathparts[-1] == 'git-receive-pack' or
+                request.args.get('service') == ['git-receive-pack'])
+            self._track(request, 'proxy')
+            resource = ProxyResource(path_info['repository_backend'],
+                                     writerequired)
 
         # Smart HTTP requests
         # /info/refs
-        if (len(pathparts) >= 2 and
+        elif (len(pathparts) >= 2 and
             pathparts[-2] == 'info' and
             pathparts[-1] == 'refs'):
             writerequired = ('service' in request.args and
                              request.args['service'][0] == 'git-receive-pack')
-            resource = InfoRefs(path_info['repository_fs_path'])
+            # the requests of a fetch following it use the same refs
+            refresh = True
+            env = admission['env']
+            if not writerequired:
+                env = advertise_bundle(self.git_configuration, path_info, env)
+            resource = InfoRefs(path_info['repository_fs_path'],
+                                gitcommand=self.git_configuration.git_binary,
+                                advertisement_cache=getattr(
+                                    self.git_configuration,
+                                    'advertisement_cache', None),
+                                scheduler=scheduler, username=self.username,
+                                tracker=self._track(request, 'info-refs'),
+                                compression=compression, env=env)
 
         # /git-upload-pack (client pull)
         elif len(pathparts) >= 1 and pathparts[-1] == 'git-upload-pack':
-            cmd = 'git'
+            cmd = self.git_configuration.git_binary
             args = [os.path.basename(cmd), 'upload-pack', '--stateless-rpc',
                     path_info['repository_fs_path']]
-            resource = GitCommand(cmd, args)
+            pack_cache = getattr(self.git_configuration, 'pack_cache', None)
+            tracker = self._track(request, 'upload-pack')
+            admission['env'] = advertise_bundle(self.git_configuration,
+                                                path_info, admission['env'])
+            if compression is not None and not compression.upload_pack:
+                compression = None
+            if pack_cache is not None:
+                resource = CachedUploadPack(cmd, args, pack_cache,
+                                            path_info['repository_fs_path'],
+                                            tracker=tracker,
+                                            compression=compression,
+                                            **admission)
+            else:
+                resource = GitCommand(cmd, args, tracker=tracker,
+                                      compression=compression, **admission)
             request.setHeader('Content-Type',
                               'application/x-git-upload-pack-result')
 
         # /git-receive-pack (client push)
         elif len(pathparts) >= 1 and pathparts[-1] == 'git-receive-pack':
             writerequired = True
-            cmd = 'git'
+            cmd = self.git_configuration.git_binary
             args = [os.path.basename(cmd), 'receive-pack',
                     '--stateless-rpc', path_info['repository_fs_path']]
-            resource = GitCommand(cmd, args)
+            resource = ReceivePack(cmd, args, self.git_configuration,
+                                   path_info['repository_fs_path'],
+                                   priority=PRIORITY_PUSH,
+                                   tracker=self._track(request,
+                                                       'receive-pack'),
+                                   **admission)
             request.setHeader('Content-Type',
                               'application/x-git-receive-pack-result')
 
-        # static files as specified in file_headers or fallback webfrontend
+        # static files as specified in file_types or fallback webfrontend
         else:
             # determine the headers for this file
-            filename, headers = None, None
-            for matcher, get_headers in file_headers.items():
-                m = matcher.match(path)
-                if m:
-                    filename = m.group(1)
-                    headers = get_headers()
-                    break
-
-            if filename is not None:
+            m = file_dispatcher.match(path)
+            if m is not None:
+                filename = m.group(m.lastgroup)
+                fs_path = os.path.join(path_info['repository_fs_path'],
+                                       filename)
+                if m.lastgroup == 'bundle':
+                    fs_path = self._bundlePath(path_info, filename)
+                    if fs_path is None:
+                        return resource
+
+                get_headers, immutable = file_type_info[m.lastgroup]
+                headers = get_headers()
                 for key, val in headers.items():
                     request.setHeader(key, val)
 
-                log.msg("Returning file %s" % os.path.join(
-                                    path_info['repository_fs_path'], filename))
-                resource = File(os.path.join(path_info['repository_fs_path'],
-                                        filename), headers['Content-Type'])
+                log.msg("Returning file %s" % fs_path)
+                self._track(request, 'dumb')
+                if immutable:
+                    # content-addressed, the name identifies the content
+                    etag = filename.replace('objects/', '').replace(
+                                        'pack/pack-', '').replace('/', '')
+                    open_files = getattr(self.git_configuration,
+                                         'open_files', None)
+                    resource = ImmutableFile(fs_path, headers['Content-Type'],
+                                             etag, open_files,
+                                             admission['shaper'],
+                                             self.username,
+                                             path_info['repository_fs_path'])
+                else:
+                    resource = File(fs_path, headers['Content-Type'])
                 resource.isLeaf = True  # static file -> it is a leaf
 
             else:
                 # No match -> fallback to git viewer
+                self._track(request, 'viewer')
                 if script_name is not None:
                     # patch pre/post path of request according to
                     # script_name and path
@@ -386,20 +895,91 @@ class GitResource(Resource):
         # before returning the resource, check if write access is required
         # and enforce privileges accordingly
         # anonymous (username = None) will never be granted write access
-        if writerequired and (self.username is None or
-                              not self.authnz.can_write(self.username,
-                                                        path_info)):
-            if self.username is None:
-                return UnauthorizedResource(self.credentialFactories)
-            else:
-                return ForbiddenResource("You don't have write access")
+        if writerequired and path_info.get('repository_upstream') is not None:
+            return ForbiddenResource("Mirrors are read only")
+        if writerequired and self.username is None:
+            return UnauthorizedResource(self.credentialFactories)
+        if writerequired:
+            allowed = self.authnz.can_write(self.username, path_info)
+            return self._when(allowed, self._writeAllowed, request,
+                              path_info, resource, refresh)
+        return self._writeAllowed(True, request, path_info, resource,
+                                  refresh)
+
+    def _writeAllowed(self, allowed, request, path_info, resource, refresh):
+        if not allowed:
+            return ForbiddenResource("You don't have write access")
+
+        mirrors = getattr(self.git_configuration, 'mirror_manager', None)
+        upstream = path_info.get('repository_upstream')
+        if refresh and mirrors is not None and upstream is not None:
+            d = mirrors.refresh(path_info['repository_fs_path'], upstream)
+            d.addCallbacks(self._mirrorRefreshed, self._mirrorFailed,
+                           callbackArgs=(request, resource))
+            return DeferredResource(d)
 
         return resource
 
+    def _when(self, result, f, *args):
+        """Call f with a result of path_lookup or authnz, which may be
+        a Deferred, and return the resource it gives"""
+        if not isinstance(result, defer.Deferred):
+            return f(result, *args)
+        result.addCallback(f, *args)
+        result.addErrback(self._authorizationFailed)
+        return DeferredResource(result)
+
+    def _authorizationFailed(self, failure):
+        log.err(failure, 'Authorizing the request of %s failed' % (
+                    self.username,))
+        return ErrorPage(503, "Service Unavailable", "Authorization failed")
+
+    def _mirrorRefreshed(self, ignored, request, resource):
+        getattr(request, 'span', unsampled).mark('refresh')
+        return resource
+
+    def _mirrorFailed(self, failure):
+        failure.trap(MirrorUnavailable)
+        log.msg('Refreshing a mirror failed: %s' % failure.getErrorMessage())
+        return ErrorPage(502, "Bad Gateway", "Upstream repository unavailable")
+
+    def _bundlePath(self, path_info, filename):
+        """Get the path of a bundle of the BundleStore, None if there is
+        no such bundle"""
+        bundle_store = getattr(self.git_configuration, 'bundle_store', None)
+        if bundle_store is None:
+            return None
+        name = filename[len('bundles/'):-len('.bundle')]
+        return bundle_store.path(path_info['repository_fs_path'], name)
+
+    def _track(self, request, rpc):
+        getattr(request, 'span', unsampled).set('rpc', rpc)
+        tracker = track_request(self.git_configuration, 'http', rpc)
+        tracker.watch(request)
+        return tracker
+
     def render_GET(self, request):
         return ForbiddenResource()
 
 
+class GitAuthSessionWrapper(HTTPAuthSessionWrapper):
+    """Starts the trace span of each request before authentication"""
+
+    def __init__(self, portal, credentialFactories, git_configuration):
+        HTTPAuthSessionWrapper.__init__(self, portal, credentialFactories)
+        self.git_configuration = git_configuration
+
+    def getChildWithDefault(self, path, request):
+        request.span = start_span(self.git_configuration, 'http')
+        request.notifyFinish().addBoth(self._finished, request.span)
+        return HTTPAuthSessionWrapper.getChildWithDefault(self, path,
+                                                          request)
+
+    def _finished(self, result, span):
+        span.mark('drain')
+        span.end()
+
+
 class GitHTTPRealm(object):
     implements(IRealm)
 
@@ -434,10 +1014,16 @@ def create_factory(authnz, git_configuration, git_viewer=None):
 
     if hasattr(authnz, 'check_password'):
         log.msg("Registering PasswordChecker")
-        gitportal.registerChecker(PasswordChecker(authnz.check_password))
+        check_password = authnz.check_password
+        metrics = getattr(git_configuration, 'metrics', None)
+        if metrics is not None:
+            check_password = metrics.timed_check(check_password, 'http',
+                                                 'password')
+        gitportal.registerChecker(PasswordChecker(check_password))
     gitportal.registerChecker(AllowAnonymousAccess())
 
-    resource = HTTPAuthSessionWrapper(gitportal, credentialFactories)
+    resource = GitAuthSessionWrapper(gitportal, credentialFactories,
+                                     git_configuration)
     site = Site(resource)
 
     return site
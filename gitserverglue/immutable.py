@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+import os
+import mmap
+from collections import OrderedDict
+
+from zope.interface import implements
+from twisted.internet.interfaces import IPushProducer
+from twisted.web.http import CACHED, PARTIAL_CONTENT
+from twisted.web.http import REQUESTED_RANGE_NOT_SATISFIABLE
+from twisted.web.resource import Resource, NoResource
+from twisted.web.server import NOT_DONE_YET
+
+
+def parse_range(header, size):
+    """Get the (first, last) byte of a single bytes range
+
+    Returns None if the header should be ignored (malformed or several
+    ranges) and raises ValueError if the range cannot be satisfied."""
+    unit, _, spec = header.partition('=')
+    first, _, last = spec.strip().partition('-')
+    if (unit.strip().lower() != 'bytes' or ',' in spec or
+            not (first + last).isdigit()):
+        return None
+
+    if first == '':
+        # suffix range, the last n bytes
+        if int(last) == 0 or size == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - int(last), 0), size - 1
+
+    first = int(first)
+    if last and first > int(last):
+        return None
+    if first >= size:
+        raise ValueError("Range starts after the end of the file")
+    return first, min(int(last or size - 1), size - 1)
+
+
+class OpenFile(object):
+    """An open file shared by all requests for it
+
+    The file is closed once it was evicted from the cache (or was never
+    cached) and no request uses it anymore."""
+
+    def __init__(self, fs_path, cached=True):
+        self.file = open(fs_path, 'rb')
+        st = os.fstat(self.file.fileno())
+        self.identity = (st.st_dev, st.st_ino)
+        self.size = st.st_size
+        self.users = 0
+        self.evicted = not cached
+        self._mmap = None
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def mmap(self):
+        if self._mmap is None:
+            self._mmap = mmap.mmap(self.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def acquire(self):
+        self.users += 1
+        return self
+
+    def release(self):
+        self.users -= 1
+        if self.evicted and self.users <= 0:
+            self.close()
+
+    def evict(self):
+        self.evicted = True
+        if self.users <= 0:
+            self.close()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self.file.close()
+
+
+class OpenFileCache(object):
+    """Keeps immutable files open between requests
+
+    Each request still stats the path, so deleted files are not served
+    and a replaced file is opened again."""
+
+    def __init__(self, max_files=256):
+        self.max_files = max_files
+        self.hits = 0
+        self.misses = 0
+        self._files = OrderedDict()
+
+    def open(self, fs_path):
+        """Get an acquired OpenFile, raises EnvironmentError"""
+        st = os.stat(fs_path)
+
+        entry = self._files.pop(fs_path, None)
+        if entry is not None and entry.identity != (st.st_dev, st.st_ino):
+            entry.evict()
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            entry = OpenFile(fs_path)
+        else:
+            self.hits += 1
+
+        self._files[fs_path] = entry
+        while len(self._files) > self.max_files:
+            self._files.popitem(last=False)[1].evict()
+        return entry.acquire()
+
+
+class MmapProducer(object):
+    """Writes a range of a memory mapped file to a request
+
+    request may also be a consumer in front of the request, like the
+    ShapedConsumer of a BandwidthShaper."""
+    implements(IPushProducer)
+
+    chunk_size = 2 ** 16
+
+    def __init__(self, request, openfile, offset, length):
+        self.request = request
+        self.openfile = openfile
+        self.offset = offset
+        self.remaining = length
+        self.paused = False
+        self.stopped = False
+
+    def start(self):
+        self.data = self.openfile.mmap()
+        self.request.registerProducer(self, True)
+        self.resumeProducing()
+
+    def resumeProducing(self):
+        self.paused = False
+        while not self.paused and not self.stopped and self.remaining:
+            length = min(self.chunk_size, self.remaining)
+            chunk = self.data[self.offset:self.offset + length]
+            self.offset += length
+            self.remaining -= length
+            self.request.write(chunk)
+
+        if not self.remaining and not self.stopped:
+            self.stopped = True
+            self.request.unregisterProducer()
+            self.request.finish()
+            self.openfile.release()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def stopProducing(self):
+        if not self.stopped:
+            self.stopped = True
+            self.openfile.release()
+
+
+class ImmutableFile(Resource):
+    """Serves a content-addressed file (loose object, pack or index)
+
+    The content never changes for a given name, so the ETag is derived
+    from the name. Single byte ranges are supported so interrupted
+    downloads of large packs can be resumed. If a BandwidthShaper is
+    given, the file is sent within its limits for username and
+    repository."""
+    isLeaf = True
+
+    def __init__(self, fs_path, content_type, etag, open_files=None,
+                 shaper=None, username=None, repository=None):
+        Resource.__init__(self)
+        self.fs_path = fs_path
+        self.content_type = content_type
+        self.etag = '"%s"' % etag
+        self.open_files = open_files
+        self.shaper = shaper
+        self.username = username
+        self.repository = repository
+
+    def render_GET(self, request):
+        request.setHeader('Accept-Ranges', 'bytes')
+        if request.setETag(self.etag) == CACHED:
+            return ''
+
+        try:
+            if self.open_files is not None:
+                openfile = self.open_files.open(self.fs_path)
+            else:
+                openfile = OpenFile(self.fs_path, cached=False).acquire()
+        except EnvironmentError:
+            return NoResource().render(request)
+
+        size = openfile.size
+        first, last = 0, size - 1
+        requested = request.getHeader('range')
+        if_range = request.getHeader('if-range')
+        if requested is not None and if_range not in (None, self.etag):
+            requested = None  # the client has a different version
+
+        if requested is not None:
+            try:
+                byte_range = parse_range(requested, size)
+            except ValueError:
+                openfile.release()
+                request.setResponseCode(REQUESTED_RANGE_NOT_SATISFIABLE)
+                request.setHeader('Content-Range', 'bytes */%d' % size)
+                return ''
+            if byte_range is not None:
+                first, last = byte_range
+                request.setResponseCode(PARTIAL_CONTENT)
+                request.setHeader('Content-Range',
+                                  'bytes %d-%d/%d' % (first, last, size))
+
+        length = last - first + 1
+        request.setHeader('Content-Type', self.content_type)
+        request.setHeader('Content-Length', str(length))
+        if request.method == 'HEAD' or length == 0:
+            openfile.release()
+            return ''
+
+        output = request
+        if self.shaper is not None:
+            output = self.shaper.shape(request, self.username,
+                                       request.getClientIP(), self.repository)
+
+        MmapProducer(output, openfile, first, length).start()
+        return NOT_DONE_YET
+
+    render_HEAD = render_GET
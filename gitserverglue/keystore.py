@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+from twisted.conch.ssh import keys
+from twisted.internet import reactor
+from twisted.python import log
+
+from gitserverglue.common import WatchedFile
+
+
+class PublicKeyStore(object):
+    """Index of a file with lines of the form username: public key
+
+    Keys are indexed by their blob, so checking an offered key is a
+    dict lookup. The file is read again once it changed, but only keys
+    which were not in the file before are parsed."""
+
+    def __init__(self, keys_file, check_interval=2, clock=reactor):
+        self.keys_file = keys_file
+        self.watched = WatchedFile(keys_file, check_interval, clock)
+        self.reloads = 0
+
+        self._users = {}  # key blob -> frozenset of users
+        self._blobs = {}  # key as written in the file -> key blob
+        self.reload_if_changed()
+
+    def reload_if_changed(self):
+        if not self.watched.changed():
+            return
+
+        try:
+            with open(self.keys_file, 'rb') as f:
+                lines = f.readlines()
+        except IOError:
+            lines = []
+
+        users = {}
+        blobs = {}
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                user, key = line.split(':', 1)
+                key = key.strip()
+                blob = self._blobs.get(key)
+                if blob is None:
+                    blob = keys.Key.fromString(data=key).blob()
+            except:
+                log.err(None, "Loading key failed")
+                continue
+            blobs[key] = blob
+            users.setdefault(blob, set()).add(user.strip())
+
+        self._users = dict((blob, frozenset(u)) for blob, u in users.items())
+        self._blobs = blobs
+        self.reloads += 1
+
+    def users(self, keyblob):
+        """Get the users which may log in with a key"""
+        self.reload_if_changed()
+        return self._users.get(keyblob, frozenset())
+
+    def allowed(self, username, keyblob):
+        return username in self.users(keyblob)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+import os
+import re
+
+from twisted.internet import reactor
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python import log
+from twisted.python.procutils import which
+
+LOOSE_OBJECT = re.compile(r'^[0-9a-f]{38}$')
+
+
+def estimate_loose_objects(repo_path):
+    """Estimate the number of loose objects of a repository from one of
+    the 256 object directories, like git gc --auto does"""
+    try:
+        names = os.listdir(os.path.join(repo_path, 'objects', '17'))
+    except OSError:
+        return 0
+    return 256 * len([n for n in names if LOOSE_OBJECT.match(n)])
+
+
+def count_packs(repo_path):
+    try:
+        names = os.listdir(os.path.join(repo_path, 'objects', 'pack'))
+    except OSError:
+        return 0
+    return len([n for n in names if n.endswith('.pack')])
+
+
+class MaintenanceRun(ProcessProtocol):
+    """Runs the git commands of a maintenance one after the other"""
+
+    def __init__(self, scheduler, repo_path, tasks):
+        self.scheduler = scheduler
+        self.repo_path = repo_path
+        self.tasks = list(tasks)
+        self.failed = False
+        self._errors = []
+        self._task = None
+
+    def start(self):
+        if not self.tasks:
+            return self.scheduler._runEnded(self)
+
+        self._task = self.tasks.pop(0)
+        self._errors = []
+        args = self.scheduler.command(self._task)
+        try:
+            reactor.spawnProcess(self, args[0], args, {}, path=self.repo_path)
+        except Exception as e:
+            log.msg("Maintenance of %s failed: %s" % (self.repo_path, e))
+            self.failed = True
+            self.scheduler._runEnded(self)
+
+    def errReceived(self, data):
+        self._errors.append(data)
+
+    def processEnded(self, reason):
+        if reason.value.exitCode != 0:
+            log.msg("git %s in %s failed: %s" % (
+                        ' '.join(self._task), self.repo_path,
+                        ''.join(self._errors).strip()))
+            self.failed = True
+        self.start()
+
+
+class MaintenanceScheduler(object):
+    """Keeps repositories fast to serve with maintenance after pushes
+
+    A while (delay seconds) after a push, the commit-graph of the
+    repository is updated incrementally and update-server-info run for
+    dumb HTTP clients. After repack_pushes pushes, or once there are
+    about loose_objects loose objects or max_packs packs, the objects
+    are also repacked incrementally (geometric repack with a multi-pack
+    index and bitmaps, needs git 2.34) and loose refs packed.
+
+    At most concurrency repositories are maintained at once, at the
+    lowest CPU and I/O priority if nice and ionice are available. The
+    task lists are class attributes to adapt them to a git version."""
+
+    repack = ['repack', '-d', '-q', '--geometric=2', '--write-midx',
+              '--write-bitmap-index']
+    pack_refs = ['pack-refs', '--all']
+    commit_graph = ['commit-graph', 'write', '--reachable', '--split',
+                    '--no-progress']
+    update_server_info = ['update-server-info']
+
+    def __init__(self, git_binary='git', concurrency=1, delay=30,
+                 repack_pushes=20, loose_objects=1000, max_packs=20,
+                 low_priority=True, clock=reactor):
+        self.git_binary = git_binary
+        self.concurrency = concurrency
+        self.delay = delay
+        self.repack_pushes = repack_pushes
+        self.loose_objects = loose_objects
+        self.max_packs = max_packs
+        self.clock = clock
+
+        self.prefix = []
+        if low_priority:
+            # ionice -t: run anyway if the I/O priority cannot be set
+            for cmd in (['nice', '-n', '19'], ['ionice', '-c', '3', '-t']):
+                found = which(cmd[0])
+                if found:
+                    self.prefix += [found[0]] + cmd[1:]
+
+        self.runs = 0
+        self.failures = 0
+        self._pushes = {}  # repo_path -> pushes since the last repack
+        self._delayed = {}  # repo_path -> DelayedCall of the next run
+        self._queue = []
+        self._running = {}  # repo_path -> MaintenanceRun
+        self._again = set()  # pushed to while running
+
+    @property
+    def running(self):
+        return len(self._running)
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    def repository_updated(self, repo_path):
+        """Count a push to a repository and schedule its maintenance"""
+        self._pushes[repo_path] = self._pushes.get(repo_path, 0) + 1
+        if repo_path in self._running:
+            self._again.add(repo_path)
+        else:
+            self._schedule(repo_path)
+
+    def command(self, task):
+        """Get the command line running a task"""
+        return self.prefix + [self.git_binary] + task
+
+    def tasks(self, repo_path):
+        """Get the tasks to run on a repository now"""
+        tasks = []
+        if (self._pushes.get(repo_path, 0) >= self.repack_pushes or
+                estimate_loose_objects(repo_path) >= self.loose_objects or
+                count_packs(repo_path) >= self.max_packs):
+            tasks += [self.repack, self.pack_refs]
+        return tasks + [self.commit_graph, self.update_server_info]
+
+    def _schedule(self, repo_path):
+        # a run a while after the first of several pushes
+        if repo_path not in self._delayed and repo_path not in self._queue:
+            self._delayed[repo_path] = self.clock.callLater(
+                                        self.delay, self._due, repo_path)
+
+    def _due(self, repo_path):
+        del self._delayed[repo_path]
+        self._queue.append(repo_path)
+        self._next()
+
+    def _next(self):
+        while self._queue and len(self._running) < self.concurrency:
+            repo_path = self._queue.pop(0)
+            if not os.path.isdir(repo_path):
+                continue
+
+            tasks = self.tasks(repo_path)
+            if self.repack in tasks:
+                self._pushes[repo_path] = 0
+
+            log.msg("Maintaining %s: %s" % (repo_path, ', '.join(
+                        ' '.join(task[:2]) for task in tasks)))
+            run = MaintenanceRun(self, repo_path, tasks)
+            self._running[repo_path] = run
+            run.start()
+
+    def _runEnded(self, run):
+        del self._running[run.repo_path]
+        self.runs += 1
+        if run.failed:
+            self.failures += 1
+        if run.repo_path in self._again:
+            self._again.discard(run.repo_path)
+            self._schedule(run.repo_path)
+        self.clock.callLater(0, self._next)
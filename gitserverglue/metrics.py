@@ -0,0 +1,625 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+"""Counters, gauges and histograms exported in the Prometheus text format
+
+All values are only updated from the reactor thread, so they are plain
+attributes without any locking."""
+
+import os
+import sys
+import time
+import bisect
+from collections import OrderedDict
+
+from zope.interface import implements
+from twisted.internet import defer
+from twisted.internet.interfaces import IHalfCloseableProtocol
+from twisted.protocols.policies import ProtocolWrapper, WrappingFactory
+from twisted.python.failure import Failure
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+
+def _find_monotonic():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    if not sys.platform.startswith('linux'):
+        return time.time
+
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long),
+                        ('tv_nsec', ctypes.c_long)]
+
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or
+                            ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    except (ImportError, OSError, AttributeError):
+        return time.time
+
+    CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+
+# seconds from an arbitrary starting point, not affected by clock changes
+monotonic = _find_monotonic()
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+RUNTIME_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300,
+                   600, 1800)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join(
+                '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                             .replace('"', r'\"').replace('\n', r'\n'))
+                for name, value in zip(names, values))
+
+
+class Value(object):
+    """A single counter or gauge value"""
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class HistogramValue(object):
+    """Observations of a single histogram, counted per bucket"""
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Metric(object):
+    """A named metric with a value per combination of label values"""
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def labels(self, *labelvalues):
+        """Get the value for the given label values, look it up once
+        and keep it if it is updated often"""
+        value = self._values.get(labelvalues)
+        if value is None:
+            if len(labelvalues) != len(self.labelnames):
+                raise ValueError("%s expects labels %r" % (self.name,
+                                                          self.labelnames))
+            value = self._values[labelvalues] = self._newValue()
+        return value
+
+    def _newValue(self):
+        return Value()
+
+    def samples(self):
+        """Iterate over (suffix, label names, label values, value)"""
+        for labelvalues, value in sorted(self._values.items()):
+            yield '', self.labelnames, labelvalues, value.value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for suffix, names, values, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix,
+                                        _format_labels(names, values),
+                                        _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    type = 'counter'
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _newValue(self):
+        return HistogramValue(self.buckets)
+
+    def samples(self):
+        names = self.labelnames + ('le',)
+        for labelvalues, value in sorted(self._values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),),
+                                    value.counts):
+                total += count
+                yield ('_bucket', names,
+                       labelvalues + (_format_value(bound),), total)
+            yield '_sum', self.labelnames, labelvalues, value.sum
+            yield '_count', self.labelnames, labelvalues, total
+
+
+class CallbackMetric(Metric):
+    """A metric read from elsewhere when the metrics are collected
+
+    func returns a single value or, if there are labels, a dict
+    mapping tuples of label values to values."""
+
+    def __init__(self, name, help, type, func, labelnames=()):
+        Metric.__init__(self, name, help, labelnames)
+        self.type = type
+        self.func = func
+
+    def samples(self):
+        values = self.func()
+        if not self.labelnames:
+            values = {(): values}
+        for labelvalues, value in sorted(values.items()):
+            yield '', self.labelnames, labelvalues, value
+
+
+class Registry(object):
+    """Collection of the metrics of a process"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name, help, type, func, labelnames=()):
+        return self.register(CallbackMetric(name, help, type, func,
+                                            labelnames))
+
+    def render(self):
+        """Get all metrics in the Prometheus text exposition format"""
+        return ''.join(metric.render() for metric in self.metrics)
+
+
+def _parse_value(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def sum_rendered(texts):
+    """Sum up the samples of several Registry.render() results, e.g.
+    of the same registry in several processes"""
+    families = OrderedDict()  # name -> (comment lines, samples)
+    for text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# '):
+                name = line.split(' ', 3)[2]
+                family = families.setdefault(name, ([], OrderedDict()))
+                if line not in family[0]:
+                    family[0].append(line)
+            elif line and family is not None:
+                key, _, value = line.rpartition(' ')
+                family[1][key] = family[1].get(key, 0) + _parse_value(value)
+
+    lines = []
+    for comments, samples in families.values():
+        lines.extend(comments)
+        lines.extend('%s %s' % (key, _format_value(value))
+                     for key, value in samples.items())
+    return ''.join(line + '\n' for line in lines)
+
+
+class RequestMetrics(object):
+    """Timings of a single request, see ServerMetrics.request"""
+
+    process_start = None
+
+    def __init__(self, metrics, protocol, rpc):
+        self.metrics = metrics
+        self.protocol = protocol
+        self.rpc = rpc
+        self.start = monotonic()
+        self.waiting = True
+        metrics.requests.labels(protocol, rpc).inc()
+
+    def first_byte(self):
+        """Call whenever data is sent, only the first call is recorded"""
+        if self.waiting:
+            self.waiting = False
+            self.metrics.first_byte_seconds.labels(
+                    self.protocol, self.rpc).observe(monotonic() - self.start)
+
+    def watch(self, request):
+        """Record the first byte written to a twisted.web request"""
+        write = request.write
+
+        def firstWrite(data):
+            del request.write  # back to the method of the class
+            self.first_byte()
+            write(data)
+        request.write = firstWrite
+
+    def process_started(self):
+        self.process_start = monotonic()
+
+    def process_ended(self, reason):
+        """Record the runtime and exit code, reason as in processEnded"""
+        if self.process_start is None:
+            return
+        runtime = monotonic() - self.process_start
+        self.process_start = None
+
+        code = getattr(reason.value, 'exitCode', None)
+        if code is None:
+            code = 'signal'
+        self.metrics.process_seconds.labels(self.protocol,
+                                            self.rpc).observe(runtime)
+        self.metrics.process_exits.labels(self.protocol, self.rpc,
+                                          code).inc()
+
+
+class UntrackedRequest(object):
+    """Stands in for RequestMetrics if no metrics are collected"""
+
+    def first_byte(self):
+        pass
+
+    def watch(self, request):
+        pass
+
+    def process_started(self):
+        pass
+
+    def process_ended(self, reason):
+        pass
+
+
+untracked = UntrackedRequest()
+
+
+def track_request(git_configuration, protocol, rpc):
+    """Get the RequestMetrics for a new request or untracked if
+    git_configuration has no metrics"""
+    metrics = getattr(git_configuration, 'metrics', None)
+    if metrics is None:
+        return untracked
+    return metrics.request(protocol, rpc)
+
+
+class MeteredProtocol(ProtocolWrapper):
+    """Counts the connection and the bytes passing through it"""
+    implements(IHalfCloseableProtocol)
+
+    def __init__(self, factory, wrappedProtocol):
+        ProtocolWrapper.__init__(self, factory, wrappedProtocol)
+        self.received = factory.received
+        self.sent = factory.sent
+
+    def makeConnection(self, transport):
+        self.factory.accepted.inc()
+        self.factory.open.inc()
+        ProtocolWrapper.makeConnection(self, transport)
+
+    def dataReceived(self, data):
+        self.received.inc(len(data))
+        ProtocolWrapper.dataReceived(self, data)
+
+    def write(self, data):
+        self.sent.inc(len(data))
+        ProtocolWrapper.write(self, data)
+
+    def writeSequence(self, data):
+        self.sent.inc(sum(len(d) for d in data))
+        ProtocolWrapper.writeSequence(self, data)
+
+    def connectionLost(self, reason):
+        self.factory.open.dec()
+        ProtocolWrapper.connectionLost(self, reason)
+
+    # IHalfCloseableProtocol, if the wrapped protocol supports it
+    def readConnectionLost(self):
+        wrapped = IHalfCloseableProtocol(self.wrappedProtocol, None)
+        if wrapped is None:
+            self.transport.loseConnection()
+        else:
+            wrapped.readConnectionLost()
+
+    def writeConnectionLost(self):
+        wrapped = IHalfCloseableProtocol(self.wrappedProtocol, None)
+        if wrapped is not None:
+            wrapped.writeConnectionLost()
+
+
+class MeteredFactory(WrappingFactory):
+    protocol = MeteredProtocol
+
+    def __init__(self, wrappedFactory, metrics, protocol):
+        WrappingFactory.__init__(self, wrappedFactory)
+        self.accepted = metrics.connections.labels(protocol)
+        self.open = metrics.open_connections.labels(protocol)
+        self.received = metrics.bytes_received.labels(protocol)
+        self.sent = metrics.bytes_sent.labels(protocol)
+
+
+class ServerMetrics(object):
+    """The metrics of the git, HTTP and SSH servers
+
+    Set as git_configuration.metrics to record requests, auth and
+    path_lookup latencies and git processes. Connections and bytes
+    are counted for factories wrapped with wrap_factory."""
+
+    def __init__(self, registry=None):
+        if registry is None:
+            registry = Registry()
+        self.registry = registry
+
+        self.connections = registry.counter(
+                'gitserverglue_connections_total',
+                'Accepted connections', ['protocol'])
+        self.open_connections = registry.gauge(
+                'gitserverglue_open_connections',
+                'Currently open connections', ['protocol'])
+        self.bytes_received = registry.counter(
+                'gitserverglue_received_bytes_total',
+                'Bytes received from clients', ['protocol'])
+        self.bytes_sent = registry.counter(
+                'gitserverglue_sent_bytes_total',
+                'Bytes sent to clients', ['protocol'])
+        self.requests = registry.counter(
+                'gitserverglue_requests_total',
+                'Requests by protocol and RPC', ['protocol', 'rpc'])
+        self.first_byte_seconds = registry.histogram(
+                'gitserverglue_first_byte_seconds',
+                'Time from a request to the first byte of its response',
+                ['protocol', 'rpc'])
+        self.auth_seconds = registry.histogram(
+                'gitserverglue_auth_seconds',
+                'Time taken to check credentials',
+                ['protocol', 'method', 'result'])
+        self.path_lookup_seconds = registry.histogram(
+                'gitserverglue_path_lookup_seconds',
+                'Time taken by path_lookup', ['protocol'])
+        self.process_seconds = registry.histogram(
+                'gitserverglue_git_process_seconds',
+                'Runtime of git processes', ['protocol', 'rpc'],
+                RUNTIME_BUCKETS)
+        self.process_exits = registry.counter(
+                'gitserverglue_git_process_exits_total',
+                'Ended git processes by exit code',
+                ['protocol', 'rpc', 'code'])
+
+    def open_connection_count(self):
+        """Get the number of open connections of all wrapped factories"""
+        return sum(value.value
+                   for value in self.open_connections._values.values())
+
+    def request(self, protocol, rpc):
+        """Count a request and get the RequestMetrics to time it"""
+        return RequestMetrics(self, protocol, rpc)
+
+    def wrap_factory(self, factory, protocol):
+        """Count the connections and bytes of a server factory"""
+        return MeteredFactory(factory, self, protocol)
+
+    def timed_check(self, check, protocol, method):
+        """Wrap a credentials check returning a bool or a Deferred"""
+        def timed(*args):
+            start = monotonic()
+
+            def done(result):
+                if isinstance(result, Failure):
+                    outcome = 'error'
+                elif result:
+                    outcome = 'success'
+                else:
+                    outcome = 'failure'
+                self.auth_seconds.labels(protocol, method, outcome).observe(
+                                                        monotonic() - start)
+                return result
+            return defer.maybeDeferred(check, *args).addBoth(done)
+        return timed
+
+    def timed_path_lookup(self, path_lookup):
+        """Wrap a path_lookup implementation"""
+        def timed(url, protocol_hint=None):
+            start = monotonic()
+
+            def done(result):
+                self.path_lookup_seconds.labels(protocol_hint).observe(
+                                                        monotonic() - start)
+                return result
+            try:
+                result = path_lookup(url, protocol_hint=protocol_hint)
+            except Exception:
+                done(None)
+                raise
+            if isinstance(result, defer.Deferred):
+                return result.addBoth(done)
+            return done(result)
+        return timed
+
+    def watch_scheduler(self, scheduler):
+        """Export the state of a ProcessScheduler"""
+        self.registry.callback('gitserverglue_git_processes_running',
+                               'Running git processes', 'gauge',
+                               lambda: scheduler.running)
+        self.registry.callback('gitserverglue_git_processes_queued',
+                               'Requests waiting for a process slot',
+                               'gauge', lambda: scheduler.queued)
+        self.registry.callback('gitserverglue_git_processes_rejected_total',
+                               'Requests rejected as the server was busy',
+                               'counter', lambda: scheduler.rejected)
+
+    def watch_shaper(self, shaper):
+        """Export the state of a BandwidthShaper"""
+        self.registry.callback('gitserverglue_responses_throttled',
+                               'Responses waiting for bandwidth', 'gauge',
+                               lambda: shaper.waiting)
+        self.registry.callback('gitserverglue_responses_throttled_total',
+                               'Times a response had to wait for bandwidth',
+                               'counter', lambda: shaper.throttled)
+
+    def watch_maintenance(self, scheduler):
+        """Export the state of a MaintenanceScheduler"""
+        self.registry.callback('gitserverglue_maintenance_running',
+                               'Repositories being maintained', 'gauge',
+                               lambda: scheduler.running)
+        self.registry.callback('gitserverglue_maintenance_queued',
+                               'Repositories waiting for maintenance',
+                               'gauge', lambda: scheduler.queued)
+        self.registry.callback('gitserverglue_maintenance_runs_total',
+                               'Completed maintenance runs', 'counter',
+                               lambda: scheduler.runs)
+        self.registry.callback('gitserverglue_maintenance_failures_total',
+                               'Maintenance runs with a failed task',
+                               'counter', lambda: scheduler.failures)
+
+    def watch_bundles(self, bundle_store):
+        """Export the counters of a BundleStore"""
+        self.registry.callback('gitserverglue_bundles_created_total',
+                               'Clone bundles created', 'counter',
+                               lambda: bundle_store.created)
+        self.registry.callback('gitserverglue_bundles_failed_total',
+                               'Clone bundles which could not be created',
+                               'counter', lambda: bundle_store.failed)
+
+    def watch_backends(self, pool):
+        """Export the state of a BackendPool"""
+        self.registry.callback('gitserverglue_backends_healthy',
+                               'Backend nodes accepting connections',
+                               'gauge', lambda: pool.healthy)
+        self.registry.callback('gitserverglue_backend_failovers_total',
+                               'Requests retried on another backend node',
+                               'counter', lambda: pool.failovers)
+
+    def watch_timeouts(self, timeouts):
+        """Export the counters of Timeouts"""
+        self.registry.callback('gitserverglue_timeouts_total',
+                               'Connections dropped by timeout', 'counter',
+                               lambda: dict(((kind,), n) for kind, n in
+                                            timeouts.expirations.items()),
+                               ['timeout'])
+        self.registry.callback('gitserverglue_timeout_kills_total',
+                               'Git processes killed by timeouts', 'counter',
+                               lambda: timeouts.kills)
+        self.registry.callback('gitserverglue_timers',
+                               'Connections with a pending timeout',
+                               'gauge', lambda: len(timeouts.wheel))
+
+    def watch_mirrors(self, mirrors):
+        """Export the state of a MirrorManager"""
+        self.registry.callback('gitserverglue_mirror_fetches_running',
+                               'Fetches from upstream repositories running',
+                               'gauge', lambda: mirrors.running)
+        self.registry.callback('gitserverglue_mirror_requests_waiting',
+                               'Requests waiting for a mirror to be '
+                               'refreshed', 'gauge', lambda: mirrors.waiting)
+        self.registry.callback('gitserverglue_mirror_fetches_total',
+                               'Completed fetches from upstream repositories',
+                               'counter', lambda: mirrors.fetches)
+        self.registry.callback('gitserverglue_mirror_failures_total',
+                               'Failed fetches from upstream repositories',
+                               'counter', lambda: mirrors.failures)
+
+    def watch_authz(self, authnz):
+        """Export the state of a CachingAuthnz"""
+        self.registry.callback('gitserverglue_authz_checks_pending',
+                               'Permission checks in flight', 'gauge',
+                               lambda: len(authnz.coalescer))
+        self.registry.callback('gitserverglue_authz_checks_coalesced_total',
+                               'Permission checks answered by a check '
+                               'already in flight', 'counter',
+                               lambda: authnz.coalescer.coalesced)
+        self.registry.callback('gitserverglue_authz_cache_hits_total',
+                               'Permission checks answered from the cache',
+                               'counter', lambda: authnz.hits)
+        self.registry.callback('gitserverglue_authz_cache_misses_total',
+                               'Permission checks not answered from the '
+                               'cache', 'counter', lambda: authnz.misses)
+
+
+class MetricsResource(Resource):
+    """Serves a Registry in the Prometheus text format"""
+    isLeaf = True
+
+    def __init__(self, registry):
+        Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type',
+                          'text/plain; version=0.0.4; charset=utf-8')
+        return self.registry.render()
+
+
+def create_admin_factory(metrics):
+    """Site serving /metrics, meant for a separate (internal) port"""
+    root = Resource()
+    root.putChild('metrics', MetricsResource(metrics.registry))
+    return Site(root)
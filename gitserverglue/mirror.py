@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+"""Read-through mirrors of upstream repositories, see MirrorManager"""
+
+import os
+import shutil
+import tempfile
+
+from twisted.internet import reactor, defer
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python import log
+
+from gitserverglue.common import repository_updated
+from gitserverglue.refs import ref_state_fingerprint
+
+
+class MirrorUnavailable(Exception):
+    """A mirror does not exist and could not be created"""
+
+
+class MirrorFetch(ProcessProtocol):
+    """Runs git clone --mirror or git fetch for MirrorManager"""
+
+    timeoutCall = None
+
+    def __init__(self, manager, mirror_path, upstream_url):
+        self.manager = manager
+        self.mirror_path = mirror_path
+        self.upstream_url = upstream_url
+        self.waiting = []
+        self.errors = []
+        self.tmpdir = None  # the clone of a new mirror
+
+    def wait(self):
+        """Get a Deferred firing once the fetch is done"""
+        d = defer.Deferred(self.waiting.remove)
+        self.waiting.append(d)
+        return d
+
+    def errReceived(self, data):
+        self.errors.append(data)
+
+    def processEnded(self, reason):
+        if self.timeoutCall is not None and self.timeoutCall.active():
+            self.timeoutCall.cancel()
+        self.manager._fetchEnded(self, reason.value.exitCode,
+                                 ''.join(self.errors).strip())
+
+    def timedOut(self):
+        self.errors.append('timed out')
+        try:
+            self.transport.signalProcess('KILL')
+        except ProcessExitedAlready:
+            pass
+
+
+class MirrorManager(object):
+    """Keeps local bare mirrors of upstream repositories fresh
+
+    A path_lookup returns the URL of the upstream repository as
+    'repository_upstream' together with the path of its mirror as
+    'repository_fs_path'. Before a read is served from the mirror,
+    refresh fetches from upstream if the last fetch is more than ttl
+    seconds ago (a missing mirror is cloned). Requests arriving during
+    a fetch wait for the same fetch.
+
+    At most concurrency fetches run at once, the others are queued.
+    Fetches are killed after timeout seconds. After a failed fetch,
+    upstream is not asked again for retry_interval seconds and the
+    mirror is served as it is, stale."""
+
+    def __init__(self, git_binary='git', ttl=60, concurrency=2,
+                 timeout=600, retry_interval=60, git_configuration=None,
+                 clock=reactor):
+        self.git_binary = git_binary
+        self.ttl = ttl
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.git_configuration = git_configuration
+        self.clock = clock
+
+        self.fetches = 0
+        self.failures = 0
+        self._failed = {}  # mirror_path -> time of the last failure
+        self._pending = {}  # mirror_path -> MirrorFetch
+        self._queue = []
+        self._running = 0
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def waiting(self):
+        return sum(len(f.waiting) for f in self._pending.values())
+
+    def refresh(self, mirror_path, upstream_url):
+        """Get a Deferred firing once the mirror can be served, failing
+        with MirrorUnavailable if there is none"""
+        exists = os.path.isdir(mirror_path)
+        now = self.clock.seconds()
+        if exists and now - self.last_fetch(mirror_path) < self.ttl:
+            return defer.succeed(None)
+
+        fetch = self._pending.get(mirror_path)
+        if fetch is None:
+            failed = self._failed.get(mirror_path)
+            if failed is not None and now - failed < self.retry_interval:
+                if exists:
+                    return defer.succeed(None)  # stale
+                return defer.fail(MirrorUnavailable(
+                            "Cannot fetch %s" % upstream_url))
+
+            fetch = MirrorFetch(self, mirror_path, upstream_url)
+            self._pending[mirror_path] = fetch
+            self._queue.append(fetch)
+            self._next()
+        return fetch.wait()
+
+    def last_fetch(self, mirror_path):
+        """Get the time of the last fetch into a mirror, also by another
+        process, 0 if unknown"""
+        try:
+            # touched by each fetch, see _succeeded
+            return os.stat(os.path.join(mirror_path, 'FETCH_HEAD')).st_mtime
+        except OSError:
+            return 0
+
+    def command(self, fetch):
+        """Get the command line of a fetch"""
+        git = os.path.basename(self.git_binary)
+        if fetch.tmpdir is not None:
+            return [git, 'clone', '--mirror', '--quiet', fetch.upstream_url,
+                    fetch.tmpdir]
+        return [git, 'fetch', '--prune', '--quiet', fetch.upstream_url,
+                '+refs/*:refs/*']
+
+    def _next(self):
+        while self._queue and self._running < self.concurrency:
+            fetch = self._queue.pop(0)
+            path = fetch.mirror_path
+            if not os.path.isdir(path):
+                parent = os.path.dirname(os.path.abspath(path))
+                if not os.path.isdir(parent):
+                    os.makedirs(parent)
+                fetch.tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=parent)
+                path = parent
+
+            log.msg("Fetching %s into %s" % (fetch.upstream_url,
+                                             fetch.mirror_path))
+            fetch.fingerprint = ref_state_fingerprint(fetch.mirror_path)
+            self._running += 1
+            try:
+                # inherits the environment, e.g. for ssh upstreams
+                reactor.spawnProcess(fetch, self.git_binary,
+                                     self.command(fetch), None, path=path)
+            except Exception as e:
+                self._fetchEnded(fetch, None, str(e))
+                continue
+            fetch.timeoutCall = self.clock.callLater(self.timeout,
+                                                     fetch.timedOut)
+
+    def _fetchEnded(self, fetch, exit_code, errors):
+        self._running -= 1
+        del self._pending[fetch.mirror_path]
+        self.fetches += 1
+
+        if exit_code == 0 and fetch.tmpdir is not None:
+            try:
+                os.rename(fetch.tmpdir, fetch.mirror_path)
+            except OSError as e:
+                exit_code = None  # e.g. created by another process
+                errors = str(e)
+        if fetch.tmpdir is not None and os.path.isdir(fetch.tmpdir):
+            shutil.rmtree(fetch.tmpdir, ignore_errors=True)
+
+        if exit_code == 0:
+            self._succeeded(fetch)
+        else:
+            self._failed[fetch.mirror_path] = self.clock.seconds()
+            self.failures += 1
+            log.msg("Fetching %s failed: %s" % (fetch.upstream_url, errors))
+
+        available = os.path.isdir(fetch.mirror_path)
+        for d in list(fetch.waiting):
+            if available:
+                d.callback(None)
+            else:
+                d.errback(MirrorUnavailable("Cannot fetch %s" %
+                                            fetch.upstream_url))
+        self.clock.callLater(0, self._next)
+
+    def _succeeded(self, fetch):
+        self._failed.pop(fetch.mirror_path, None)
+        try:
+            # the time of this fetch, git clone writes no FETCH_HEAD
+            f = open(os.path.join(fetch.mirror_path, 'FETCH_HEAD'), 'a')
+            f.close()
+            os.utime(os.path.join(fetch.mirror_path, 'FETCH_HEAD'), None)
+        except (IOError, OSError):
+            pass
+
+        if self.git_configuration is not None and \
+                ref_state_fingerprint(fetch.mirror_path) != fetch.fingerprint:
+            repository_updated(self.git_configuration, fetch.mirror_path)
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+import os
+import os.path
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+from twisted.python import log
+
+from gitserverglue.pktline import iter_payloads
+
+
+def normalize_upload_request(data):
+    """Get the canonical form of an upload-pack request
+
+    Only requests without any haves and terminated by done (i.e.
+    fresh clones) are considered cacheable, None is returned for
+    everything else. Capabilities that do not influence the
+    response such as agent= are dropped and everything is sorted.
+    Protocol v2 fetch commands are handled alike, their arguments
+    (command=fetch, thin-pack etc.) are kept as they are."""
+    wants, caps, other = set(), set(), []
+    done = False
+
+    try:
+        for line in iter_payloads(data):
+            if line is None:
+                continue
+            line = line.rstrip('\n')
+            if line.startswith('want '):
+                parts = line.split(' ')
+                wants.add(parts[1])
+                caps.update(c for c in parts[2:]
+                            if not c.startswith(('agent=', 'session-id=')))
+            elif line.startswith('have '):
+                return None
+            elif line == 'done':
+                done = True
+            elif line.startswith(('agent=', 'session-id=')):
+                continue  # protocol v2 capabilities
+            else:
+                other.append(line)  # shallow, deepen, filter etc.
+    except ValueError:
+        return None
+
+    if not done or not wants:
+        return None
+
+    return '\n'.join(sorted(wants) + sorted(caps) + sorted(other))
+
+
+class PackCacheWriter(object):
+    """Collects a response into a temporary file of the cache"""
+
+    def __init__(self, cache, key, repo_id):
+        self.cache = cache
+        self.key = key
+        self.repo_id = repo_id
+        self.generation = cache._generations.get(repo_id, 0)
+        self.size = 0
+
+        fd, self.tmpname = tempfile.mkstemp(prefix='.tmp-',
+                                            dir=cache._repo_dir(repo_id))
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        if self.file is None:
+            return
+        self.file.write(data)
+        self.size += len(data)
+        if self.size > self.cache.max_entry_size:
+            self.abort()
+
+    def commit(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        self.cache._add(self)
+
+    def abort(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        try:
+            os.unlink(self.tmpname)
+        except OSError:
+            pass
+
+
+class PackCache(object):
+    """Content-addressed on-disk cache of git-upload-pack responses
+
+    Entries are keyed by the ref state of the repository, the protocol
+    and the normalized request. The total size of the cache is bounded
+    and least recently used entries are evicted first. Entries of a
+    repository are dropped when a push to it completes."""
+
+    def __init__(self, directory, max_size=2 * 1024 ** 3,
+                 max_entry_size=512 * 1024 ** 2):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_size = 0
+
+        self._entries = OrderedDict()  # key -> (fs_path, size, repo_id)
+        self._generations = {}
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._scan()
+
+    def _scan(self):
+        found = []
+        for repo_id in os.listdir(self.directory):
+            repo_dir = os.path.join(self.directory, repo_id)
+            if not os.path.isdir(repo_dir):
+                continue
+            for filename in os.listdir(repo_dir):
+                fs_path = os.path.join(repo_dir, filename)
+                if filename.startswith('.tmp-'):
+                    os.unlink(fs_path)
+                elif filename.endswith('.pack'):
+                    st = os.stat(fs_path)
+                    found.append((st.st_mtime, filename[:-5], fs_path,
+                                  st.st_size, repo_id))
+
+        for unused_mtime, key, fs_path, size, repo_id in sorted(found):
+            self._entries[key] = (fs_path, size, repo_id)
+            self.total_size += size
+        self._evict()
+
+    def _repo_id(self, repo_path):
+        return hashlib.sha1(os.path.abspath(repo_path)).hexdigest()
+
+    def _repo_dir(self, repo_id):
+        repo_dir = os.path.join(self.directory, repo_id)
+        if not os.path.isdir(repo_dir):
+            os.makedirs(repo_dir)
+        return repo_dir
+
+    def make_key(self, repo_path, protocol, fingerprint, request):
+        """Get the cache key for a request or None if it is not cacheable"""
+        normalized = normalize_upload_request(request)
+        if normalized is None:
+            return None
+        return hashlib.sha1('\0'.join([os.path.abspath(repo_path), protocol,
+                                       fingerprint, normalized])).hexdigest()
+
+    def open(self, key):
+        """Open a cached response for reading, None if not cached"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        try:
+            f = open(entry[0], 'rb')
+        except IOError:
+            self.total_size -= entry[1]
+            self.misses += 1
+            return None
+
+        self._entries[key] = entry  # most recently used
+        self.hits += 1
+        return f
+
+    def writer(self, key, repo_path):
+        """Get a writer storing a response for key once committed"""
+        return PackCacheWriter(self, key, self._repo_id(repo_path))
+
+    def invalidate(self, repo_path):
+        """Drop all cached responses for a repository"""
+        repo_id = self._repo_id(repo_path)
+        self._generations[repo_id] = self._generations.get(repo_id, 0) + 1
+
+        for key, entry in self._entries.items():
+            if entry[2] == repo_id:
+                self._remove(key)
+
+    def _add(self, writer):
+        if self._generations.get(writer.repo_id, 0) != writer.generation:
+            # a push completed while the response was being generated
+            os.unlink(writer.tmpname)
+            return
+
+        fs_path = os.path.join(self._repo_dir(writer.repo_id),
+                               writer.key + '.pack')
+        os.rename(writer.tmpname, fs_path)
+
+        if writer.key in self._entries:
+            self.total_size -= self._entries.pop(writer.key)[1]
+        self._entries[writer.key] = (fs_path, writer.size, writer.repo_id)
+        self.total_size += writer.size
+        self._evict()
+
+    def _remove(self, key):
+        fs_path, size, unused_repo_id = self._entries.pop(key)
+        self.total_size -= size
+        try:
+            os.unlink(fs_path)
+        except OSError:
+            log.err(None, "Removing cached pack %s failed" % fs_path)
+
+    def _evict(self):
+        while self.total_size > self.max_size and self._entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
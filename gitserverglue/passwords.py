@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+import os
+import hmac
+import hashlib
+from collections import OrderedDict
+
+from twisted.internet import reactor, defer
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+from gitserverglue.metrics import monotonic
+
+
+class PasswordVerifier(object):
+    """Runs a slow password check in a thread pool and caches successes
+
+    Successful verifications are remembered for ttl seconds under an
+    HMAC of the credentials with a per-process random key, so neither
+    passwords nor plain hashes of them are kept in memory. Failed
+    verifications are never cached."""
+
+    def __init__(self, checker, threads=4, ttl=60, max_entries=10000,
+                 clock=reactor):
+        self.checker = checker
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.pool = ThreadPool(minthreads=0, maxthreads=threads,
+                               name='PasswordVerifier')
+
+        self.hits = 0
+        self.misses = 0
+        self.verifications = 0
+        self.verify_time = 0.0
+
+        self._secret = os.urandom(32)
+        self._verified = OrderedDict()  # digest -> expiry
+        self._generation = 0  # bumped by clear()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+    @property
+    def average_latency(self):
+        """Average time a verification took in the pool in seconds"""
+        if self.verifications == 0:
+            return 0.0
+        return self.verify_time / self.verifications
+
+    def verify(self, username, password):
+        """Get a Deferred firing with True if the password is correct"""
+        digest = hmac.new(self._secret, '%s\0%s' % (username, password),
+                          hashlib.sha256).digest()
+
+        expiry = self._verified.get(digest)
+        if expiry is not None and expiry > self.clock.seconds():
+            self.hits += 1
+            return defer.succeed(True)
+        self.misses += 1
+
+        if not self.pool.started:
+            self.pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown',
+                                          self.pool.stop)
+
+        d = deferToThreadPool(reactor, self.pool, self._check, username,
+                               password)
+        d.addCallback(self._checked, digest, self._generation)
+        return d
+
+    def clear(self):
+        """Forget all verified credentials, e.g. after passwords changed
+
+        Checks still running in the pool are not cached either."""
+        self._generation += 1
+        self._verified.clear()
+
+    def _check(self, username, password):
+        # runs in the pool
+        start = monotonic()
+        result = self.checker(username, password)
+        return result, monotonic() - start
+
+    def _checked(self, checked, digest, generation):
+        result, elapsed = checked
+        self.verifications += 1
+        self.verify_time += elapsed
+
+        # the check might have used passwords from before a clear()
+        if result and generation == self._generation:
+            self._verified.pop(digest, None)
+            self._verified[digest] = self.clock.seconds() + self.ttl
+            self._prune()
+        return result
+
+    def _prune(self):
+        now = self.clock.seconds()
+        while self._verified:
+            digest, expiry = next(self._verified.iteritems())
+            if expiry > now and len(self._verified) <= self.max_entries:
+                break
+            del self._verified[digest]
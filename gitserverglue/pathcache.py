@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+import os.path
+from collections import OrderedDict
+
+from twisted.internet import reactor, defer
+from twisted.python import log, filepath
+
+from gitserverglue.authcache import Coalescer
+
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None
+
+
+def git_suffix_key(url):
+    """Cache key of a url, anything after a .git path component is cut
+
+    /foo/bar.git/objects/ab/cdef and /foo/bar.git/info/refs share the
+    key foo/bar.git."""
+    parts = [p for p in url.split('/') if p]
+    for i, part in enumerate(parts):
+        if part.endswith('.git'):
+            del parts[i + 1:]
+            break
+    return '/'.join(parts)
+
+
+class CachingPathLookup(object):
+    """Memoizes a path_lookup implementation
+
+    Lookups finding a repository are cached for ttl seconds, lookups
+    finding nothing for negative_ttl seconds. The cache is bounded to
+    max_entries and least recently used entries are evicted first.
+    key_func maps a url to its cache key, the default assumes the
+    result only depends on the url up to the first .git component.
+    path_lookup may return a Deferred, concurrent lookups of the same
+    key then share one call and get a Deferred as well. If watch is
+    True and inotify is available, the lookups finding a repository
+    are dropped as soon as its directory is removed or renamed.
+    Repositories created later are only found once negative_ttl has
+    passed."""
+
+    def __init__(self, path_lookup, ttl=60, negative_ttl=5,
+                 max_entries=10000, key_func=git_suffix_key, watch=True,
+                 clock=reactor):
+        self.path_lookup = path_lookup
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.key_func = key_func
+        self.clock = clock
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self.coalescer = Coalescer()
+        self._entries = OrderedDict()  # key -> (expiry, path_info)
+        self._watched = {}  # repository path -> keys of its lookups
+        self._notifier = None
+        if watch and inotify is not None:
+            try:
+                self._notifier = inotify.INotify()
+                self._notifier.startReading()
+            except Exception:
+                log.err(None, "inotify unavailable, relying on TTLs")
+                self._notifier = None
+
+    def __call__(self, url, protocol_hint=None):
+        key = (self.key_func(url), protocol_hint)
+        now = self.clock.seconds()
+
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry[0] > now:
+            self._entries[key] = entry  # most recently used
+            if self._found(entry[1]):
+                self.hits += 1
+            else:
+                self.negative_hits += 1
+            return entry[1]
+
+        self.misses += 1
+        return self.coalescer.call(key, self._lookup, url, protocol_hint,
+                                   key)
+
+    def _lookup(self, url, protocol_hint, key):
+        path_info = self.path_lookup(url, protocol_hint=protocol_hint)
+        if isinstance(path_info, defer.Deferred):
+            return path_info.addCallback(self._store, key)
+        return self._store(path_info, key)
+
+    def _store(self, path_info, key):
+        if self._found(path_info):
+            ttl = self.ttl
+        else:
+            ttl = self.negative_ttl
+        self._entries[key] = (self.clock.seconds() + ttl, path_info)
+        while len(self._entries) > self.max_entries:
+            evicted, (expiry, evicted_info) = self._entries.popitem(last=False)
+            self.evictions += 1
+            self._unwatch(self._repository(evicted_info), evicted)
+
+        self._watch(self._repository(path_info), key)
+        return path_info
+
+    def invalidate(self):
+        """Drop all cached lookups, e.g. after repositories were added"""
+        self._entries.clear()
+        self.invalidations += 1
+        for fs_path in list(self._watched):
+            self._unwatch(fs_path)
+
+    def _found(self, path_info):
+        # proxied repositories have no local path
+        return (path_info is not None and
+                (path_info['repository_fs_path'] is not None or
+                 path_info.get('repository_backend') is not None))
+
+    def _repository(self, path_info):
+        if path_info is None or path_info['repository_fs_path'] is None:
+            return None
+        return os.path.abspath(path_info['repository_fs_path'])
+
+    def _watch(self, fs_path, key):
+        if self._notifier is None or fs_path is None:
+            return
+        if fs_path in self._watched:
+            self._watched[fs_path].add(key)
+            return
+
+        mask = inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF
+        try:
+            self._notifier.watch(filepath.FilePath(fs_path), mask,
+                                 callbacks=[self._changed])
+        except Exception:
+            log.err(None, "Watching %s failed" % fs_path)
+            return
+        self._watched[fs_path] = set([key])
+
+    def _unwatch(self, fs_path, key=None):
+        keys = self._watched.get(fs_path)
+        if keys is None:
+            return
+        keys.discard(key)
+        if key is not None and keys:
+            return
+        del self._watched[fs_path]
+        self._notifier.ignore(filepath.FilePath(fs_path))
+
+    def _changed(self, ignored, path, mask):
+        fs_path = os.path.abspath(path.path)
+        for key in self._watched.get(fs_path, ()):
+            entry = self._entries.get(key)
+            if entry is not None and self._repository(entry[1]) == fs_path:
+                del self._entries[key]
+        self.invalidations += 1
+        if mask & inotify.IN_DELETE_SELF:
+            # the watch of a removed directory is dropped by inotify
+            self._watched.pop(fs_path, None)
+        else:
+            self._unwatch(fs_path)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+"""Encoding and decoding of the pkt-line format used by the git protocols"""
+
+from collections import deque
+
+FLUSH = '0000'
+DELIM = '0001'  # protocol v2 section delimiter
+RESPONSE_END = '0002'  # protocol v2 end of a stateless response
+
+SPECIAL = {0: FLUSH, 1: DELIM, 2: RESPONSE_END}
+_special = frozenset(SPECIAL.values())
+
+# the bound GitProtocol always enforced, a little above what git sends
+MAX_PACKET_LENGTH = 65524
+MAX_PAYLOAD = MAX_PACKET_LENGTH - 4
+
+# sideband channels
+SIDEBAND_DATA, SIDEBAND_PROGRESS, SIDEBAND_ERROR = 1, 2, 3
+
+_lengths = ['%04x' % i for i in range(4, 0x1004)]  # covers short lines
+
+
+class PacketError(ValueError):
+    """Raised for malformed packet length headers"""
+
+    def __init__(self, header):
+        ValueError.__init__(self, "Invalid Paket Length: " + header)
+        self.header = header
+
+
+def encode(data=None):
+    """Format data as a pkt-line, a flush packet if data is None"""
+    if data is None:
+        return FLUSH
+    length = len(data) + 4
+    if length < 0x1004:
+        return _lengths[length - 4] + data
+    if length > MAX_PACKET_LENGTH:
+        raise ValueError("Packet too long: %d bytes" % length)
+    return '%04x%s' % (length, data)
+
+
+def encode_lines(lines, flush=True):
+    """Format many lines as pkt-lines at once, optionally followed by a
+    flush packet. None in lines is encoded as flush."""
+    out = [encode(line) for line in lines]
+    if flush:
+        out.append(FLUSH)
+    return ''.join(out)
+
+
+def sideband(channel, data):
+    """Format data as pkt-lines on a sideband channel"""
+    step = MAX_PAYLOAD - 1
+    prefix = chr(channel)
+    return ''.join(encode(prefix + data[i:i + step])
+                   for i in xrange(0, len(data), step))
+
+
+def demultiplex(packet):
+    """Split a sideband packet into its channel and data"""
+    if len(packet) < 5:
+        raise ValueError("Not a sideband packet")
+    return ord(packet[4]), packet[5:]
+
+
+class PacketDecoder(object):
+    """Incremental pkt-line decoder
+
+    Received chunks are only collected until packets are requested and
+    then joined with the unconsumed rest of the buffer once. Packets
+    are cut from that buffer through a read offset in one tight loop,
+    so each byte is copied a constant number of times instead of the
+    whole buffer being copied for each packet. (On Python 2, int()
+    cannot parse a bytearray and memoryview slicing is slower than
+    slicing a str, so plain strings are used.)"""
+
+    def __init__(self):
+        self._buffer = ''
+        self._offset = 0
+        self._chunks = []
+        self._pending = deque()
+        self._error = None
+
+    def feed(self, data):
+        if data:
+            self._chunks.append(data)
+
+    def __len__(self):
+        """Number of buffered bytes not returned as packets yet"""
+        return (len(self._buffer) - self._offset +
+                sum(len(c) for c in self._chunks) +
+                sum(len(p) for p in self._pending))
+
+    def next_packet(self):
+        """Get the next complete packet including its length header,
+        None if more data is needed. Raises PacketError if the stream
+        is malformed."""
+        if not self._pending:
+            self._pending.extend(self._decode())
+            if not self._pending:
+                if self._error is not None:
+                    raise self._error
+                return None
+        return self._pending.popleft()
+
+    def packets(self):
+        """Get a list of all complete packets buffered so far"""
+        packets = list(self._pending)
+        self._pending.clear()
+        packets.extend(self._decode())
+        if not packets and self._error is not None:
+            raise self._error
+        return packets
+
+    def remaining(self):
+        """Get and drop everything buffered but not returned yet"""
+        data = ''.join(list(self._pending) +
+                       [self._buffer[self._offset:]] + self._chunks)
+        self._buffer, self._offset, self._chunks = '', 0, []
+        self._pending.clear()
+        return data
+
+    def _decode(self):
+        if self._chunks:
+            self._chunks.insert(0, self._buffer[self._offset:])
+            self._buffer, self._offset = ''.join(self._chunks), 0
+            self._chunks = []
+
+        buf, offset, end = self._buffer, self._offset, len(self._buffer)
+        packets = []
+        while end - offset >= 4 and self._error is None:
+            header = buf[offset:offset + 4]
+            try:
+                pktlen = int(header, 16)
+            except ValueError:
+                self._error = PacketError(header)
+                break
+
+            if pktlen >= 4:
+                if pktlen > MAX_PACKET_LENGTH:
+                    self._error = PacketError(header)
+                    break
+                if pktlen > end - offset:
+                    break
+                packets.append(buf[offset:offset + pktlen])
+            elif pktlen in SPECIAL:
+                packets.append(SPECIAL[pktlen])
+                pktlen = 4
+            else:
+                self._error = PacketError(header)
+                break
+            offset += pktlen
+
+        self._offset = offset
+        return packets
+
+
+def iter_payloads(data):
+    """Iterate over the payloads of a string of pkt-lines
+
+    Special packets yield None. Raises ValueError on malformed or
+    truncated data."""
+    decoder = PacketDecoder()
+    decoder.feed(data)
+    for packet in decoder.packets():
+        if packet in _special:
+            yield None
+        else:
+            yield packet[4:]
+    if len(decoder):
+        raise ValueError("Truncated pkt-line")
@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+"""Serving repositories from backend nodes, see BackendPool"""
+
+from zope.interface import implements
+from twisted.internet import reactor, defer
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.error import ConnectError, ProcessDone
+from twisted.internet.interfaces import IConsumer, IProcessTransport
+from twisted.internet.protocol import Factory, Protocol
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseDone
+from twisted.web.client import FileBodyProducer
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IBodyProducer, UNKNOWN_LENGTH
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from gitserverglue.pktline import encode
+
+# headers of a single HTTP connection, not passed on
+HOP_BY_HOP = frozenset(['connection', 'keep-alive', 'proxy-authenticate',
+                        'proxy-authorization', 'te', 'trailers',
+                        'transfer-encoding', 'upgrade'])
+
+# request bodies of reads up to this size are kept to retry them
+# on another node
+MAX_REPLAY_SIZE = 1024 ** 2
+
+
+def request_line(rpc, path, host, protocol=None, username=None):
+    """Encode the request of a git:// connection to a node
+
+    protocol is a protocol_env passed on as extra parameters, username
+    the user the proxy authenticated, only nodes trusting the proxy
+    accept it (see git_configuration.trusted_proxies)."""
+    extra = []
+    if protocol:
+        extra = protocol['GIT_PROTOCOL'].split(':')
+    if username is not None:
+        extra.append('user=' + username)
+    line = '%s %s\0host=%s\0' % (rpc, path, host)
+    if extra:
+        line += '\0' + ''.join(p + '\0' for p in extra)
+    return encode(line)
+
+
+def connect_tcp(host, port, protocol, timeout):
+    """Connect protocol to host:port, returns a Deferred firing with it
+    once connected"""
+    factory = Factory()
+    factory.noisy = False  # not logged for each connection
+    factory.buildProtocol = lambda addr: protocol
+    endpoint = TCP4ClientEndpoint(reactor, host, port, timeout)
+    return endpoint.connect(factory)
+
+
+class Backend(object):
+    """A node serving repositories with gitserverglue (or git daemon
+    for reads over git:// only)"""
+
+    def __init__(self, host, git_port=9418, http_port=8080):
+        self.host = host
+        self.git_port = git_port
+        self.http_port = http_port
+        self.healthy = True
+
+    def __repr__(self):
+        return '%s:%d' % (self.host, self.git_port)
+
+
+class BackendPool(object):
+    """The nodes holding (copies of) a set of repositories
+
+    A path_lookup returns a pool as 'repository_backend' (with
+    'repository_fs_path' None) to have a repository served by one of
+    its nodes. Clients are authenticated and authorized by the proxy,
+    their connections are then passed on to the node: git:// and SSH
+    over a git:// connection, HTTP over persistent HTTP connections
+    (git:// connections only carry a single request).
+
+    The first node is the primary, which takes all pushes. Reads are
+    spread round robin over the healthy nodes and fail over to the
+    next one if a node cannot be reached. Every check_interval seconds,
+    the git port of each node is connected to, nodes which do not
+    accept within check_timeout seconds are only tried last until they
+    do again."""
+
+    def __init__(self, backends, check_interval=10, check_timeout=5,
+                 clock=reactor):
+        self.backends = list(backends)
+        self.primary = self.backends[0]
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.clock = clock
+
+        self.http_pool = HTTPConnectionPool(reactor, persistent=True)
+        self.agent = Agent(reactor, connectTimeout=check_timeout,
+                           pool=self.http_pool)
+        self.failovers = 0
+        self._next = 0
+        self._call = None
+
+    @property
+    def healthy(self):
+        return len([b for b in self.backends if b.healthy])
+
+    def start(self):
+        """Start checking the health of the nodes"""
+        self._check()
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+        return self.http_pool.closeCachedConnections()
+
+    def candidates(self, write=False):
+        """Get the nodes to try for a request, in order"""
+        if write:
+            return [self.primary]
+        self._next = (self._next + 1) % len(self.backends)
+        nodes = self.backends[self._next:] + self.backends[:self._next]
+        return ([b for b in nodes if b.healthy] +
+                [b for b in nodes if not b.healthy])
+
+    def connect(self, protocol, write=False):
+        """Connect protocol to the git port of a node, returns a Deferred
+        firing with the node once connected"""
+        candidates = self.candidates(write)
+        attempts = []
+
+        def cancel(d):
+            candidates[:] = []
+            attempts[-1].cancel()
+        d = defer.Deferred(cancel)
+
+        def attempt(failure=None):
+            if not candidates:
+                d.errback(failure)
+                return
+            if failure is not None:
+                self.failovers += 1
+            backend = candidates.pop(0)
+            attempts.append(connect_tcp(backend.host, backend.git_port,
+                                        protocol, self.check_timeout))
+            attempts[-1].addCallbacks(lambda p: d.callback(backend),
+                                      failed, errbackArgs=(backend,))
+
+        def failed(failure, backend):
+            if failure.check(defer.CancelledError):
+                return
+            self.failed(backend, failure)
+            attempt(failure)
+
+        attempt()
+        return d
+
+    def failed(self, backend, failure):
+        """Mark a node as unhealthy after failing to connect to it"""
+        if backend.healthy:
+            log.msg("Backend %r failed: %s" % (backend,
+                                               failure.getErrorMessage()))
+        backend.healthy = False
+
+    def _check(self):
+        self._call = self.clock.callLater(self.check_interval, self._check)
+        for backend in self.backends:
+            d = connect_tcp(backend.host, backend.git_port, Protocol(),
+                            self.check_timeout)
+            d.addCallbacks(self._checked, self._checkFailed,
+                           callbackArgs=(backend,),
+                           errbackArgs=(backend,))
+
+    def _checked(self, protocol, backend):
+        protocol.transport.loseConnection()
+        if not backend.healthy:
+            log.msg("Backend %r is back" % backend)
+        backend.healthy = True
+
+    def _checkFailed(self, failure, backend):
+        self.failed(backend, failure)
+
+
+class BackendConnection(Protocol):
+    """git:// connection to a node carrying one request
+
+    Once connected, the request is sent and client is told about what
+    the node sends with backendDataReceived and backendConnectionLost."""
+
+    client = None
+
+    def __init__(self, rpc, path, protocol=None, username=None):
+        self.rpc = rpc
+        self.path = path
+        self.protocol = protocol
+        self.username = username
+
+    def connectionMade(self):
+        peer = self.transport.getPeer()
+        self.transport.write(request_line(self.rpc, self.path,
+                                          '%s:%d' % (peer.host, peer.port),
+                                          self.protocol, self.username))
+
+    def dataReceived(self, data):
+        self.client.backendDataReceived(data)
+
+    def connectionLost(self, reason):
+        self.client.backendConnectionLost(reason)
+
+
+class BackendProcess(object):
+    """Stands in for the git process of an SSH session whose request is
+    passed on to a node over a BackendConnection
+
+    The process protocol sees the output of the node on stdout and the
+    process ending once the node closes the connection."""
+    implements(IProcessTransport)
+
+    pid = None
+    lost = False
+
+    def __init__(self, proto, connection):
+        self.proto = proto
+        self.connection = connection
+        connection.client = self
+
+    def backendDataReceived(self, data):
+        self.proto.childDataReceived(1, data)
+
+    def backendConnectionLost(self, reason):
+        self.lost = True
+        for childFD in (0, 1, 2):
+            self.proto.childConnectionLost(childFD)
+        status = Failure(ProcessDone(0))
+        self.proto.processExited(status)
+        self.proto.processEnded(status)
+
+    def write(self, data):
+        if not self.lost:
+            self.connection.transport.write(data)
+
+    def writeSequence(self, seq):
+        self.write(''.join(seq))
+
+    def closeStdin(self):
+        if not self.lost:
+            self.connection.transport.loseWriteConnection()
+
+    def loseConnection(self):
+        if not self.lost:
+            self.connection.transport.loseConnection()
+
+    def signalProcess(self, signalID):
+        self.loseConnection()
+
+    def closeStdout(self):
+        pass
+
+    def closeStderr(self):
+        pass
+
+    def closeChildFD(self, descriptor):
+        pass
+
+    def writeToChild(self, childFD, data):
+        if childFD == 0:
+            self.write(data)
+
+    # IPushProducer, for a BandwidthShaper limiting the output
+    def pauseProducing(self):
+        self.connection.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.connection.transport.resumeProducing()
+
+    def stopProducing(self):
+        self.loseConnection()
+
+
+class StreamingBody(object):
+    """The streamed body of a request passed on to a node
+
+    producer (the client connection) is paused while the node does not
+    keep up. Up to max_replay bytes are kept for replay to retry the
+    request on another node."""
+    implements(IBodyProducer)
+
+    length = UNKNOWN_LENGTH
+    consumer = None
+    complete = False
+    stopped = False
+
+    def __init__(self, producer, max_replay=0):
+        self.producer = producer
+        self.max_replay = max_replay
+        self.buffer = []
+        self.sent = []
+        self.sentSize = 0
+        self._finished = None
+
+    @property
+    def replayable(self):
+        return self.sentSize <= self.max_replay
+
+    def replay(self):
+        """Get a body sending everything again, None if too much of it
+        was not kept"""
+        if not self.replayable:
+            return None
+        body = StreamingBody(self.producer, self.max_replay)
+        body.buffer = self.sent + self.buffer
+        body.complete = self.complete
+        self.stopProducing()
+        return body
+
+    def write(self, data):
+        if self.stopped:
+            return
+        if self.consumer is None:
+            self.buffer.append(data)
+            return
+        self._keep(data)
+        self.consumer.write(data)
+
+    def finish(self):
+        self.complete = True
+        if self._finished is not None:
+            d, self._finished = self._finished, None
+            d.callback(None)
+
+    def _keep(self, data):
+        if self.replayable:
+            self.sent.append(data)
+            self.sentSize += len(data)
+            if not self.replayable:
+                self.sent = []
+
+    # IBodyProducer
+    def startProducing(self, consumer):
+        self.consumer = consumer
+        buffered, self.buffer = ''.join(self.buffer), []
+        if buffered:
+            self._keep(buffered)
+            consumer.write(buffered)
+        if self.complete:
+            return defer.succeed(None)
+        self._finished = defer.Deferred()
+        return self._finished
+
+    def pauseProducing(self):
+        self.producer.pauseProducing()
+
+    def resumeProducing(self):
+        self.producer.resumeProducing()
+
+    def stopProducing(self):
+        # the deferred of startProducing must not fire anymore
+        self.stopped = True
+        self._finished = None
+        self.producer.resumeProducing()
+
+
+class ResponseRelay(Protocol):
+    """Passes the response body of a node on to the client request"""
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    def connectionMade(self):
+        self.proxy.request.registerProducer(self.transport, True)
+
+    def dataReceived(self, data):
+        self.proxy.request.write(data)
+
+    def connectionLost(self, reason):
+        self.proxy.relay = None
+        if self.proxy.disconnected:
+            return
+        request = self.proxy.request
+        request.unregisterProducer()
+        if reason.check(ResponseDone, PotentialDataLoss):
+            request.finish()
+        else:
+            log.msg("Response of %r to %s failed: %s" % (
+                        self.proxy.backend, request.uri,
+                        reason.getErrorMessage()))
+            request.channel.transport.loseConnection()
+
+
+class ProxyResource(Resource):
+    """Passes an HTTP request on to a node of a BackendPool
+
+    Request bodies are streamed to the node as they arrive (already
+    decompressed by StreamingRequest). Reads are retried on the next
+    node if a node fails before it responded."""
+    implements(IConsumer)
+
+    isLeaf = True
+    request = None
+    backend = None
+    body = None
+    relay = None
+    disconnected = False
+    _pending = None
+
+    def __init__(self, pool, writerequired=False):
+        Resource.__init__(self)
+        self.pool = pool
+        self.writerequired = writerequired
+
+    def render(self, request):
+        self.request = request
+        if self.body is None and request.method in ('POST', 'PUT'):
+            # buffered request
+            self.body = FileBodyProducer(request.content)
+        request.notifyFinish().addErrback(self._requestLost)
+        self.candidates = self.pool.candidates(self.writerequired)
+        self._attempt()
+        return NOT_DONE_YET
+
+    def headers(self):
+        """Get the headers to send to the node"""
+        request = self.request
+        headers = Headers()
+        skipped = set(['host', 'content-length'])  # set by the agent
+        if getattr(request, '_decoder', None) is not None:
+            skipped.add('content-encoding')  # decoded as it arrived
+        for name, values in request.requestHeaders.getAllRawHeaders():
+            if name.lower() not in HOP_BY_HOP and \
+                    name.lower() not in skipped:
+                headers.setRawHeaders(name, values)
+        forwarded = request.requestHeaders.getRawHeaders('x-forwarded-for',
+                                                         [])
+        headers.setRawHeaders('x-forwarded-for',
+                              [', '.join(forwarded +
+                                         [request.getClientIP()])])
+        return headers
+
+    def _attempt(self, failure=None):
+        if failure is not None:
+            self.pool.failovers += 1
+        self.backend = self.candidates.pop(0)
+        url = 'http://%s:%d%s' % (self.backend.host, self.backend.http_port,
+                                  self.request.uri)
+        self._pending = self.pool.agent.request(self.request.method, url,
+                                                self.headers(), self.body)
+        self._pending.addCallbacks(self._response, self._failed)
+
+    def _failed(self, failure):
+        self._pending = None
+        if failure.check(defer.CancelledError) or self.disconnected:
+            return
+        if failure.check(ConnectError):
+            self.pool.failed(self.backend, failure)
+        if self.candidates and self._replay():
+            log.msg("Retrying %s after %r failed: %s" % (
+                        self.request.uri, self.backend,
+                        failure.getErrorMessage()))
+            return self._attempt(failure)
+
+        log.msg("Proxying %s to %r failed: %s" % (
+                    self.request.uri, self.backend,
+                    failure.getErrorMessage()))
+        if isinstance(self.body, StreamingBody):
+            self.body.stopProducing()  # discard the rest
+        self.request.setResponseCode(502)
+        self.request.setHeader('Content-Type', 'text/plain')
+        self.request.write("Repository unavailable\n")
+        self.request.finish()
+
+    def _replay(self):
+        """Prepare the body to be sent again, returns False if it cannot"""
+        if isinstance(self.body, StreamingBody):
+            self.body = self.body.replay()
+            return self.body is not None
+        if self.body is not None:
+            self.request.content.seek(0)
+            self.body = FileBodyProducer(self.request.content)
+        return True
+
+    def _response(self, response):
+        self._pending = None
+        if self.disconnected:
+            response.deliverBody(Protocol())
+            return
+
+        request = self.request
+        request.setResponseCode(response.code, response.phrase)
+        for name, values in response.headers.getAllRawHeaders():
+            if name.lower() not in HOP_BY_HOP:
+                request.responseHeaders.setRawHeaders(name, values)
+        self.relay = ResponseRelay(self)
+        response.deliverBody(self.relay)
+
+    def _requestLost(self, reason):
+        self.disconnected = True
+        if self._pending is not None:
+            self._pending.cancel()
+        if self.relay is not None and self.relay.transport is not None:
+            self.relay.transport.stopProducing()
+
+    # IConsumer for StreamingRequest
+    def registerProducer(self, producer, streaming):
+        max_replay = MAX_REPLAY_SIZE
+        if self.writerequired:
+            max_replay = 0  # only sent to the primary
+        self.body = StreamingBody(producer, max_replay)
+
+    def unregisterProducer(self):
+        self.body.finish()
+
+    def write(self, data):
+        self.body.write(data)
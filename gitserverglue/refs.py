@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+import os
+import os.path
+import mmap
+import errno
+import zlib
+import struct
+import hashlib
+import binascii
+from collections import OrderedDict
+
+from twisted.python import log
+
+from gitserverglue.pktline import PacketDecoder, FLUSH, encode_lines
+
+
+def _hash_stat(h, fs_path, name):
+    try:
+        st = os.stat(fs_path)
+    except OSError:
+        h.update('%s -\n' % name)
+        return
+    h.update('%s %d %d %r\n' % (name, st.st_ino, st.st_size, st.st_mtime))
+
+
+def ref_state_fingerprint(repo_path):
+    """Compute a cheap fingerprint of the refs of a repository
+
+    Only stat() information of HEAD, packed-refs, the loose refs and
+    the config (which changes the capabilities) is used. Since git
+    updates these by writing a lock file and renaming it into place,
+    every update changes the inode of the affected file and therefore
+    the fingerprint."""
+    h = hashlib.sha1()
+    _hash_stat(h, os.path.join(repo_path, 'HEAD'), 'HEAD')
+    _hash_stat(h, os.path.join(repo_path, 'config'), 'config')
+    _hash_stat(h, os.path.join(repo_path, 'packed-refs'), 'packed-refs')
+
+    refs_dir = os.path.join(repo_path, 'refs')
+    for dirpath, dirnames, filenames in os.walk(refs_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith('.lock'):
+                continue
+            fs_path = os.path.join(dirpath, filename)
+            _hash_stat(h, fs_path, os.path.relpath(fs_path, repo_path))
+
+    return h.hexdigest()
+
+
+class AdvertisementCache(object):
+    """Keeps the last rendered ref advertisement of each repository
+
+    Entries are only returned as long as the ref state fingerprint
+    they were rendered for is still current. Encoded (e.g. compressed)
+    forms of an advertisement are kept alongside it."""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, repo_path, service, fingerprint):
+        entry = self._entries.pop((repo_path, service), None)
+        if entry is None or entry[0] != fingerprint:
+            self.misses += 1
+            return None
+
+        self._entries[(repo_path, service)] = entry  # most recently used
+        self.hits += 1
+        return entry[1]
+
+    def get_encoded(self, repo_path, service, fingerprint, encoding,
+                    encode):
+        """Get the advertisement as encoded by encode(data), which is only
+        called the first time encoding is asked for"""
+        data = self.get(repo_path, service, fingerprint)
+        if data is None:
+            return None
+
+        encoded = self._entries[(repo_path, service)][2]
+        if encoding not in encoded:
+            encoded[encoding] = encode(data)
+        return encoded[encoding]
+
+    def store(self, repo_path, service, fingerprint, data):
+        self._entries.pop((repo_path, service), None)
+        self._entries[(repo_path, service)] = (fingerprint, data, {})
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+UPLOAD_PACK_CAPABILITIES = [
+    'multi_ack', 'thin-pack', 'side-band', 'side-band-64k', 'ofs-delta',
+    'shallow', 'deepen-since', 'deepen-not', 'deepen-relative',
+    'no-progress', 'include-tag', 'multi_ack_detailed'
+]
+
+# environment for an upload-pack serving a client which got its ref
+# advertisement from RefAdvertiser. Refs might have moved since, so
+# wants of objects that are still reachable are accepted as well.
+ADVERTISED_UPLOAD_PACK_ENV = {
+    'GIT_CONFIG_PARAMETERS': "'uploadpack.allowreachablesha1inwant'='true'"
+}
+
+# pack object types
+OBJ_COMMIT, OBJ_TREE, OBJ_BLOB, OBJ_TAG = 1, 2, 3, 4
+TYPE_NAMES = {OBJ_COMMIT: 'commit', OBJ_TREE: 'tree', OBJ_BLOB: 'blob',
+              OBJ_TAG: 'tag'}
+
+# settings in the repository config which change what upload-pack
+# advertises in a way this module does not know about
+UNSUPPORTED_CONFIG = ['hiderefs', 'objectformat', 'refstorage']
+UNSUPPORTED_CONFIG_SECTIONS = ['include', 'includeif']
+
+# settings allowing wants of unadvertised objects, with the
+# capabilities upload-pack advertises for them
+WANT_CONFIG = {
+    'uploadpack.allowtipsha1inwant': ['allow-tip-sha1-in-want'],
+    'uploadpack.allowreachablesha1inwant': ['allow-reachable-sha1-in-want'],
+    'uploadpack.allowanysha1inwant': ['allow-tip-sha1-in-want',
+                                      'allow-reachable-sha1-in-want'],
+}
+
+
+class UnsupportedRepository(Exception):
+    """The refs of a repository can not be advertised without git"""
+
+
+class PackIndex(object):
+    """Lookup of object offsets in a version 2 pack index"""
+
+    def __init__(self, idx_path):
+        with open(idx_path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mmap[:8] != '\377tOc\0\0\0\2':
+            raise UnsupportedRepository("Unsupported pack index " + idx_path)
+
+        self.fanout = struct.unpack('>256I', self.mmap[8:8 + 1024])
+        self.count = self.fanout[255]
+        self.sha_table = 8 + 1024
+        self.offset_table = self.sha_table + self.count * 24
+        self.large_offset_table = self.offset_table + self.count * 4
+
+    def offset(self, binsha):
+        first = ord(binsha[0])
+        lo = first and self.fanout[first - 1] or 0
+        hi = self.fanout[first]
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.sha_table + mid * 20
+            current = self.mmap[pos:pos + 20]
+            if current < binsha:
+                lo = mid + 1
+            elif current > binsha:
+                hi = mid
+            else:
+                pos = self.offset_table + mid * 4
+                offset, = struct.unpack('>I', self.mmap[pos:pos + 4])
+                if offset & 0x80000000:
+                    pos = self.large_offset_table + (offset & 0x7fffffff) * 8
+                    offset, = struct.unpack('>Q', self.mmap[pos:pos + 8])
+                return offset
+
+        return None
+
+
+def _tag_target(data):
+    """Get the object id a tag object points to"""
+    if not data.startswith('object ') or len(data) < 47:
+        raise UnsupportedRepository("Unable to parse tag object")
+    return data[7:47]
+
+
+class ObjectReader(object):
+    """Reads types and tag targets of objects without running git
+
+    Loose objects and non-deltified objects in packs are supported,
+    everything else raises UnsupportedRepository."""
+
+    def __init__(self, repo_path, pack_indexes):
+        self.object_dirs = [os.path.join(repo_path, 'objects')]
+        self.pack_indexes = pack_indexes
+
+        alternates = os.path.join(self.object_dirs[0], 'info', 'alternates')
+        if os.path.exists(alternates):
+            with open(alternates, 'rb') as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        self.object_dirs.append(os.path.join(
+                                            self.object_dirs[0], line))
+
+    def peel(self, sha):
+        """Get the object a tag eventually points to, None for non-tags"""
+        peeled = None
+        for unused_depth in range(32):
+            objtype, target = self.read_header(sha)
+            if objtype != 'tag':
+                return peeled
+            peeled = sha = target
+        raise UnsupportedRepository("Tag chain too long")
+
+    def read_header(self, sha):
+        """Get the type of an object and the target if it is a tag"""
+        for objects_dir in self.object_dirs:
+            fs_path = os.path.join(objects_dir, sha[:2], sha[2:])
+            if os.path.exists(fs_path):
+                return self._read_loose(fs_path)
+
+        binsha = binascii.unhexlify(sha)
+        for objects_dir in self.object_dirs:
+            pack_dir = os.path.join(objects_dir, 'pack')
+            if not os.path.isdir(pack_dir):
+                continue
+            for filename in os.listdir(pack_dir):
+                if not filename.endswith('.idx'):
+                    continue
+                idx_path = os.path.join(pack_dir, filename)
+                if idx_path not in self.pack_indexes:
+                    self.pack_indexes[idx_path] = PackIndex(idx_path)
+                offset = self.pack_indexes[idx_path].offset(binsha)
+                if offset is not None:
+                    return self._read_packed(idx_path[:-4] + '.pack', offset)
+
+        raise UnsupportedRepository("Object %s not found" % sha)
+
+    def _read_loose(self, fs_path):
+        with open(fs_path, 'rb') as f:
+            data = zlib.decompressobj().decompress(f.read(4096), 512)
+        header, unused_sep, content = data.partition('\0')
+        objtype = header.split(' ')[0]
+        if objtype == 'tag':
+            return objtype, _tag_target(content)
+        return objtype, None
+
+    def _read_packed(self, pack_path, offset):
+        with open(pack_path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(4096)
+
+        c = ord(data[0])
+        objtype = (c >> 4) & 7
+        pos = 1
+        while c & 0x80:  # skip the remaining size bytes
+            c = ord(data[pos])
+            pos += 1
+
+        if objtype not in TYPE_NAMES:
+            raise UnsupportedRepository("Deltified object at %d in %s" %
+                                        (offset, pack_path))
+        if objtype == OBJ_TAG:
+            content = zlib.decompressobj().decompress(data[pos:], 512)
+            return 'tag', _tag_target(content)
+        return TYPE_NAMES[objtype], None
+
+
+def read_config(repo_path):
+    """Get the settings of the config of a repository as a list of
+    (section.name, value) in the order they appear
+
+    Section and setting names are lower case, subsections are kept as
+    they are (remote.origin.url). Settings without a value are true."""
+    try:
+        with open(os.path.join(repo_path, 'config'), 'rb') as f:
+            lines = f.read().splitlines()
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+
+    settings = []
+    section = ''
+    for line in lines:
+        line = line.strip()
+        if not line or line[0] in '#;':
+            continue
+        if line.startswith('['):
+            header = line[1:line.index(']')].strip()
+            name, _, subsection = header.partition(' ')
+            section = name.lower()
+            subsection = subsection.strip().strip('"')
+            if subsection:
+                section += '.' + subsection
+            continue
+        name, equals, value = line.partition('=')
+        if not equals:
+            value = 'true'
+        settings.append(('%s.%s' % (section, name.strip().lower()),
+                         _config_value(value)))
+    return settings
+
+
+def _config_value(raw):
+    # drop quotes and a trailing comment
+    value = []
+    quoted = False
+    for c in raw:
+        if c == '"':
+            quoted = not quoted
+        elif c in '#;' and not quoted:
+            break
+        else:
+            value.append(c)
+    return ''.join(value).strip()
+
+
+def config_bool(value):
+    return value.lower() in ('true', 'yes', 'on', '1')
+
+
+def read_refs(repo_path, reader):
+    """Read HEAD and all refs of a repository
+
+    Returns the target of HEAD if it is a symbolic ref and a sorted
+    list of (name, sha, peeled) tuples with HEAD as first entry."""
+    refs = {}
+    peeled = {}
+    peeled_trait = None
+
+    packed_refs = os.path.join(repo_path, 'packed-refs')
+    if os.path.exists(packed_refs):
+        with open(packed_refs, 'rb') as f:
+            last = None
+            for line in f:
+                line = line.rstrip('\n')
+                if line.startswith('# pack-refs with:'):
+                    traits = line.split(':', 1)[1].split()
+                    if 'fully-peeled' in traits:
+                        peeled_trait = lambda name: True
+                    elif 'peeled' in traits:
+                        peeled_trait = lambda name: name.startswith(
+                                                            'refs/tags/')
+                elif line.startswith('^'):
+                    peeled[last] = line[1:41]
+                elif line and not line.startswith('#'):
+                    sha, last = line.split(' ', 1)
+                    refs[last] = sha
+
+    # which packed refs are known to be no tag objects
+    not_peeled = set()
+    if peeled_trait is not None:
+        not_peeled = set(name for name in refs
+                         if name not in peeled and peeled_trait(name))
+
+    symrefs = {}
+    refs_dir = os.path.join(repo_path, 'refs')
+    for dirpath, dirnames, filenames in os.walk(refs_dir):
+        for filename in filenames:
+            if filename.endswith('.lock'):
+                continue
+            fs_path = os.path.join(dirpath, filename)
+            name = os.path.relpath(fs_path, repo_path).replace(os.sep, '/')
+            with open(fs_path, 'rb') as f:
+                content = f.read().strip()
+            if content.startswith('ref: '):
+                symrefs[name] = content[5:]
+            elif len(content) == 40:
+                refs[name] = content
+                peeled.pop(name, None)
+                not_peeled.discard(name)
+            else:
+                raise UnsupportedRepository("Unable to parse " + fs_path)
+
+    for name, target in symrefs.items():
+        if target in refs:
+            refs[name] = refs[target]
+            if target in peeled:
+                peeled[name] = peeled[target]
+            if target in not_peeled:
+                not_peeled.add(name)
+
+    result = []
+    for name in sorted(refs):
+        if name not in peeled and name not in not_peeled:
+            peel = reader.peel(refs[name])
+            if peel is not None:
+                peeled[name] = peel
+        result.append((name, refs[name], peeled.get(name)))
+
+    with open(os.path.join(repo_path, 'HEAD'), 'rb') as f:
+        head = f.read().strip()
+
+    head_target = None
+    if head.startswith('ref: '):
+        head_target = head[5:]
+        if head_target in refs:
+            result.insert(0, ('HEAD', refs[head_target],
+                              peeled.get(head_target)))
+    elif len(head) == 40:
+        result.insert(0, ('HEAD', head, reader.peel(head)))
+
+    return head_target, result
+
+
+class RefAdvertiser(object):
+    """Generates git-upload-pack ref advertisements without running git
+
+    The advertisement is what upload-pack sends on git:// and ssh://
+    before the client sends its wants. Capabilities depending on
+    uploadpack settings are taken from the config of the repository,
+    those in the global and system configs are not looked at. If a
+    repository uses features which are not supported here, None is
+    returned and git should be used instead."""
+
+    def __init__(self, cache=None, agent='gitserverglue'):
+        if cache is None:
+            cache = AdvertisementCache()
+        self.cache = cache
+        self.agent = agent
+        self._pack_indexes = {}
+
+    def advertise(self, repo_path, fingerprint=None):
+        if fingerprint is None:
+            fingerprint = ref_state_fingerprint(repo_path)
+
+        data = self.cache.get(repo_path, 'upload-pack-native', fingerprint)
+        if data is not None:
+            return data
+
+        try:
+            data = self.generate(repo_path)
+        except (UnsupportedRepository, EnvironmentError,
+                ValueError, zlib.error) as e:
+            log.msg("Unable to advertise refs of %s: %s" % (repo_path, e))
+            return None
+
+        self.cache.store(repo_path, 'upload-pack-native', fingerprint, data)
+        return data
+
+    def generate(self, repo_path):
+        config = read_config(repo_path)
+        for key, value in config:
+            if (key.rsplit('.', 1)[-1] in UNSUPPORTED_CONFIG or
+                    key.split('.', 1)[0] in UNSUPPORTED_CONFIG_SECTIONS):
+                raise UnsupportedRepository("%s is configured" % key)
+        if os.path.exists(os.path.join(repo_path, 'shallow')):
+            raise UnsupportedRepository("Shallow repository")
+
+        # forget indexes of packs which were removed by a repack
+        for idx_path in self._pack_indexes.keys():
+            if not os.path.exists(idx_path):
+                del self._pack_indexes[idx_path]
+
+        reader = ObjectReader(repo_path, self._pack_indexes)
+        head_target, refs = read_refs(repo_path, reader)
+
+        # the capabilities in the order upload-pack sends them
+        allowed = set()
+        allow_filter = False
+        for key, value in config:
+            if key in WANT_CONFIG:
+                if config_bool(value):
+                    allowed.update(WANT_CONFIG[key])
+                else:
+                    allowed.difference_update(WANT_CONFIG[key])
+            elif key == 'uploadpack.allowfilter':
+                allow_filter = config_bool(value)
+        caps = list(UPLOAD_PACK_CAPABILITIES)
+        caps.extend(c for c in ('allow-tip-sha1-in-want',
+                                'allow-reachable-sha1-in-want')
+                    if c in allowed)
+        if refs and refs[0][0] == 'HEAD' and head_target is not None:
+            caps.append('symref=HEAD:' + head_target)
+        if allow_filter:
+            caps.append('filter')
+        caps.append('object-format=sha1')
+        caps.append('agent=' + self.agent)
+        caps = ' '.join(caps)
+
+        if not refs:
+            # like upload-pack since git 2.41, the capabilities of empty
+            # repositories are sent with a placeholder ref
+            null = '0' * 40
+            return encode_lines(['%s capabilities^{}\0%s\n' % (null, caps)])
+
+        lines = []
+        for name, sha, peeled in refs:
+            if not lines:
+                lines.append('%s %s\0%s\n' % (sha, name, caps))
+            else:
+                lines.append('%s %s\n' % (sha, name))
+            if peeled is not None:
+                lines.append('%s %s^{}\n' % (peeled, name))
+
+        return encode_lines(lines)
+
+
+class AdvertisementSkipper(object):
+    """Removes the ref advertisement from the output of upload-pack
+
+    Used when the advertisement was already sent by RefAdvertiser."""
+
+    done = False
+
+    def __init__(self):
+        self.decoder = PacketDecoder()
+
+    def feed(self, data):
+        """Returns the part of data following the advertisement"""
+        if self.done:
+            return data
+
+        self.decoder.feed(data)
+        while True:
+            packet = self.decoder.next_packet()
+            if packet is None:
+                return ''
+            if packet == FLUSH:
+                self.done = True
+                return self.decoder.remaining()
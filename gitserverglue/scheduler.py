@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+import bisect
+import itertools
+
+from twisted.internet import defer, reactor
+
+PRIORITY_PUSH = 0
+PRIORITY_FETCH = 10
+
+
+class ServerBusy(Exception):
+    """No process slot could be acquired"""
+
+    def __init__(self, message, retry_after):
+        Exception.__init__(self, message)
+        self.message = message
+        self.retry_after = retry_after
+
+
+class ProcessSlot(object):
+    """Permission to run one git process, release it once git ended"""
+
+    released = False
+
+    def __init__(self, scheduler, repository, username):
+        self.scheduler = scheduler
+        self.repository = repository
+        self.username = username
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.scheduler._release(self)
+
+
+class ProcessScheduler(object):
+    """Limits the number of concurrently running git processes
+
+    Limits apply globally, per repository and per user (anonymous
+    users are only subject to the global and per repository limits).
+    Requests exceeding a limit are queued by priority and in FIFO
+    order within the same priority. Requests are rejected with
+    ServerBusy when the queue is full or they waited too long."""
+
+    def __init__(self, max_processes=32, max_per_repository=8,
+                 max_per_user=4, max_queue=256, max_wait=30,
+                 retry_after=10, clock=reactor):
+        self.max_processes = max_processes
+        self.max_per_repository = max_per_repository
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.clock = clock
+
+        self.running = 0
+        self.rejected = 0
+        self._per_repository = {}
+        self._per_user = {}
+        self._queue = []  # sorted list of (priority, seq, entry)
+        self._seq = itertools.count()
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    def acquire(self, repository, username=None, priority=PRIORITY_FETCH):
+        """Get a Deferred firing with a ProcessSlot once a process may run
+
+        The Deferred fails with ServerBusy if no slot is available in
+        time and can be cancelled if the client went away."""
+        if self._allowed(repository, username):
+            return defer.succeed(self._grant(repository, username))
+
+        if len(self._queue) >= self.max_queue:
+            if not self._queue or self._queue[-1][0] <= priority:
+                self.rejected += 1
+                return defer.fail(ServerBusy("Server busy, too many "
+                                             "requests queued",
+                                             self.retry_after))
+
+            # make room by rejecting the last queued request
+            # of lower priority
+            entry = self._queue[-1][2]
+            self._dequeue(entry)
+            self.rejected += 1
+            entry[0].errback(ServerBusy("Server busy, too many requests "
+                                        "queued", self.retry_after))
+
+        entry = [None, repository, username, None]
+        d = defer.Deferred(lambda d: self._dequeue(entry))
+        entry[0] = d
+        entry[3] = self.clock.callLater(self.max_wait, self._expire, entry)
+        bisect.insort(self._queue, (priority, next(self._seq), entry))
+        return d
+
+    def _allowed(self, repository, username):
+        if self.running >= self.max_processes:
+            return False
+        if (self._per_repository.get(repository, 0) >=
+                self.max_per_repository):
+            return False
+        if (username is not None and
+                self._per_user.get(username, 0) >= self.max_per_user):
+            return False
+        return True
+
+    def _grant(self, repository, username):
+        self.running += 1
+        self._per_repository[repository] = \
+            self._per_repository.get(repository, 0) + 1
+        if username is not None:
+            self._per_user[username] = self._per_user.get(username, 0) + 1
+        return ProcessSlot(self, repository, username)
+
+    def _release(self, slot):
+        self.running -= 1
+        self._decrement(self._per_repository, slot.repository)
+        if slot.username is not None:
+            self._decrement(self._per_user, slot.username)
+
+        granted = []
+        for queued in list(self._queue):
+            d, repository, username, timeout = queued[2]
+            if self._allowed(repository, username):
+                self._queue.remove(queued)
+                timeout.cancel()
+                granted.append((d, self._grant(repository, username)))
+
+        for d, slot in granted:
+            d.callback(slot)
+
+    def _decrement(self, counts, key):
+        counts[key] -= 1
+        if counts[key] == 0:
+            del counts[key]
+
+    def _dequeue(self, entry):
+        for i, queued in enumerate(self._queue):
+            if queued[2] is entry:
+                del self._queue[i]
+                break
+        if entry[3].active():
+            entry[3].cancel()
+
+    def _expire(self, entry):
+        self._dequeue(entry)
+        self.rejected += 1
+        entry[0].errback(ServerBusy("Server busy, timed out waiting for "
+                                    "a free slot", self.retry_after))
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+import collections
+import weakref
+
+from zope.interface import implements
+from twisted.internet import reactor
+from twisted.internet.interfaces import IConsumer, IPushProducer
+
+
+class TokenBucket(object):
+    """Allows rate bytes per second and bursts of up to capacity bytes
+
+    Sending may overdraw the bucket by up to capacity bytes, nothing
+    more is sent until it refilled."""
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def full(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+class BandwidthShaper(object):
+    """Limits the bandwidth of responses with token buckets
+
+    Limits in bytes per second apply to all responses together, per
+    user, per client address and per repository, None disables a limit
+    (anonymous users are only subject to the others). After a pause,
+    bursts of burst seconds worth of a limit are allowed. Responses
+    held back by a limit are sent round robin, quantum bytes at a time,
+    so they share the bandwidth evenly."""
+
+    quantum = 16384
+    interval = 0.05
+    prune_interval = 60
+
+    def __init__(self, rate=None, per_user=None, per_address=None,
+                 per_repository=None, burst=1.0, clock=reactor):
+        self.limits = (('all', rate), ('user', per_user),
+                       ('address', per_address),
+                       ('repository', per_repository))
+        self.burst = burst
+        self.clock = clock
+
+        self.throttled = 0
+        # buckets live as long as a response uses them and are kept
+        # until they refilled, a new bucket would allow a new burst
+        self._buckets = weakref.WeakValueDictionary()
+        self._refilling = set()
+        self._pruned = clock.seconds()
+        self._waiting = []
+        self._call = None
+
+    @property
+    def waiting(self):
+        return len(self._waiting)
+
+    def shape(self, consumer, username=None, address=None,
+              repository=None):
+        """Get a consumer passing writes on to consumer within the limits
+
+        It takes the place of consumer: producers are registered with it
+        and loseConnection or finish are passed on once everything held
+        back was written. If no limit applies, consumer is returned."""
+        now = self.clock.seconds()
+        if now - self._pruned >= self.prune_interval:
+            self._pruned = now
+            self._refilling = set(bucket for bucket in self._refilling
+                                  if not bucket.full(now))
+
+        keys = {'all': '', 'user': username, 'address': address,
+                'repository': repository}
+        buckets = []
+        for kind, rate in self.limits:
+            if rate is not None and keys[kind] is not None:
+                buckets.append(self._bucket((kind, keys[kind]), rate))
+        if not buckets:
+            return consumer
+        return ShapedConsumer(self, consumer, buckets)
+
+    def _bucket(self, key, rate):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, max(rate * self.burst, self.quantum),
+                                 self.clock.seconds())
+            self._buckets[key] = bucket
+        return bucket
+
+    def _take(self, buckets, size):
+        """Take size tokens unless one of buckets is exhausted
+
+        Callers take at most quantum tokens at once, a bucket is not
+        overdrawn by more than its capacity either way."""
+        now = self.clock.seconds()
+        for bucket in buckets:
+            bucket.refill(now)
+            if bucket.tokens <= 0:
+                return False
+        for bucket in buckets:
+            bucket.tokens = max(bucket.tokens - size, -bucket.capacity)
+            self._refilling.add(bucket)
+        return True
+
+    def _wait(self, consumer):
+        self.throttled += 1
+        self._waiting.append(consumer)
+        if self._call is None:
+            self._call = self.clock.callLater(self.interval, self._send)
+
+    def _forget(self, consumer):
+        if consumer in self._waiting:
+            self._waiting.remove(consumer)
+
+    def _send(self):
+        self._call = None
+
+        progress = True
+        while progress and self._waiting:
+            # consumers which could not send go first in the next round
+            waiting, self._waiting = self._waiting, []
+            progress = False
+            blocked = []
+            sent = []
+            drained = []
+            for consumer in waiting:
+                if consumer.stopped:
+                    continue
+                size = min(self.quantum, consumer.pendingSize)
+                if not self._take(consumer.buckets, size):
+                    blocked.append(consumer)
+                elif size:
+                    progress = True
+                    consumer._sendPending(size)
+                    sent.append(consumer)
+                else:
+                    # resume the producer only once there are tokens
+                    # for what it produces next
+                    drained.append(consumer)
+            self._waiting = blocked + sent + self._waiting
+
+            # may produce more and wait again
+            for consumer in drained:
+                consumer._drained()
+
+        if self._waiting and self._call is None:
+            self._call = self.clock.callLater(self.interval, self._send)
+
+
+class ShapedConsumer(object):
+    """Writes to a consumer as the token buckets of a BandwidthShaper
+    allow, see BandwidthShaper.shape
+
+    While writes are held back, the producer is paused."""
+    implements(IConsumer, IPushProducer)
+
+    producer = None
+    streaming = True
+    paused = False
+    throttled = False
+    stopped = False
+
+    def __init__(self, shaper, consumer, buckets):
+        self.shaper = shaper
+        self.consumer = consumer
+        self.buckets = buckets
+        self.pending = collections.deque()
+        self.pendingSize = 0
+        self._closing = []
+
+    # IConsumer
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        self.streaming = streaming
+        self.consumer.registerProducer(self, streaming)
+
+    def unregisterProducer(self):
+        self.producer = None
+        self.consumer.unregisterProducer()
+
+    def write(self, data):
+        if self.stopped:
+            return
+        if not self.pending:
+            # pass on what the buckets allow right away, a quantum at a
+            # time so they are overdrawn by less than a quantum
+            quantum = self.shaper.quantum
+            allowed = 0
+            while allowed < len(data) and self.shaper._take(
+                    self.buckets, min(quantum, len(data) - allowed)):
+                allowed += quantum
+            if allowed >= len(data):
+                self.consumer.write(data)
+                return
+            if allowed:
+                self.consumer.write(data[:allowed])
+                data = data[allowed:]
+
+        self.pending.append(data)
+        self.pendingSize += len(data)
+        if self.producer is not None and self.streaming:
+            # the consumer may have resumed it in the meantime
+            self.producer.pauseProducing()
+        if not self.throttled:
+            self.throttled = True
+            self.shaper._wait(self)
+
+    def writeSequence(self, seq):
+        self.write(''.join(seq))
+
+    def loseConnection(self):
+        self._whenDrained(self.consumer.loseConnection)
+
+    def finish(self):
+        self._whenDrained(self.consumer.finish)
+
+    def _whenDrained(self, f):
+        if self.throttled and not self.stopped:
+            self._closing.append(f)
+        else:
+            f()
+
+    def _sendPending(self, size):
+        chunks = []
+        while size > 0:
+            data = self.pending.popleft()
+            if len(data) > size:
+                self.pending.appendleft(data[size:])
+                data = data[:size]
+            chunks.append(data)
+            size -= len(data)
+        data = ''.join(chunks)
+        self.pendingSize -= len(data)
+        self.consumer.write(data)
+
+    def _drained(self):
+        self.throttled = False
+        closing, self._closing = self._closing, []
+        for f in closing:
+            f()
+        if self.producer is not None and not self.paused:
+            self.producer.resumeProducing()
+
+    # IPushProducer, towards the consumer
+    def pauseProducing(self):
+        self.paused = True
+        if self.producer is not None:
+            self.producer.pauseProducing()
+
+    def resumeProducing(self):
+        self.paused = False
+        if self.producer is not None and not self.throttled:
+            self.producer.resumeProducing()
+
+    def stopProducing(self):
+        self.stopped = True
+        self.pending.clear()
+        self.pendingSize = 0
+        self.shaper._forget(self)
+        if self.producer is not None:
+            self.producer.stopProducing()
@@ -20,14 +20,27 @@
 from twisted.cred import portal
 from twisted.conch import avatar
 from twisted.conch.checkers import SSHPublicKeyDatabase
-from twisted.conch.ssh import factory, session
+from twisted.conch.ssh import common, connection, factory, session, userauth
 from twisted.internet import reactor, defer
 from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.interfaces import IConsumer
 from twisted.python import log, components
 from zope.interface import implements
 import shlex
 
+from gitserverglue.bundles import advertise_bundle
 from gitserverglue.common import ErrorProcess, PasswordChecker
+from gitserverglue.common import ProcessProtocolProxy, PendingProcess
+from gitserverglue.common import repository_updated
+from gitserverglue.common import protocol_env, protocol_version
+from gitserverglue.metrics import monotonic, track_request, untracked
+from gitserverglue.mirror import MirrorUnavailable
+from gitserverglue.pktline import FLUSH
+from gitserverglue.proxy import BackendConnection, BackendProcess
+from gitserverglue.refs import AdvertisementSkipper, ADVERTISED_UPLOAD_PACK_ENV
+from gitserverglue.scheduler import ServerBusy, PRIORITY_FETCH, PRIORITY_PUSH
+from gitserverglue.timeouts import connection_timer, untimed
+from gitserverglue.tracing import start_span, unsampled
 
 
 class GitAvatar(avatar.ConchUser):
@@ -36,7 +49,40 @@ class GitAvatar(avatar.ConchUser):
         self.username = username
         self.authnz = authnz
         self.git_configuration = git_configuration
-        self.channelLookup.update({'session': session.SSHSession})
+        self.channelLookup.update({'session': GitSSHSession})
+        self.authenticated = monotonic()
+
+
+class GitSSHSession(session.SSHSession):
+    """Passes environment variables the client sets (the SSH client git
+    runs sends GIT_PROTOCOL) on to GitSession.setEnv"""
+
+    def request_env(self, data):
+        name, rest = common.getNS(data)
+        value, rest = common.getNS(rest)
+        if not self.session:
+            self.session = session.ISession(self.avatar)
+        if self.session.setEnv(name, value):
+            return 1
+        log.msg('Ignoring environment variable %s' % name)
+        return 0
+
+
+class GitUserAuthServer(userauth.SSHUserAuthServer):
+    """Remembers when authentication started, to trace how long it took"""
+
+    def serviceStarted(self):
+        self.transport.authStarted = monotonic()
+        userauth.SSHUserAuthServer.serviceStarted(self)
+
+
+class GitSSHConnection(connection.SSHConnection):
+    """Ends the handshake timeout of the ConnectionTimer, if any, once
+    the user is authenticated"""
+
+    def serviceStarted(self):
+        connection.SSHConnection.serviceStarted(self)
+        connection_timer(self.transport.transport).authenticated()
 
 
 class GitRealm:
@@ -52,19 +98,181 @@ class GitRealm:
                                         self.git_configuration), lambda: None
 
 
+class SessionOutput(object):
+    """The session as consumer of the output of git-shell, to be
+    limited by BandwidthShaper.shape
+
+    The SSH channel buffers everything written to it and never pauses
+    a producer. loseConnection passes the end of git on to the session."""
+    implements(IConsumer)
+
+    reason = None
+
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def write(self, data):
+        self.wrapped.childDataReceived(1, data)
+
+    def loseConnection(self):
+        self.wrapped.childConnectionLost(1)
+        self.wrapped.processEnded(self.reason)
+
+
+class GitShellProtocol(ProcessProtocolProxy):
+    """Wraps the session protocol of a git-shell process
+
+    Releases the process slot and notifies caches once a push
+    completed."""
+
+    slot = None
+    skipper = None
+    tracker = untracked
+    span = unsampled
+    timer = untimed
+    waiting = True
+    output = None
+
+    def __init__(self, wrapped, git_configuration, repository_fs_path, rpc):
+        ProcessProtocolProxy.__init__(self, wrapped)
+        self.git_configuration = git_configuration
+        self.repository_fs_path = repository_fs_path
+        self.rpc = rpc
+
+    def shape(self, shaper, username, address):
+        """Send the output of git within the limits of a BandwidthShaper"""
+        self.session_output = SessionOutput(self.wrapped)
+        self.output = shaper.shape(self.session_output, username, address,
+                                   self.repository_fs_path)
+
+    def makeConnection(self, transport):
+        ProcessProtocolProxy.makeConnection(self, transport)
+        if self.output is not None:
+            self.output.registerProducer(transport, True)
+
+    def childDataReceived(self, childFD, data):
+        if childFD == 1:
+            if self.skipper is not None:
+                # the advertisement was already sent by RefAdvertiser
+                data = self.skipper.feed(data)
+                if not data:
+                    return
+            if self.waiting:
+                self.waiting = False
+                self.span.mark('first_byte')
+                self.tracker.first_byte()
+            if self.output is not None:
+                self.output.write(data)
+                return
+        ProcessProtocolProxy.childDataReceived(self, childFD, data)
+
+    def childConnectionLost(self, childFD):
+        if childFD == 1 and self.output is not None:
+            return  # once the output was sent, see processEnded
+        ProcessProtocolProxy.childConnectionLost(self, childFD)
+
+    def processEnded(self, reason):
+        self.tracker.process_ended(reason)
+        self.timer.remove_process(self.transport)
+        self.span.mark('stream')
+        self.span.set('exit_code', reason.value.exitCode)
+        if self.slot is not None:
+            self.slot.release()
+        if self.rpc == 'git-receive-pack' and \
+                self.repository_fs_path is not None and \
+                reason.value.exitCode == 0:
+            repository_updated(self.git_configuration,
+                               self.repository_fs_path)
+        if self.output is None:
+            ProcessProtocolProxy.processEnded(self, reason)
+            return
+
+        self.session_output.reason = reason
+        self.output.unregisterProducer()
+        self.output.loseConnection()
+
+
+class AdvertisedProcess(PendingProcess):
+    """Stands in for upload-pack after the refs were advertised without it
+
+    As soon as the first packet of the client arrived, decided is called
+    with True if the client wants objects or False if it is done."""
+
+    received = 0
+
+    def __init__(self, decided):
+        PendingProcess.__init__(self)
+        self.decided = decided
+
+    def write(self, data):
+        PendingProcess.write(self, data)
+        if self.received < 4:
+            self.received += len(data)
+            if self.received >= 4:
+                self.decided(''.join(self.buffer)[:4] != FLUSH)
+
+
 class GitSession:
+    span = unsampled
+    timer = untimed
+
     def __init__(self, avatar):
         self.avatar = avatar
         self.ptrans = None
+        self.authorization = None  # waiting for path_lookup or authnz
+        self.protocol = {}  # environment passing GIT_PROTOCOL on to git
+
+    def setEnv(self, name, value):
+        """Accept an environment variable of the client, returns False
+        for everything but GIT_PROTOCOL"""
+        if name != 'GIT_PROTOCOL':
+            return False
+        self.protocol = protocol_env(value)
+        return True
 
     def execCommand(self, proto, cmd):
+        # the span starts with the authentication of the connection
+        auth_started = getattr(proto.session.conn.transport, 'authStarted',
+                               None)
+        self.span = start_span(self.avatar.git_configuration, 'ssh',
+                               auth_started)
+        if auth_started is not None:
+            self.span.add_phase('auth', auth_started,
+                                self.avatar.authenticated)
+        self.span.mark('session')
+        self.span.set('user', self.avatar.username)
+        self.timer = connection_timer(proto.session.conn.transport.transport)
+        self.timer.request_started()
+
         cmdparts = shlex.split(cmd)
         rpc = cmdparts[0]
         path = cmdparts[-1]
 
-        path_info = self.avatar.git_configuration.path_lookup(path,
-                                    protocol_hint="ssh")
-        if path_info is None or path_info['repository_fs_path'] is None:
+        # both may be asynchronous, e.g. asking a permission service
+        d = self.authorization = defer.maybeDeferred(
+                self.avatar.git_configuration.path_lookup, path,
+                protocol_hint="ssh")
+        d.addCallback(self._lookedUp, proto, rpc, path)
+        d.addCallback(self._authorized, proto, rpc, path)
+        d.addErrback(self._authorizationFailed, proto)
+        if self.authorization is not None:
+            # the session writes client data to the transport of proto
+            # while authorizing
+            self.ptrans = proto.transport = PendingProcess(d.cancel)
+
+    def _lookedUp(self, path_info, proto, rpc, path):
+        """Check the access to a looked up repository, giving
+        (path_info, allowed), or None if the request was rejected"""
+        self.span.mark('lookup')
+        if path_info is None or (
+                path_info['repository_fs_path'] is None and
+                path_info.get('repository_backend') is None):
             log.msg('User %s tried to access %s but the translator did '
                     'not return a real path' % (self.avatar.username, path))
             return self._kill_connection(proto, "Unknown Repository")
@@ -72,27 +280,220 @@ class GitSession:
         if rpc not in ['git-upload-pack', 'git-receive-pack']:
             log.err('Unknown RPC: ' + rpc)
             return self._kill_connection(proto, "Unknown RPC")
-
-        if (rpc == 'git-upload-pack' and
-            not self.avatar.authnz.can_read(self.avatar.username, path_info)):
+        self.span.set('rpc', rpc[4:])
+        self.span.set('repository', path_info['repository_fs_path'])
+
+        if rpc == 'git-receive-pack' and \
+                path_info.get('repository_upstream') is not None:
+            return self._kill_connection(proto, "Mirrors are read only")
+
+        if rpc == 'git-upload-pack':
+            check = self.avatar.authnz.can_read
+        else:
+            check = self.avatar.authnz.can_write
+        d = defer.maybeDeferred(check, self.avatar.username, path_info)
+        return d.addCallback(lambda allowed: (path_info, allowed))
+
+    def _authorized(self, result, proto, rpc, path):
+        self.authorization = None
+        if result is None:
+            return
+        path_info, allowed = result
+        self.span.mark('authorize')
+
+        if rpc == 'git-upload-pack' and not allowed:
             log.msg('User %s tried to access %s but '
                     'does not have read permissions' % (self.avatar.username,
                                                             path))
             return self._kill_connection(proto,
                                          "You don't have read permissions")
 
-        if (rpc == 'git-receive-pack' and
-            not self.avatar.authnz.can_write(self.avatar.username, path_info)):
+        if rpc == 'git-receive-pack' and not allowed:
             log.msg('User %s tried to access %s but does not have '
                     'write permissions' % (self.avatar.username, path))
             return self._kill_connection(proto,
                                          "You don't have write permissions")
 
+        gitproto = GitShellProtocol(proto, self.avatar.git_configuration,
+                                    path_info['repository_fs_path'], rpc)
+        gitproto.tracker = track_request(self.avatar.git_configuration,
+                                         'ssh', rpc[4:])
+        gitproto.span = self.span
+        gitproto.timer = self.timer
+        shaper = getattr(self.avatar.git_configuration, 'bandwidth_shaper',
+                         None)
+        if shaper is not None:
+            peer = proto.session.conn.transport.transport.getPeer()
+            gitproto.shape(shaper, self.avatar.username, peer.host)
+
+        if path_info.get('repository_backend') is not None:
+            return self._proxy(gitproto, path_info['repository_backend'],
+                               path)
+
+        mirrors = getattr(self.avatar.git_configuration, 'mirror_manager',
+                          None)
+        if mirrors is not None and \
+                path_info.get('repository_upstream') is not None:
+            d = mirrors.refresh(path_info['repository_fs_path'],
+                                path_info['repository_upstream'])
+            if self.ptrans is None:
+                # the session writes client data to the transport of
+                # proto while the mirror is refreshed
+                self.ptrans = gitproto.wrapped.transport = PendingProcess()
+            self.ptrans.cancelled = d.cancel
+            d.addCallbacks(self._mirrorRefreshed, self._mirrorFailed,
+                           callbackArgs=(proto, gitproto, path_info, rpc),
+                           errbackArgs=(gitproto,))
+            return
+
+        self._serve(proto, gitproto, path_info, rpc)
+
+    def _authorizationFailed(self, failure, proto):
+        self.authorization = None
+        if failure.check(defer.CancelledError):
+            return
+        log.err(failure, 'Authorizing the request of %s failed' % (
+                    self.avatar.username,))
+        self._kill_connection(proto, "Authorization failed")
+
+    def _serve(self, proto, gitproto, path_info, rpc):
+        """Advertise the refs or start git for an authorized request"""
         gitshell = self.avatar.git_configuration.git_shell_binary
         cmdargs = ['git-shell', '-c',
                    rpc + ' \'' + path_info['repository_fs_path'] + '\'']
+
+        advertiser = getattr(self.avatar.git_configuration, 'ref_advertiser',
+                             None)
+        if protocol_version(self.protocol) != 0:
+            advertiser = None  # only knows the v0 advertisement
+        if rpc == 'git-upload-pack' and advertiser is not None:
+            advertisement = advertiser.advertise(
+                                path_info['repository_fs_path'])
+            if advertisement is not None:
+                # git is only needed once the client wants objects
+                gitproto.skipper = AdvertisementSkipper()
+                gitproto.tracker.first_byte()
+                proto.childDataReceived(1, advertisement)
+                self.span.mark('advertise')
+                pending = self.ptrans
+                self.ptrans = proto.transport = AdvertisedProcess(
+                    lambda wants: self._advertised(wants, proto, gitproto,
+                                                   gitshell, cmdargs))
+                if pending is not None:
+                    pending.attach(self.ptrans)
+                return
+
+        env = self.protocol
+        if rpc == 'git-upload-pack':
+            env = advertise_bundle(self.avatar.git_configuration, path_info,
+                                   env)
+        self._start(gitproto, gitshell, cmdargs, env)
+
+    def _proxy(self, gitproto, pool, path):
+        """Pass the request on to a node of a BackendPool"""
+        connection = BackendConnection(gitproto.rpc, path, self.protocol,
+                                       self.avatar.username)
+        d = pool.connect(connection,
+                         write=gitproto.rpc == 'git-receive-pack')
+        if self.ptrans is None:
+            # the session writes client data to the transport of proto
+            # while connecting
+            self.ptrans = gitproto.wrapped.transport = PendingProcess()
+        self.ptrans.cancelled = d.cancel
+        d.addCallbacks(self._backendConnected, self._backendFailed,
+                       callbackArgs=(gitproto, connection),
+                       errbackArgs=(gitproto,))
+
+    def _backendConnected(self, backend, gitproto, connection):
+        self.span.set('backend', repr(backend))
+        self.span.mark('connect')
+        pending = self.ptrans
+        self.ptrans = BackendProcess(gitproto, connection)
+        gitproto.makeConnection(self.ptrans)
+        pending.attach(self.ptrans)
+
+    def _backendFailed(self, failure, gitproto):
+        if failure.check(defer.CancelledError):
+            return
+        log.msg('Proxying the request of %s failed: %s' % (
+                    self.avatar.username, failure.getErrorMessage()))
+        self.ptrans = None
+        self._kill_connection(gitproto.wrapped, "Repository unavailable")
+
+    def _mirrorRefreshed(self, ignored, proto, gitproto, path_info, rpc):
+        self.span.mark('refresh')
+        self._serve(proto, gitproto, path_info, rpc)
+
+    def _mirrorFailed(self, failure, gitproto):
+        if failure.check(defer.CancelledError):
+            return
+        failure.trap(MirrorUnavailable)
+        log.msg('Refreshing the mirror for %s failed: %s' % (
+                    self.avatar.username, failure.getErrorMessage()))
+        self.ptrans = None
+        self._kill_connection(gitproto.wrapped,
+                              "Upstream repository unavailable")
+
+    def _advertised(self, wants, proto, gitproto, gitshell, cmdargs):
+        self.span.mark('negotiate')
+        if not wants:
+            # the client only wanted to list the refs
+            self.ptrans = None
+            return ErrorProcess(proto, 0, None)
+        self._start(gitproto, gitshell, cmdargs, ADVERTISED_UPLOAD_PACK_ENV)
+
+    def _start(self, gitproto, gitshell, cmdargs, env={}):
+        scheduler = getattr(self.avatar.git_configuration,
+                            'process_scheduler', None)
+        if scheduler is None:
+            return self._spawn(gitproto, gitshell, cmdargs, env)
+
+        priority = PRIORITY_FETCH
+        if gitproto.rpc == 'git-receive-pack':
+            priority = PRIORITY_PUSH
+
+        d = scheduler.acquire(gitproto.repository_fs_path,
+                              self.avatar.username, priority)
+        if self.ptrans is None:
+            # the session writes client data to the transport of proto
+            # while waiting for a process slot
+            self.ptrans = gitproto.wrapped.transport = PendingProcess()
+        self.ptrans.cancelled = d.cancel
+        d.addCallbacks(self._slotAcquired, self._slotFailed,
+                       callbackArgs=(gitproto, gitshell, cmdargs, env),
+                       errbackArgs=(gitproto.wrapped,))
+
+    def _spawn(self, gitproto, gitshell, cmdargs, env, slot=None):
+        gitproto.slot = slot
+        pending = self.ptrans
+
         log.msg("Spawning %s with args %r" % (gitshell, cmdargs))
-        self.ptrans = reactor.spawnProcess(proto, gitshell, cmdargs)
+        gitproto.tracker.process_started()
+        try:
+            self.ptrans = reactor.spawnProcess(gitproto, gitshell, cmdargs,
+                                               env)
+        except:
+            if slot is not None:
+                slot.release()
+            raise
+
+        self.span.mark('spawn')
+        self.timer.add_process(self.ptrans)
+        if pending is not None:
+            pending.attach(self.ptrans)
+
+    def _slotAcquired(self, slot, gitproto, gitshell, cmdargs, env):
+        self.span.mark('queue')
+        self._spawn(gitproto, gitshell, cmdargs, env, slot)
+
+    def _slotFailed(self, failure, proto):
+        if failure.check(defer.CancelledError):
+            return
+        failure.trap(ServerBusy)
+        log.msg('Rejecting request of %s: %s' % (self.avatar.username,
+                                                 failure.value.message))
+        self.ptrans = None
+        self._kill_connection(proto, failure.value.message)
 
     def getPty(self, term, windowSize, attrs):
         pass
@@ -101,6 +502,7 @@ class GitSession:
         self._kill_connection(proto, "Shell access not allowed\n")
 
     def _kill_connection(self, proto, msg):
+        self.ptrans = None  # e.g. a PendingProcess
         ErrorProcess(proto, 128, msg)
 
     def eofReceived(self):
@@ -108,6 +510,9 @@ class GitSession:
             self.ptrans.closeStdin()
 
     def closed(self):
+        self.span.mark('drain')
+        self.span.end()
+        self.timer.request_finished()
         if self.ptrans:
             try:
                 self.ptrans.signalProcess('HUP')
@@ -132,15 +537,27 @@ def create_factory(private_keys, public_keys, authnz, git_configuration):
     class GitSSHFactory(factory.SSHFactory):
         publicKeys = public_keys
         privateKeys = private_keys
+        services = dict(factory.SSHFactory.services)
+        services['ssh-userauth'] = GitUserAuthServer
+        services['ssh-connection'] = GitSSHConnection
 
     gitportal = portal.Portal(GitRealm(authnz, git_configuration))
 
+    metrics = getattr(git_configuration, 'metrics', None)
     if hasattr(authnz, 'check_password'):
         log.msg("Registering PasswordChecker")
-        gitportal.registerChecker(PasswordChecker(authnz.check_password))
+        check_password = authnz.check_password
+        if metrics is not None:
+            check_password = metrics.timed_check(check_password, 'ssh',
+                                                 'password')
+        gitportal.registerChecker(PasswordChecker(check_password))
     if hasattr(authnz, 'check_publickey'):
         log.msg("Registering PublicKeyChecker")
-        gitportal.registerChecker(PublicKeyChecker(authnz.check_publickey))
+        check_publickey = authnz.check_publickey
+        if metrics is not None:
+            check_publickey = metrics.timed_check(check_publickey, 'ssh',
+                                                  'publickey')
+        gitportal.registerChecker(PublicKeyChecker(check_publickey))
 
     GitSSHFactory.portal = gitportal
 
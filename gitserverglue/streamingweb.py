@@ -19,23 +19,39 @@
 
 from urllib import unquote
 import string
+import zlib
 
 from twisted.internet.interfaces import IConsumer
 from twisted.web.http import HTTPChannel, parse_qs, datetimeToString
 from twisted.web.server import Request, version
 from twisted.web.resource import IResource, getChildForRequest
 from twisted.web.util import DeferredResource
-from twisted.python import failure
+from twisted.python import failure, log
+
+from gitserverglue.compression import BodyTooLarge, MAX_DECODED_SIZE
+from gitserverglue.compression import content_decoder, decoded
+from gitserverglue.timeouts import connection_timer, untimed
 
 
 class StreamingRequest(Request):
-    """Modified Request to support streaming content"""
+    """Modified Request to support streaming content
+
+    gzip or deflate encoded content is decompressed as it arrives, in
+    both modes. The connection is dropped if it is corrupt, truncated
+    or larger than maxDecodedSize once decompressed."""
 
     _fallbackToBuffered = True
+    _decoder = None
+    _discardContent = False
     fallbackContentTypes = [
         'multipart/form-data',
         'application/x-www-form-urlencoded'
     ]
+    maxDecodedSize = MAX_DECODED_SIZE
+    # content received while a DeferredResource is resolved, and the
+    # arguments of requestReceived if the content is complete already
+    _pendingContent = None
+    _pendingRequest = None
 
     def requestHeadersReceived(self, command, path, version):
         """Called when a StreamingHTTPChannel received all headers
@@ -47,6 +63,10 @@ class StreamingRequest(Request):
         However, if these conditions are not met, streaming
         mode will be used."""
 
+        self._decoder = content_decoder(self.requestHeaders,
+                                        self._contentReceived,
+                                        self.maxDecodedSize)
+
         ctype = self.requestHeaders.getRawHeaders('content-type')
         if ctype is not None:
             ctype = ctype[0]
@@ -81,7 +101,18 @@ class StreamingRequest(Request):
         self.process()
 
     def requestReceived(self, command, path, version):
-        if self._fallbackToBuffered:
+        if self._discardContent:
+            return
+        if self._decoder is not None:
+            try:
+                self._decoder.finish()
+            except zlib.error as e:
+                self._dropUndecodable(e)
+                return
+            decoded(self.requestHeaders, self._decoder.size)
+        if self._pendingContent is not None:
+            self._pendingRequest = (command, path, version)
+        elif self._fallbackToBuffered:
             Request.requestReceived(self, command, path, version)
         else:
             self.resource.unregisterProducer()
@@ -102,6 +133,7 @@ class StreamingRequest(Request):
         self.prepath = []
         self.postpath = map(unquote, string.split(self.path[1:], '/'))
 
+        self._pendingContent = []
         try:
             self.processResource(self.site.getResourceFor(self))
         except:
@@ -110,18 +142,27 @@ class StreamingRequest(Request):
     def processResource(self, resource):
         if not isinstance(resource, DeferredResource):
             resource = getChildForRequest(resource, self)
+            # e.g. a child determined asynchronously behind a proxy
+            real = self._getRealResource(resource)
+            if isinstance(real, DeferredResource):
+                resource = real
 
         if isinstance(resource, DeferredResource):
             resource.d.addCallback(self.processResource).addErrback(
                 self.processingFailed)
         else:
             self.resource = self._getRealResource(resource)
+            pending, self._pendingContent = self._pendingContent, None
 
             if IConsumer.providedBy(self.resource):
                 self.resource.registerProducer(self.channel.transport, True)
                 self.render(resource)  # use resource here to not break proxies
             else:
                 self._fallbackToBuffered = True
+            for data in pending or ():
+                self._contentReceived(data)
+            if self._pendingRequest is not None:
+                self.requestReceived(*self._pendingRequest)
 
             # resource is determined, resume producing
             self.channel.transport.resumeProducing()
@@ -143,22 +184,55 @@ class StreamingRequest(Request):
         raise Exception("Unable to find real resource")
 
     def handleContentChunk(self, data):
-        if self._fallbackToBuffered:
+        if self._discardContent:
+            return
+        if self._decoder is None:
+            return self._contentReceived(data)
+
+        try:
+            self._decoder.write(data)
+        except (BodyTooLarge, zlib.error) as e:
+            self._dropUndecodable(e)
+
+    def _dropUndecodable(self, reason):
+        log.msg("Dropping connection, cannot decode request body of "
+                "%s: %s" % (self.uri, reason))
+        self._discardContent = True
+        self.channel.transport.loseConnection()
+
+    def _contentReceived(self, data):
+        if self._pendingContent is not None:
+            self._pendingContent.append(data)
+        elif self._fallbackToBuffered:
             self.content.write(data)
         else:
             self.resource.write(data)
 
 
 class StreamingHTTPChannel(HTTPChannel):
-    """Modified HTTPChannel to support streaming requests"""
+    """Modified HTTPChannel to support streaming requests
+
+    Requests are reported to the ConnectionTimer of the connection, if
+    any, from the time their headers are complete."""
+
+    timer = untimed
+
+    def connectionMade(self):
+        HTTPChannel.connectionMade(self)
+        self.timer = connection_timer(self.transport)
 
     def allHeadersReceived(self):
         HTTPChannel.allHeadersReceived(self)
+        self.timer.request_started()
         req = self.requests[-1]
         if hasattr(req, "requestHeadersReceived"):
             req.requestHeadersReceived(self._command,
                                        self._path, self._version)
 
+    def requestDone(self, request):
+        self.timer.request_finished()
+        HTTPChannel.requestDone(self, request)
+
 
 def make_site_streaming(site):
     site.requestFactory = StreamingRequest
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+import os
+from ConfigParser import SafeConfigParser
+from StringIO import StringIO
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from gitserverglue.acl import CompiledPermissions, PermissionIndex
+
+PERMISSIONS = """
+[groups]
+devs = Alice, bob
+
+[project/main.git]
+alice = r
+@devs = w
+* = r
+anonymous = r
+
+[project/*]
+bob = rw
+* = r
+
+[project/secret-*]
+carol = rw
+
+[*]
+anonymous = r
+"""
+
+
+def compile_permissions(text):
+    config = SafeConfigParser()
+    config.readfp(StringIO(text))
+    return CompiledPermissions(config)
+
+
+class CompiledPermissionsTests(unittest.TestCase):
+    def setUp(self):
+        self.permissions = compile_permissions(PERMISSIONS)
+
+    def test_exact_section_combines_levels(self):
+        self.assertEqual(self.permissions.resolve('project/main.git',
+                                                  'alice'), 'rw')
+        self.assertEqual(self.permissions.resolve('project/main.git',
+                                                  'bob'), 'rw')
+        self.assertEqual(self.permissions.resolve('project/main.git',
+                                                  'dave'), 'r')
+
+    def test_anonymous_is_not_authenticated(self):
+        self.assertEqual(self.permissions.resolve('project/main.git',
+                                                  'anonymous'), 'r')
+        self.assertEqual(self.permissions.resolve('project/other.git',
+                                                  'anonymous'), 'r')
+        self.assertEqual(self.permissions.resolve('other.git',
+                                                  'anonymous'), 'r')
+
+    def test_pattern(self):
+        self.assertEqual(self.permissions.resolve('project/other.git',
+                                                  'bob'), 'rw')
+        self.assertEqual(self.permissions.resolve('project/other.git',
+                                                  'dave'), 'r')
+
+    def test_most_specific_pattern_first(self):
+        self.assertEqual(self.permissions.resolve('project/secret-1.git',
+                                                  'carol'), 'rw')
+        # the more specific section does not mention bob
+        self.assertEqual(self.permissions.resolve('project/secret-1.git',
+                                                  'bob'), 'rw')
+
+    def test_no_match(self):
+        self.assertEqual(self.permissions.resolve('other.git', 'bob'), '')
+
+
+class PermissionIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.perms_file = self.mktemp()
+        self.write(PERMISSIONS)
+        self.index = PermissionIndex(self.perms_file, check_interval=2,
+                                     clock=self.clock)
+
+    def write(self, text):
+        with open(self.perms_file + '.tmp', 'wb') as f:
+            f.write(text)
+        os.rename(self.perms_file + '.tmp', self.perms_file)
+
+    def test_levels(self):
+        self.assertTrue(self.index.allowed('project/main.git', 'Alice', 'w'))
+        self.assertTrue(self.index.allowed('project/main.git', None, 'r'))
+        self.assertFalse(self.index.allowed('project/main.git', None, 'w'))
+
+    def test_reload(self):
+        self.assertEqual(self.index.levels('new.git', 'dave'), '')
+        self.write(PERMISSIONS + "\n[new.git]\ndave = rw\n")
+        self.assertEqual(self.index.levels('new.git', 'dave'), '')
+        self.clock.advance(2)
+        self.assertEqual(self.index.levels('new.git', 'dave'), 'rw')
+        self.assertEqual(self.index.reloads, 2)
+
+    def test_broken_file_keeps_permissions(self):
+        self.write("[project/main.git\nalice = rw\n")
+        self.clock.advance(2)
+        self.assertEqual(self.index.levels('project/main.git', 'alice'),
+                         'rw')
+        self.assertEqual(len(self.flushLoggedErrors()), 1)
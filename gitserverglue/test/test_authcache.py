@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from gitserverglue.authcache import CachingAuthnz, Coalescer
+
+
+class Authnz(object):
+    """Answers checks once answer is called"""
+
+    name = 'remote'
+
+    def __init__(self):
+        self.readers = set(['alice'])
+        self.checks = []
+
+    def can_read(self, username, path_info):
+        self.checks.append((defer.Deferred(), username in self.readers))
+        return self.checks[-1][0]
+
+    def can_write(self, username, path_info):
+        return username == 'alice'
+
+    def answer(self):
+        checks, self.checks = self.checks, []
+        for d, allowed in checks:
+            d.callback(allowed)
+
+
+class CoalescerTests(unittest.TestCase):
+    def setUp(self):
+        self.coalescer = Coalescer()
+        self.calls = []
+
+    def call(self, value):
+        self.calls.append(defer.Deferred())
+        return self.calls[-1]
+
+    def test_coalesced(self):
+        first = self.coalescer.call('a', self.call, 1)
+        second = self.coalescer.call('a', self.call, 1)
+        other = self.coalescer.call('b', self.call, 2)
+        self.assertEqual((len(self.calls), len(self.coalescer)), (2, 2))
+        self.calls[0].callback('result')
+        self.assertEqual(self.successResultOf(first), 'result')
+        self.assertEqual(self.successResultOf(second), 'result')
+        self.assertNoResult(other)
+        self.assertEqual(self.coalescer.coalesced, 1)
+
+        # a new call once the result arrived
+        self.coalescer.call('a', self.call, 1)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_errback(self):
+        waiting = [self.coalescer.call('a', self.call, 1) for i in range(3)]
+        self.calls[0].errback(ValueError("unavailable"))
+        for d in waiting:
+            self.failureResultOf(d, ValueError)
+        self.assertEqual(len(self.coalescer), 0)
+
+    def test_cancel(self):
+        first = self.coalescer.call('a', self.call, 1)
+        second = self.coalescer.call('a', self.call, 1)
+        first.cancel()
+        self.failureResultOf(first, defer.CancelledError)
+        self.calls[0].callback('result')
+        self.assertEqual(self.successResultOf(second), 'result')
+
+    def test_synchronous(self):
+        self.assertEqual(self.coalescer.call('a', lambda: 1), 1)
+        self.assertEqual(self.coalescer.call('a', defer.succeed, 2).result,
+                         2)
+        self.assertEqual(len(self.coalescer), 0)
+
+
+class CachingAuthnzTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.authnz = Authnz()
+        self.cache = CachingAuthnz(self.authnz, ttl=60, negative_ttl=5,
+                                   max_entries=2, clock=self.clock)
+        self.path_info = {'repository_fs_path': '/srv/a.git'}
+
+    def can_read(self, username, path_info=None):
+        d = self.cache.can_read(username, path_info or self.path_info)
+        self.authnz.answer()
+        return self.successResultOf(d)
+
+    def test_coalesced(self):
+        first = self.cache.can_read('alice', self.path_info)
+        second = self.cache.can_read('alice', dict(self.path_info))
+        self.cache.can_read('bob', self.path_info)
+        self.assertEqual(len(self.authnz.checks), 2)
+        self.authnz.answer()
+        self.assertTrue(self.successResultOf(first))
+        self.assertTrue(self.successResultOf(second))
+        self.assertEqual(self.cache.coalescer.coalesced, 1)
+
+    def test_errback(self):
+        first = self.cache.can_read('alice', self.path_info)
+        second = self.cache.can_read('alice', self.path_info)
+        self.authnz.checks.pop()[0].errback(IOError("unavailable"))
+        self.failureResultOf(first, IOError)
+        self.failureResultOf(second, IOError)
+        # failures are not cached
+        self.assertTrue(self.can_read('alice'))
+
+    def test_expiry(self):
+        self.assertTrue(self.can_read('alice'))
+        self.assertFalse(self.can_read('bob'))
+        self.clock.advance(4)
+        self.assertTrue(self.cache.can_read('alice', self.path_info))
+        self.assertFalse(self.cache.can_read('bob', self.path_info))
+        self.assertEqual(self.cache.hits, 2)
+        self.clock.advance(1)
+        self.can_read('bob')
+        self.assertEqual(self.cache.misses, 3)
+        self.clock.advance(55)
+        self.can_read('alice')
+        self.assertEqual(self.cache.misses, 4)
+
+    def test_nothing_cached_by_default(self):
+        cache = CachingAuthnz(self.authnz, clock=self.clock)
+        for i in range(2):
+            d = cache.can_read('alice', self.path_info)
+            self.authnz.answer()
+            self.assertTrue(self.successResultOf(d))
+        self.assertEqual(cache.hits, 0)
+
+    def test_max_entries(self):
+        for path in ('/srv/a.git', '/srv/b.git', '/srv/c.git', '/srv/a.git'):
+            self.can_read('alice', {'repository_fs_path': path})
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_invalidate(self):
+        self.can_read('alice')
+        self.authnz.readers.clear()
+        self.cache.invalidate()
+        self.assertFalse(self.can_read('alice'))
+
+    def test_synchronous(self):
+        self.assertTrue(self.cache.can_write('alice', self.path_info))
+        self.assertFalse(self.cache.can_write('bob', self.path_info))
+        self.assertEqual(self.cache.name, 'remote')
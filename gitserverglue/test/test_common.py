@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+from twisted.trial import unittest
+
+from gitserverglue.common import protocol_env, protocol_version
+
+
+class ProtocolTests(unittest.TestCase):
+    def test_protocol_env(self):
+        self.assertEqual(protocol_env('version=2'),
+                         {'GIT_PROTOCOL': 'version=2'})
+        self.assertEqual(protocol_env('version=2:object-format=sha1'),
+                         {'GIT_PROTOCOL': 'version=2:object-format=sha1'})
+        self.assertEqual(protocol_env(None), {})
+        self.assertEqual(protocol_env(''), {})
+
+    def test_malformed_parameters(self):
+        self.assertEqual(protocol_env('version=2:a b:$(id):x=\n::'),
+                         {'GIT_PROTOCOL': 'version=2'})
+        self.assertEqual(protocol_env('x;y=1'), {})
+
+    def test_protocol_version(self):
+        self.assertEqual(protocol_version({}), 0)
+        self.assertEqual(protocol_version(protocol_env('version=1')), 1)
+        self.assertEqual(protocol_version(
+            {'GIT_PROTOCOL': 'version=2:version=1'}), 2)
+        self.assertEqual(protocol_version({'GIT_PROTOCOL': 'version=x'}),
+                         0)
+        self.assertEqual(protocol_version({'GIT_PROTOCOL': 'other=2'}), 0)
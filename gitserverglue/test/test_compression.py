@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+import gzip
+import io
+import zlib
+
+from twisted.trial import unittest
+from twisted.web.http_headers import Headers
+
+from gitserverglue.compression import BodyTooLarge, Decoder, decode_content
+
+
+def gzipped(data):
+    out = io.BytesIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb')
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+
+class DecoderTests(unittest.TestCase):
+    def setUp(self):
+        self.written = []
+        self.decoder = Decoder(self.written.append, max_size=1024 ** 2)
+
+    def test_decode(self):
+        data = 'want %040d\n' * 10000
+        for encoded in (gzipped(data), zlib.compress(data)):
+            del self.written[:]
+            decoder = Decoder(self.written.append)
+            for i in range(0, len(encoded), 100):
+                decoder.write(encoded[i:i + 100])
+            decoder.finish()
+            self.assertEqual(''.join(self.written), data)
+            self.assertEqual(decoder.size, len(data))
+            self.assertTrue(max(map(len, self.written)) <=
+                            Decoder.chunk_size)
+
+    def test_too_large(self):
+        # a few KiB expanding to 2 MiB
+        bomb = gzipped('\0' * 2 * 1024 ** 2)
+        self.assertTrue(len(bomb) < 4096)
+        self.assertRaises(BodyTooLarge, self.decoder.write, bomb)
+        self.assertTrue(sum(map(len, self.written)) <= 1024 ** 2)
+
+    def test_truncated(self):
+        encoded = gzipped('have %040d\n' * 100)
+        for end in (1, len(encoded) // 2, len(encoded) - 1):
+            decoder = Decoder(self.written.append)
+            decoder.write(encoded[:end])
+            self.assertRaises(zlib.error, decoder.finish)
+
+    def test_corrupt(self):
+        self.assertRaises(zlib.error, self.decoder.write, 'not gzip')
+
+
+class DecodeContentTests(unittest.TestCase):
+    def request(self, body):
+        class Request(object):
+            requestHeaders = Headers({'content-encoding': ['gzip']})
+            content = io.BytesIO(body)
+        return Request()
+
+    def test_decode_content(self):
+        request = self.request(gzipped('done\n'))
+        decode_content(request)
+        self.assertEqual(request.content.read(), 'done\n')
+        self.assertEqual(request.requestHeaders.getRawHeaders(
+            'content-length'), ['5'])
+        self.assertFalse(request.requestHeaders.hasHeader(
+            'content-encoding'))
+
+    def test_truncated(self):
+        request = self.request(gzipped('done\n')[:-4])
+        self.assertRaises(zlib.error, decode_content, request)
+
+    def test_too_large(self):
+        request = self.request(gzipped('\0' * 1024))
+        self.assertRaises(BodyTooLarge, decode_content, request, 1000)
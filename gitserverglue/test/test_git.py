@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+from twisted.internet.error import ProcessDone, ProcessTerminated
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from gitserverglue import git
+from gitserverglue.packcache import PackCache
+from gitserverglue.pktline import FLUSH, encode
+
+SHA = 'a' * 40
+
+
+class ProcessTransport(StringTransport):
+    stdinClosed = False
+
+    def closeStdin(self):
+        self.stdinClosed = True
+
+    def signalProcess(self, signal):
+        pass
+
+
+class Authnz(object):
+    def can_read(self, username, path_info):
+        return True
+
+    def can_write(self, username, path_info):
+        return True
+
+
+class Configuration(object):
+    git_binary = 'git'
+    pack_cache = None
+
+    def path_lookup(self, url, protocol_hint=None):
+        return {'repository_fs_path': '/srv/test.git',
+                'repository_base_fs_path': '/srv',
+                'repository_base_url_path': '/'}
+
+
+class RecordingPackCache(PackCache):
+    def __init__(self, path):
+        PackCache.__init__(self, path)
+        self.invalidated = []
+
+    def invalidate(self, repo_path):
+        self.invalidated.append(repo_path)
+        PackCache.invalidate(self, repo_path)
+
+
+class GitProtocolTests(unittest.TestCase):
+    def setUp(self):
+        self.spawned = []
+        self.patch(git.reactor, 'spawnProcess', self.spawnProcess)
+        self.configuration = Configuration()
+        self.configuration.pack_cache = RecordingPackCache(self.mktemp())
+
+    def spawnProcess(self, process, executable, args, env=None):
+        transport = ProcessTransport()
+        self.spawned.append((process, args, transport))
+        process.makeConnection(transport)
+        return transport
+
+    def connect(self, request):
+        proto = git.GitProtocol(Authnz(), self.configuration)
+        transport = StringTransport()
+        proto.makeConnection(transport)
+        proto.dataReceived(encode(request))
+        return proto, transport
+
+    def test_shallow_clone(self):
+        """A shallow client waits for the shallow-update after its wants,
+        so they are passed on to git at the flush"""
+        proto, transport = self.connect(
+                        'git-upload-pack /test.git\0host=localhost\0')
+        process, args, stdin = self.spawned[0]
+        self.assertEqual(args, ['git', 'upload-pack', '/srv/test.git'])
+
+        wants = encode('want %s side-band-64k shallow\n' % SHA) + \
+            encode('deepen 1\n') + FLUSH
+        proto.dataReceived(wants)
+        self.assertEqual(stdin.value(), wants)
+        self.assertIdentical(proto.negotiation, None)
+
+    def test_full_clone_waits_for_done(self):
+        proto, transport = self.connect(
+                        'git-upload-pack /test.git\0host=localhost\0')
+        process, args, stdin = self.spawned[0]
+        wants = encode('want %s side-band-64k\n' % SHA) + FLUSH
+        proto.dataReceived(wants)
+        self.assertEqual(stdin.value(), '')  # possibly cached
+        proto.dataReceived(encode('done\n'))
+        self.assertEqual(stdin.value(), wants + encode('done\n'))
+
+    def push(self, reason):
+        # pushes arrive through a trusted proxy, the default peer of
+        # StringTransport
+        self.configuration.trusted_proxies = ('192.168.1.1',)
+        proto, transport = self.connect(
+                'git-receive-pack /test.git\0host=localhost\0\0user=test\0')
+        process, args, stdin = self.spawned[0]
+        self.assertEqual(args, ['git', 'receive-pack', '/srv/test.git'])
+        process.processEnded(Failure(reason))
+        return self.configuration.pack_cache.invalidated
+
+    def test_push_updates_caches(self):
+        self.assertEqual(self.push(ProcessDone(0)), ['/srv/test.git'])
+
+    def test_failed_push_keeps_caches(self):
+        self.assertEqual(self.push(ProcessTerminated(1)), [])
+
+    def test_user_from_untrusted_peer(self):
+        proto, transport = self.connect(
+                'git-receive-pack /test.git\0host=localhost\0\0user=test\0')
+        self.assertIdentical(proto.username, None)
+        self.assertEqual(self.spawned, [])
+        self.assertIn('ERR Request not supported', transport.value())
+
+    def test_user_from_trusted_proxy(self):
+        self.configuration.trusted_proxies = ('192.168.1.1',)
+        proto, transport = self.connect('git-upload-pack /test.git\0'
+                                        'host=localhost\0\0version=2\0'
+                                        'user=test\0')
+        self.assertEqual(proto.username, 'test')
+        # not passed on to git
+        self.assertEqual(proto.protocol, {'GIT_PROTOCOL': 'version=2'})
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+import os
+
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from gitserverglue.bundles import config_parameters
+from gitserverglue.common import protocol_env
+from gitserverglue.http import InfoRefs
+from gitserverglue.refs import AdvertisementCache
+
+
+class Request(DummyRequest):
+    """A DummyRequest keeping its ETag"""
+
+    etag = None
+
+    def setETag(self, etag):
+        self.etag = etag
+
+
+class RecordingCache(AdvertisementCache):
+    """An AdvertisementCache answering every get with the service"""
+
+    def get(self, repo_path, service, fingerprint):
+        return service
+
+
+class InfoRefsTests(unittest.TestCase):
+    def setUp(self):
+        self.repo = self.mktemp()
+        os.makedirs(os.path.join(self.repo, 'refs', 'heads'))
+        with open(os.path.join(self.repo, 'HEAD'), 'wb') as f:
+            f.write('ref: refs/heads/master\n')
+
+    def render(self, env):
+        request = Request([])
+        request.args = {'service': ['git-upload-pack']}
+        resource = InfoRefs(self.repo, advertisement_cache=RecordingCache(),
+                            env=env)
+        service = resource.render_GET(request)
+        return service, request.etag
+
+    def test_protocol_version(self):
+        v0 = self.render({})
+        v2 = self.render(protocol_env('version=2'))
+        self.assertEqual(v0[0], 'upload-pack')
+        self.assertEqual(v2[0], 'upload-pack-v2')
+        self.assertNotEqual(v0[1], v2[1])
+
+    def test_bundle(self):
+        env = protocol_env('version=2')
+        plain = self.render(env)
+        bundles = []
+        for name in ('first', 'second'):
+            env['GIT_CONFIG_PARAMETERS'] = config_parameters([
+                ('bundle.%s.uri' % name, 'http://localhost/%s' % name)])
+            bundles.append(self.render(env))
+        # neither the cache entry nor the ETag are shared
+        self.assertEqual(len(set([plain[0]] + [b[0] for b in bundles])), 3)
+        self.assertEqual(len(set([plain[1]] + [b[1] for b in bundles])), 3)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+import os
+
+from twisted.internet import reactor, task
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twisted.web.client import Agent, readBody
+from twisted.web.http import PARTIAL_CONTENT
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+from twisted.web.test.requesthelper import DummyRequest
+
+from gitserverglue.immutable import ImmutableFile, MmapProducer, \
+    OpenFileCache, parse_range
+from gitserverglue.metrics import ServerMetrics
+from gitserverglue.shaping import BandwidthShaper
+from gitserverglue.timeouts import ConnectionTimer, Timeouts
+
+
+class Request(DummyRequest):
+    """A DummyRequest taking push producers"""
+
+    producer = None
+
+    def __init__(self, headers={}):
+        DummyRequest.__init__(self, [])
+        for name, value in headers.items():
+            self.requestHeaders.setRawHeaders(name, [value])
+        self.transport = StringTransport()
+        self.sentLength = 0
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def body(self):
+        return ''.join(self.written)
+
+
+class ParseRangeTests(unittest.TestCase):
+    def test_ranges(self):
+        self.assertEqual(parse_range('bytes=0-9', 100), (0, 9))
+        self.assertEqual(parse_range('bytes=90-', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=90-200', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-200', 100), (0, 99))
+
+    def test_ignored(self):
+        self.assertIdentical(parse_range('items=0-9', 100), None)
+        self.assertIdentical(parse_range('bytes=0-9,20-29', 100), None)
+        self.assertIdentical(parse_range('bytes=9-0', 100), None)
+        self.assertIdentical(parse_range('bytes=a-b', 100), None)
+
+    def test_unsatisfiable(self):
+        self.assertRaises(ValueError, parse_range, 'bytes=100-', 100)
+        self.assertRaises(ValueError, parse_range, 'bytes=-0', 100)
+
+
+class ImmutableFileTests(unittest.TestCase):
+    def setUp(self):
+        self.fs_path = self.mktemp()
+        self.data = ''.join(chr(i % 256) for i in range(200000))
+        with open(self.fs_path, 'wb') as f:
+            f.write(self.data)
+        self.open_files = OpenFileCache()
+
+    def render(self, resource, request):
+        self.assertEqual(resource.render(request), NOT_DONE_YET)
+        return request
+
+    def test_get(self):
+        resource = ImmutableFile(self.fs_path, 'application/x-git-pack',
+                                 'abc', self.open_files)
+        request = self.render(resource, Request())
+        self.assertEqual(request.body(), self.data)
+        self.assertEqual(request.finished, 1)
+        self.assertEqual(request.responseHeaders.getRawHeaders(
+                            'content-length'), [str(len(self.data))])
+
+        self.render(resource, Request())
+        self.assertEqual((self.open_files.hits, self.open_files.misses),
+                         (1, 1))
+
+    def test_range(self):
+        resource = ImmutableFile(self.fs_path, 'application/x-git-pack',
+                                 'abc', self.open_files)
+        request = self.render(resource, Request({'range': 'bytes=10-19'}))
+        self.assertEqual(request.responseCode, PARTIAL_CONTENT)
+        self.assertEqual(request.body(), self.data[10:20])
+        self.assertEqual(request.responseHeaders.getRawHeaders(
+                            'content-range'), ['bytes 10-19/200000'])
+
+    def test_shaped(self):
+        clock = task.Clock()
+        shaper = BandwidthShaper(per_repository=100000, clock=clock)
+        resource = ImmutableFile(self.fs_path, 'application/x-git-pack',
+                                 'abc', self.open_files, shaper, None,
+                                 '/srv/test.git')
+        request = self.render(resource, Request())
+        self.assertTrue(len(request.body()) < len(self.data))
+        for i in range(100):
+            clock.advance(shaper.interval)
+        self.assertEqual(request.body(), self.data)
+        self.assertEqual(request.finished, 1)
+        self.assertTrue(clock.seconds() >= 1)
+
+
+class ServerTests(unittest.TestCase):
+    """Downloads through the factories of create_servers"""
+
+    def setUp(self):
+        self.data = os.urandom(3 * 2 ** 20)
+        fs_path = self.mktemp()
+        with open(fs_path, 'wb') as f:
+            f.write(self.data)
+
+        root = Resource()
+        root.putChild('pack', ImmutableFile(fs_path, 'application/x-git-pack',
+                                            'abc', OpenFileCache()))
+        site = Site(root)
+        site.timeOut = None
+        factory = ServerMetrics().wrap_factory(site, 'http')
+        factory = Timeouts(clock=task.Clock()).wrap_factory(factory, 'http')
+        self.port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+
+        self.events = []
+        self.record(MmapProducer, 'start', 'MmapProducer')
+        self.record(ConnectionTimer, 'touch', 'touch')
+
+    def record(self, cls, name, event):
+        """Add event to self.events when cls.name is called"""
+        method = getattr(cls, name)
+
+        def recording(instance):
+            self.events.append(event)
+            return method(instance)
+        self.patch(cls, name, recording)
+
+    def get(self):
+        url = 'http://127.0.0.1:%d/pack' % self.port.getHost().port
+        d = Agent(reactor).request('GET', url)
+        return d.addCallback(readBody)
+
+    def test_download(self):
+        def check(body):
+            self.assertEqual(body, self.data)
+            # the data goes through the wrappers, so it counts as
+            # activity on the connection
+            after = self.events[self.events.index('MmapProducer'):]
+            self.assertTrue(after.count('touch') >=
+                            len(self.data) // MmapProducer.chunk_size)
+        return self.get().addCallback(check)
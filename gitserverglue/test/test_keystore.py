@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+import os
+
+from twisted.conch.ssh import keys
+from twisted.conch.test import keydata
+from twisted.internet import task
+from twisted.trial import unittest
+
+from gitserverglue import keystore
+from gitserverglue.keystore import PublicKeyStore
+
+RSA = keydata.publicRSA_openssh.strip()
+DSA = keydata.publicDSA_openssh.strip()
+ECDSA = keydata.publicECDSA_openssh.strip()
+
+
+def blob(key):
+    return keys.Key.fromString(data=key).blob()
+
+
+class PublicKeyStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.keys_file = self.mktemp()
+        self.write('alice: %s\nbob: %s\n\ncarol: %s\n' % (RSA, RSA, DSA))
+        self.store = PublicKeyStore(self.keys_file, check_interval=2,
+                                    clock=self.clock)
+
+    def write(self, data):
+        # replaced like editors and scripts do, so the inode changes
+        with open(self.keys_file + '.new', 'wb') as f:
+            f.write(data)
+        os.rename(self.keys_file + '.new', self.keys_file)
+
+    def test_users(self):
+        self.assertEqual(self.store.users(blob(RSA)),
+                         frozenset(['alice', 'bob']))
+        self.assertTrue(self.store.allowed('carol', blob(DSA)))
+        self.assertFalse(self.store.allowed('alice', blob(DSA)))
+        self.assertEqual(self.store.users('unknown'), frozenset())
+
+    def test_invalid_key(self):
+        self.write('alice: %s\nbob: not a key\nno separator\n' % RSA)
+        self.clock.advance(2)
+        self.assertTrue(self.store.allowed('alice', blob(RSA)))
+        self.assertEqual(len(self.flushLoggedErrors()), 2)
+
+    def test_reload(self):
+        self.write('alice: %s\n' % DSA)
+        self.assertTrue(self.store.allowed('alice', blob(RSA)))  # too soon
+        self.clock.advance(2)
+        self.assertFalse(self.store.allowed('alice', blob(RSA)))
+        self.assertTrue(self.store.allowed('alice', blob(DSA)))
+        self.assertFalse(self.store.allowed('carol', blob(DSA)))
+        self.assertEqual(self.store.reloads, 2)
+
+        # not read again while unchanged
+        self.clock.advance(2)
+        self.store.users(blob(DSA))
+        self.assertEqual(self.store.reloads, 2)
+
+    def test_known_keys_are_not_parsed(self):
+        parsed = []
+
+        class Key(object):
+            @staticmethod
+            def fromString(data):
+                parsed.append(data)
+                return keys.Key.fromString(data=data)
+
+        class Keys(object):
+            pass
+        Keys.Key = Key
+        self.patch(keystore, 'keys', Keys)
+        self.write('alice: %s\ncarol: %s\ndave: %s\n' % (RSA, DSA, ECDSA))
+        self.clock.advance(2)
+        self.assertTrue(self.store.allowed('dave', blob(ECDSA)))
+        self.assertTrue(self.store.allowed('carol', blob(DSA)))
+        self.assertEqual(parsed, [ECDSA])
+
+    def test_missing_file(self):
+        os.remove(self.keys_file)
+        self.clock.advance(2)
+        self.assertEqual(self.store.users(blob(RSA)), frozenset())
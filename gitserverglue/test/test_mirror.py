@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+import os
+import time
+
+from twisted.internet import task
+from twisted.internet.error import ProcessDone, ProcessTerminated
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+
+from gitserverglue import mirror
+from gitserverglue.mirror import MirrorManager, MirrorUnavailable
+
+UPSTREAM = 'https://example.com/a.git'
+
+
+class ProcessTransport(object):
+    def __init__(self):
+        self.signals = []
+
+    def signalProcess(self, signal):
+        self.signals.append(signal)
+
+
+class MirrorManagerTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        # compared with the time of FETCH_HEAD
+        self.clock.advance(time.time())
+        self.spawned = []
+        self.patch(mirror.reactor, 'spawnProcess', self.spawnProcess)
+        self.manager = MirrorManager(ttl=60, concurrency=1, timeout=600,
+                                     retry_interval=30, clock=self.clock)
+        self.base = os.path.abspath(self.mktemp())
+        self.path = os.path.join(self.base, 'a.git')
+
+    def spawnProcess(self, fetch, executable, args, env=None, path=None):
+        fetch.makeConnection(ProcessTransport())
+        self.spawned.append((fetch, args))
+
+    def end(self, index=0, reason=ProcessDone(0)):
+        fetch, args = self.spawned[index]
+        if fetch.tmpdir is not None and reason.exitCode == 0:
+            os.mkdir(os.path.join(fetch.tmpdir, 'refs'))  # cloned
+        fetch.processEnded(Failure(reason))
+        self.clock.advance(0)
+
+    def test_clone_is_shared(self):
+        first = self.manager.refresh(self.path, UPSTREAM)
+        second = self.manager.refresh(self.path, UPSTREAM)
+        self.assertEqual(len(self.spawned), 1)
+        self.assertEqual(self.manager.waiting, 2)
+        fetch, args = self.spawned[0]
+        self.assertEqual(args, ['git', 'clone', '--mirror', '--quiet',
+                                UPSTREAM, fetch.tmpdir])
+
+        self.end()
+        self.successResultOf(first)
+        self.successResultOf(second)
+        self.assertTrue(os.path.isdir(os.path.join(self.path, 'refs')))
+        self.assertEqual(os.listdir(self.base), ['a.git'])
+
+        # fresh for ttl seconds
+        self.successResultOf(self.manager.refresh(self.path, UPSTREAM))
+        self.assertEqual(len(self.spawned), 1)
+
+    def test_fetch_after_ttl(self):
+        self.manager.refresh(self.path, UPSTREAM)
+        self.end()
+        self.clock.advance(59)
+        self.successResultOf(self.manager.refresh(self.path, UPSTREAM))
+        self.clock.advance(2)
+
+        first = self.manager.refresh(self.path, UPSTREAM)
+        second = self.manager.refresh(self.path, UPSTREAM)
+        self.assertEqual(self.spawned[1][1][:2], ['git', 'fetch'])
+        self.assertEqual(len(self.spawned), 2)
+        self.end(1)
+        self.successResultOf(first)
+        self.successResultOf(second)
+
+    def test_concurrency(self):
+        other = os.path.join(self.base, 'b.git')
+        self.manager.refresh(self.path, UPSTREAM)
+        d = self.manager.refresh(other, UPSTREAM)
+        self.assertEqual((len(self.spawned), self.manager.running), (1, 1))
+        self.end()
+        self.assertEqual(len(self.spawned), 2)
+        self.end(1)
+        self.successResultOf(d)
+
+    def test_failed_clone(self):
+        first = self.manager.refresh(self.path, UPSTREAM)
+        second = self.manager.refresh(self.path, UPSTREAM)
+        self.end(reason=ProcessTerminated(128))
+        self.failureResultOf(first, MirrorUnavailable)
+        self.failureResultOf(second, MirrorUnavailable)
+        self.assertEqual(os.listdir(self.base), [])
+        self.assertEqual(self.manager.failures, 1)
+
+        # upstream is not asked again for retry_interval seconds
+        self.failureResultOf(self.manager.refresh(self.path, UPSTREAM),
+                             MirrorUnavailable)
+        self.assertEqual(len(self.spawned), 1)
+        self.clock.advance(30)
+        self.manager.refresh(self.path, UPSTREAM)
+        self.assertEqual(len(self.spawned), 2)
+
+    def test_timeout(self):
+        d = self.manager.refresh(self.path, UPSTREAM)
+        self.clock.advance(600)
+        fetch = self.spawned[0][0]
+        self.assertEqual(fetch.transport.signals, ['KILL'])
+        self.end(reason=ProcessTerminated(signal=9))
+        self.failureResultOf(d, MirrorUnavailable)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+import os
+
+from twisted.trial import unittest
+
+from gitserverglue.packcache import PackCache, normalize_upload_request
+from gitserverglue.pktline import encode_lines
+
+WANT = 'want %s multi_ack_detailed side-band-64k agent=git/2.%d\n'
+SHA1 = 'a' * 40
+SHA2 = 'b' * 40
+
+
+def clone_request(*lines):
+    return encode_lines(list(lines) + [None, 'done\n'], flush=False)
+
+
+class NormalizeUploadRequestTests(unittest.TestCase):
+    def test_agent_and_order_are_ignored(self):
+        a = clone_request(WANT % (SHA1, 30), 'want %s\n' % SHA2)
+        b = clone_request(WANT % (SHA2, 40), 'want %s\n' % SHA1)
+        self.assertEqual(normalize_upload_request(a),
+                         normalize_upload_request(b))
+
+    def test_shallow_requests_differ(self):
+        full = clone_request(WANT % (SHA1, 30))
+        shallow = clone_request(WANT % (SHA1, 30), 'deepen 1\n')
+        self.assertNotEqual(normalize_upload_request(full),
+                            normalize_upload_request(shallow))
+
+    def test_haves_are_not_cacheable(self):
+        request = clone_request(WANT % (SHA1, 30), 'have %s\n' % SHA2)
+        self.assertIdentical(normalize_upload_request(request), None)
+
+    def test_incomplete_requests_are_not_cacheable(self):
+        request = encode_lines([WANT % (SHA1, 30)])
+        self.assertIdentical(normalize_upload_request(request), None)
+        self.assertIdentical(normalize_upload_request('00'), None)
+
+
+class PackCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = PackCache(self.mktemp(), max_size=100)
+        self.request = clone_request(WANT % (SHA1, 30))
+
+    def store(self, repo, fingerprint, data, request=None):
+        key = self.cache.make_key(repo, 'git', fingerprint,
+                                  request or self.request)
+        writer = self.cache.writer(key, repo)
+        writer.write(data)
+        writer.commit()
+        return key
+
+    def read(self, key):
+        f = self.cache.open(key)
+        if f is None:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_keys(self):
+        key = self.cache.make_key('repo', 'git', 'f1', self.request)
+        self.assertEqual(key, self.cache.make_key(
+                        'repo', 'git', 'f1',
+                        clone_request(WANT % (SHA1, 40))))
+        self.assertNotEqual(key, self.cache.make_key(
+                        'repo', 'git', 'f2', self.request))
+        self.assertNotEqual(key, self.cache.make_key(
+                        'repo', 'http', 'f1', self.request))
+        self.assertNotEqual(key, self.cache.make_key(
+                        'other', 'git', 'f1', self.request))
+
+    def test_store_and_open(self):
+        key = self.store('repo', 'f1', 'pack data')
+        self.assertEqual(self.read(key), 'pack data')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 0))
+
+    def test_abort(self):
+        key = self.cache.make_key('repo', 'git', 'f1', self.request)
+        writer = self.cache.writer(key, 'repo')
+        writer.write('partial')
+        writer.abort()
+        self.assertIdentical(self.read(key), None)
+        self.assertFalse(os.path.exists(writer.tmpname))
+
+    def test_invalidate(self):
+        key = self.store('repo', 'f1', 'pack data')
+        other = self.store('other', 'f1', 'other data')
+        self.cache.invalidate('repo')
+        self.assertIdentical(self.read(key), None)
+        self.assertEqual(self.read(other), 'other data')
+
+    def test_invalidate_while_writing(self):
+        """A response generated before a push completed is not stored"""
+        key = self.cache.make_key('repo', 'git', 'f1', self.request)
+        writer = self.cache.writer(key, 'repo')
+        writer.write('stale data')
+        self.cache.invalidate('repo')
+        writer.commit()
+        self.assertIdentical(self.read(key), None)
+
+    def test_eviction(self):
+        first = self.store('repo', 'f1', 'x' * 60)
+        second = self.store('repo', 'f2', 'y' * 30)
+        self.read(first)  # most recently used
+        third = self.store('repo', 'f3', 'z' * 30)
+        self.assertIdentical(self.read(second), None)
+        self.assertNotIdentical(self.read(first), None)
+        self.assertNotIdentical(self.read(third), None)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(self.cache.total_size, 90)
+
+    def test_large_entries_are_dropped(self):
+        self.cache.max_entry_size = 10
+        key = self.store('repo', 'f1', 'x' * 11)
+        self.assertIdentical(self.read(key), None)
+
+    def test_scan(self):
+        key = self.store('repo', 'f1', 'pack data')
+        cache = PackCache(self.cache.directory, max_size=100)
+        f = cache.open(key)
+        self.assertEqual(f.read(), 'pack data')
+        f.close()
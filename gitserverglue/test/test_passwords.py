@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from gitserverglue import passwords
+from gitserverglue.passwords import PasswordVerifier
+
+
+class PasswordVerifierTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.passwords = {'alice': 'secret'}
+        self.checks = []
+        self.patch(passwords, 'deferToThreadPool', self.deferToThreadPool)
+        self.verifier = PasswordVerifier(self.check, ttl=60, max_entries=2,
+                                         clock=self.clock)
+        self.verifier.pool.started = True  # checks run in deferToThreadPool
+
+    def check(self, username, password):
+        return self.passwords.get(username) == password
+
+    def deferToThreadPool(self, reactor, pool, f, *args):
+        # the result only arrives once runChecks is called
+        d = defer.Deferred()
+        self.checks.append((d, f(*args)))
+        return d
+
+    def runChecks(self):
+        checks, self.checks = self.checks, []
+        for d, result in checks:
+            d.callback(result)
+
+    def verify(self, username, password):
+        d = self.verifier.verify(username, password)
+        self.runChecks()
+        return self.successResultOf(d)
+
+    def test_success_is_cached(self):
+        self.assertTrue(self.verify('alice', 'secret'))
+        self.assertTrue(self.verify('alice', 'secret'))
+        self.assertEqual((self.verifier.hits, self.verifier.misses), (1, 1))
+        self.assertEqual(self.verifier.verifications, 1)
+
+    def test_failure_is_not_cached(self):
+        self.assertFalse(self.verify('alice', 'wrong'))
+        self.assertFalse(self.verify('alice', 'wrong'))
+        self.assertEqual(self.verifier.verifications, 2)
+
+    def test_expiry(self):
+        self.verify('alice', 'secret')
+        self.clock.advance(60)
+        self.verify('alice', 'secret')
+        self.assertEqual(self.verifier.verifications, 2)
+
+    def test_max_entries(self):
+        self.passwords.update(bob='b', carol='c')
+        self.verify('alice', 'secret')
+        self.verify('bob', 'b')
+        self.verify('carol', 'c')
+        self.verify('alice', 'secret')
+        self.assertEqual(self.verifier.hits, 0)
+
+    def test_clear(self):
+        self.verify('alice', 'secret')
+        self.verifier.clear()
+        self.passwords['alice'] = 'changed'
+        self.assertFalse(self.verify('alice', 'secret'))
+
+    def test_clear_during_check(self):
+        d = self.verifier.verify('alice', 'secret')
+        self.verifier.clear()
+        self.passwords['alice'] = 'changed'
+        self.runChecks()
+        self.assertTrue(self.successResultOf(d))
+        self.assertFalse(self.verify('alice', 'secret'))
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from gitserverglue import pathcache
+from gitserverglue.pathcache import CachingPathLookup, git_suffix_key
+
+
+class GitSuffixKeyTests(unittest.TestCase):
+    def test_key(self):
+        self.assertEqual(git_suffix_key('/foo/bar.git/objects/ab/cdef'),
+                         'foo/bar.git')
+        self.assertEqual(git_suffix_key('/foo/bar.git/info/refs'),
+                         'foo/bar.git')
+        self.assertEqual(git_suffix_key('//foo/bar/'), 'foo/bar')
+
+
+class CachingPathLookupTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.lookups = []
+        self.results = {}
+        self.cache = CachingPathLookup(self.lookup, ttl=60, negative_ttl=5,
+                                       max_entries=2, watch=False,
+                                       clock=self.clock)
+
+    def lookup(self, url, protocol_hint=None):
+        self.lookups.append(url)
+        return self.results.get('/' + git_suffix_key(url))
+
+    def found(self, url):
+        self.results[url] = {'repository_fs_path': '/srv' + url,
+                             'repository_base_fs_path': '/srv',
+                             'repository_base_url_path': '/'}
+
+    def test_ttl(self):
+        self.found('/a.git')
+        info = self.cache('/a.git/info/refs')
+        self.assertIdentical(self.cache('/a.git/HEAD'), info)
+        self.clock.advance(59)
+        self.cache('/a.git/HEAD')
+        self.assertEqual(self.lookups, ['/a.git/info/refs'])
+        self.clock.advance(1)
+        self.cache('/a.git/HEAD')
+        self.assertEqual(len(self.lookups), 2)
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 2))
+
+    def test_negative_ttl(self):
+        self.assertIdentical(self.cache('/a.git'), None)
+        self.cache('/a.git')
+        self.assertEqual(self.cache.negative_hits, 1)
+        self.clock.advance(5)
+        self.cache('/a.git')
+        self.assertEqual(len(self.lookups), 2)
+
+    def test_no_repository(self):
+        self.results['/a.git'] = {'repository_fs_path': None}
+        self.cache('/a.git')
+        self.clock.advance(5)
+        self.cache('/a.git')
+        self.assertEqual(len(self.lookups), 2)
+
+    def test_backend(self):
+        self.results['/a.git'] = {'repository_fs_path': None,
+                                  'repository_backend': object()}
+        self.cache('/a.git')
+        self.clock.advance(30)
+        self.cache('/a.git')
+        self.assertEqual(len(self.lookups), 1)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_protocol_hint(self):
+        self.cache('/a.git', protocol_hint='git')
+        self.cache('/a.git', protocol_hint='http')
+        self.assertEqual(len(self.lookups), 2)
+
+    def test_lru_eviction(self):
+        for url in ('/a.git', '/b.git', '/c.git'):
+            self.found(url)
+        self.cache('/a.git')
+        self.cache('/b.git')
+        self.cache('/a.git')
+        self.cache('/c.git')
+        self.assertEqual(self.cache.evictions, 1)
+        self.cache('/a.git')
+        self.cache('/b.git')
+        self.assertEqual(self.lookups,
+                         ['/a.git', '/b.git', '/c.git', '/b.git'])
+
+    def test_invalidate(self):
+        self.found('/a.git')
+        self.cache('/a.git')
+        self.cache.invalidate()
+        self.cache('/a.git')
+        self.assertEqual(len(self.lookups), 2)
+
+    def test_deferred_lookups_are_coalesced(self):
+        pending = []
+
+        def lookup(url, protocol_hint=None):
+            pending.append(defer.Deferred())
+            return pending[-1]
+
+        self.cache.path_lookup = lookup
+        first = self.cache('/a.git')
+        second = self.cache('/a.git')
+        self.assertEqual(len(pending), 1)
+        info = {'repository_fs_path': '/srv/a.git'}
+        pending[0].callback(info)
+        self.assertIdentical(self.successResultOf(first), info)
+        self.assertIdentical(self.successResultOf(second), info)
+        self.assertIdentical(self.cache('/a.git'), info)
+
+
+class FakeNotifier(object):
+    def __init__(self):
+        self.watches = {}
+
+    def watch(self, path, mask, callbacks):
+        self.watches[path.path] = callbacks
+
+    def ignore(self, path):
+        del self.watches[path.path]
+
+
+class WatchTests(CachingPathLookupTests):
+    if pathcache.inotify is None:
+        skip = "inotify is not available"
+
+    def setUp(self):
+        CachingPathLookupTests.setUp(self)
+        self.notifier = self.cache._notifier = FakeNotifier()
+
+    def notify(self, fs_path, mask):
+        for callback in self.notifier.watches[fs_path]:
+            callback(None, pathcache.filepath.FilePath(fs_path), mask)
+
+    def test_watch_repositories(self):
+        self.cache.max_entries = 10
+        self.found('/a.git')
+        self.found('/b.git')
+        self.cache('/a.git/info/refs')
+        self.cache('/a.git/HEAD', protocol_hint='http')
+        self.cache('/b.git')
+        self.cache('/c.git')
+        self.assertEqual(sorted(self.notifier.watches),
+                         ['/srv/a.git', '/srv/b.git'])
+
+        self.notify('/srv/a.git', pathcache.inotify.IN_MOVE_SELF)
+        self.assertEqual(sorted(self.notifier.watches), ['/srv/b.git'])
+        self.cache('/a.git/HEAD')
+        self.cache('/b.git')
+        self.assertEqual(self.lookups.count('/a.git/HEAD'), 2)
+        self.assertEqual(self.lookups.count('/b.git'), 1)
+
+    def test_removed_repository(self):
+        self.found('/a.git')
+        self.cache('/a.git')
+        # inotify drops the watch itself
+        self.notify('/srv/a.git', pathcache.inotify.IN_DELETE_SELF)
+        self.assertEqual(self.cache._watched, {})
+        self.cache('/a.git')
+        self.assertEqual(len(self.lookups), 2)
+
+    def test_evicted_repository(self):
+        for url in ('/a.git', '/b.git', '/c.git'):
+            self.found(url)
+            self.cache(url)
+        self.assertEqual(sorted(self.notifier.watches),
+                         ['/srv/b.git', '/srv/c.git'])
+        self.cache.invalidate()
+        self.assertEqual(self.notifier.watches, {})
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+from twisted.trial import unittest
+
+from gitserverglue.pktline import DELIM, FLUSH, MAX_PACKET_LENGTH, \
+    MAX_PAYLOAD, PacketDecoder, PacketError, demultiplex, encode, \
+    encode_lines, iter_payloads, sideband
+
+
+class EncodeTests(unittest.TestCase):
+    def test_encode(self):
+        self.assertEqual(encode('a\n'), '0006a\n')
+        self.assertEqual(encode(''), '0004')
+        self.assertEqual(encode(), FLUSH)
+        self.assertEqual(encode('x' * 0x2000), '2004' + 'x' * 0x2000)
+
+    def test_too_long(self):
+        encode('x' * MAX_PAYLOAD)
+        self.assertRaises(ValueError, encode, 'x' * (MAX_PAYLOAD + 1))
+
+    def test_encode_lines(self):
+        self.assertEqual(encode_lines(['a\n', None, 'b\n']),
+                         '0006a\n00000006b\n0000')
+        self.assertEqual(encode_lines(['a\n'], flush=False), '0006a\n')
+
+    def test_sideband(self):
+        data = 'x' * (MAX_PAYLOAD * 2)
+        packets = list(iter_payloads(sideband(1, data)))
+        self.assertEqual(len(packets), 3)
+        self.assertEqual(set(p[0] for p in packets), set(['\1']))
+        self.assertEqual(''.join(p[1:] for p in packets), data)
+
+    def test_demultiplex(self):
+        self.assertEqual(demultiplex(encode('\2progress')),
+                         (2, 'progress'))
+        self.assertRaises(ValueError, demultiplex, FLUSH)
+
+
+class PacketDecoderTests(unittest.TestCase):
+    def setUp(self):
+        self.decoder = PacketDecoder()
+        self.data = encode_lines(['want a\n', None, 'have b\n']) + DELIM
+
+    def test_packets(self):
+        self.decoder.feed(self.data)
+        self.assertEqual(self.decoder.packets(),
+                         ['000bwant a\n', FLUSH, '000bhave b\n', FLUSH,
+                          DELIM])
+        self.assertEqual(len(self.decoder), 0)
+
+    def test_byte_by_byte(self):
+        packets = []
+        for c in self.data:
+            self.decoder.feed(c)
+            packet = self.decoder.next_packet()
+            if packet is not None:
+                packets.append(packet)
+        self.assertEqual(packets, ['000bwant a\n', FLUSH, '000bhave b\n',
+                                   FLUSH, DELIM])
+        self.assertEqual(self.decoder.packets(), [])
+
+    def test_incomplete(self):
+        self.decoder.feed('000bwant')
+        self.assertIdentical(self.decoder.next_packet(), None)
+        self.assertEqual(len(self.decoder), 8)
+        self.decoder.feed(' a\n0')
+        self.assertEqual(self.decoder.next_packet(), '000bwant a\n')
+        self.assertEqual(self.decoder.remaining(), '0')
+        self.assertEqual(len(self.decoder), 0)
+
+    def test_remaining(self):
+        self.decoder.feed(encode('a\n') + 'PACK')
+        self.assertEqual(self.decoder.next_packet(), '0006a\n')
+        self.assertEqual(self.decoder.remaining(), 'PACK')
+
+    def test_invalid_header(self):
+        self.decoder.feed(encode('a\n') + 'zzzz')
+        self.assertEqual(self.decoder.next_packet(), '0006a\n')
+        error = self.assertRaises(PacketError, self.decoder.next_packet)
+        self.assertEqual(error.header, 'zzzz')
+
+    def test_reserved_lengths(self):
+        self.decoder.feed('0003')
+        self.assertRaises(PacketError, self.decoder.packets)
+
+    def test_too_long(self):
+        self.decoder.feed('%04x' % (MAX_PACKET_LENGTH + 1))
+        self.assertRaises(PacketError, self.decoder.packets)
+
+
+class IterPayloadsTests(unittest.TestCase):
+    def test_payloads(self):
+        self.assertEqual(list(iter_payloads(encode_lines(['a\n', 'b\n']))),
+                         ['a\n', 'b\n', None])
+
+    def test_truncated(self):
+        self.assertRaises(ValueError, list, iter_payloads('0006a'))
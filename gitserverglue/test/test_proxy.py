@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+import io
+
+from twisted.internet import defer, task
+from twisted.internet.error import ConnectError, ConnectionRefusedError
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from gitserverglue import proxy
+from gitserverglue.pktline import encode
+from gitserverglue.proxy import Backend, BackendPool, ProxyResource, \
+    StreamingBody, request_line
+
+
+class Agent(object):
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, headers, body):
+        self.requests.append((url, body, defer.Deferred()))
+        return self.requests[-1][2]
+
+
+class Producer(object):
+    paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class Consumer(object):
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+    def value(self):
+        return ''.join(self.written)
+
+
+class Request(DummyRequest):
+    def getClientIP(self):
+        return '10.0.0.2'
+
+
+class RequestLineTests(unittest.TestCase):
+    def test_request_line(self):
+        self.assertEqual(request_line('git-upload-pack', '/a.git', 'b:9418'),
+                         encode('git-upload-pack /a.git\0host=b:9418\0'))
+        line = request_line('git-upload-pack', '/a.git', 'b:9418',
+                            {'GIT_PROTOCOL': 'version=2'}, 'test')
+        self.assertEqual(line, encode('git-upload-pack /a.git\0host=b:9418'
+                                      '\0\0version=2\0user=test\0'))
+
+
+class BackendPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.connecting = []
+        self.patch(proxy, 'connect_tcp', self.connect_tcp)
+        self.pool = BackendPool([Backend('a'), Backend('b'), Backend('c')],
+                                clock=task.Clock())
+
+    def connect_tcp(self, host, port, protocol, timeout):
+        self.connecting.append((host, defer.Deferred()))
+        return self.connecting[-1][1]
+
+    def test_round_robin(self):
+        self.assertEqual([b.host for b in self.pool.candidates()],
+                         ['b', 'c', 'a'])
+        self.assertEqual([b.host for b in self.pool.candidates()],
+                         ['c', 'a', 'b'])
+        self.pool.backends[0].healthy = False
+        self.assertEqual([b.host for b in self.pool.candidates()],
+                         ['b', 'c', 'a'])
+        self.assertEqual([b.host for b in self.pool.candidates(True)],
+                         ['a'])
+
+    def test_failover(self):
+        d = self.pool.connect(object())
+        self.connecting[0][1].errback(ConnectionRefusedError())
+        self.assertEqual(self.pool.failovers, 1)
+        self.connecting[1][1].callback(object())
+        self.assertEqual(self.successResultOf(d).host, 'c')
+        self.assertEqual([c[0] for c in self.connecting], ['b', 'c'])
+        self.assertEqual([b.healthy for b in self.pool.backends],
+                         [True, False, True])
+        self.assertEqual(self.pool.healthy, 2)
+
+    def test_all_failed(self):
+        d = self.pool.connect(object(), write=True)
+        self.connecting[0][1].errback(ConnectionRefusedError())
+        self.failureResultOf(d, ConnectionRefusedError)
+        self.assertEqual(self.pool.primary.healthy, False)
+
+    def test_health_check(self):
+        self.pool.backends[1].healthy = False
+        self.pool.start()
+        self.pool.clock.advance(self.pool.check_interval)
+        for host, d in self.connecting:
+            if host == 'a':
+                d.errback(ConnectionRefusedError())
+            else:
+                connected = proxy.Protocol()
+                connected.makeConnection(StringTransport())
+                d.callback(connected)
+        self.assertEqual([b.healthy for b in self.pool.backends],
+                         [False, True, True])
+        self.pool.stop()
+
+
+class StreamingBodyTests(unittest.TestCase):
+    def test_replay(self):
+        body = StreamingBody(Producer(), max_replay=10)
+        body.write('abc')
+        consumer = Consumer()
+        finished = body.startProducing(consumer)
+        body.write('def')
+        self.assertEqual(consumer.value(), 'abcdef')
+
+        replayed = body.replay()
+        self.assertTrue(body.stopped)
+        body.write('ghi')
+        body.finish()
+        self.assertNoResult(finished)  # stopped
+        consumer = Consumer()
+        d = replayed.startProducing(consumer)
+        self.assertEqual(consumer.value(), 'abcdef')
+        replayed.write('ghi')
+        replayed.finish()
+        self.assertEqual(consumer.value(), 'abcdefghi')
+        self.successResultOf(d)
+
+    def test_too_large_to_replay(self):
+        body = StreamingBody(Producer(), max_replay=4)
+        body.startProducing(Consumer())
+        body.write('abc')
+        self.assertNotIdentical(body.replay(), None)
+        body = StreamingBody(Producer(), max_replay=4)
+        body.startProducing(Consumer())
+        body.write('abc')
+        body.write('def')
+        self.assertIdentical(body.replay(), None)
+        self.assertEqual(body.sent, [])
+
+
+class ProxyResourceTests(unittest.TestCase):
+    def setUp(self):
+        self.pool = BackendPool([Backend('a'), Backend('b')])
+        self.pool.agent = self.agent = Agent()
+        self.request = Request([''])
+        self.request.method = 'POST'
+        self.request.uri = '/test.git/git-upload-pack'
+
+    def test_buffered_failover(self):
+        self.request.content = io.BytesIO('0000')
+        ProxyResource(self.pool).render(self.request)
+        self.agent.requests[0][2].errback(ConnectionRefusedError())
+        self.assertEqual([r[0] for r in self.agent.requests],
+                         ['http://b:8080/test.git/git-upload-pack',
+                          'http://a:8080/test.git/git-upload-pack'])
+        self.assertEqual([b.healthy for b in self.pool.backends],
+                         [True, False])
+
+        # sent again from the start
+        self.assertNotIdentical(self.agent.requests[1][1],
+                                self.agent.requests[0][1])
+        self.assertEqual(self.request.content.read(), '0000')
+
+        self.agent.requests[1][2].errback(ConnectionRefusedError())
+        self.assertEqual(self.request.responseCode, 502)
+        self.assertEqual(self.request.finished, 1)
+        self.assertEqual(self.pool.failovers, 1)
+
+    def test_streamed_failover(self):
+        resource = ProxyResource(self.pool)
+        producer = Producer()
+        resource.registerProducer(producer, True)
+        resource.write('0032want ')
+        resource.render(self.request)
+        consumer = Consumer()
+        self.agent.requests[0][1].startProducing(consumer)
+        resource.write('%040d\n' % 0)
+        self.agent.requests[0][2].errback(ConnectError())
+
+        body = self.agent.requests[1][1]
+        consumer = Consumer()
+        d = body.startProducing(consumer)
+        resource.write('0009done\n')
+        resource.unregisterProducer()
+        self.assertEqual(consumer.value(),
+                         '0032want %040d\n0009done\n' % 0)
+        self.successResultOf(d)
+
+    def test_push_is_not_retried(self):
+        resource = ProxyResource(self.pool, writerequired=True)
+        resource.registerProducer(Producer(), True)
+        resource.render(self.request)
+        self.agent.requests[0][1].startProducing(Consumer())
+        resource.write('0000')
+        self.agent.requests[0][2].errback(ConnectionRefusedError())
+        self.assertEqual(len(self.agent.requests), 1)
+        self.assertEqual(self.request.responseCode, 502)
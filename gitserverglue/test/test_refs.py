@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+import os
+import subprocess
+
+from twisted.python.procutils import which
+from twisted.trial import unittest
+
+from gitserverglue.pktline import FLUSH, encode, iter_payloads
+from gitserverglue.refs import AdvertisementCache, AdvertisementSkipper, \
+    RefAdvertiser, ref_state_fingerprint
+
+SHA1 = 'a' * 40
+SHA2 = 'b' * 40
+
+
+def write(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def update_ref(path, content):
+    """Update a ref like git does, through a lock file"""
+    write(path + '.lock', content)
+    os.rename(path + '.lock', path)
+
+
+class RefStateFingerprintTests(unittest.TestCase):
+    def setUp(self):
+        self.repo = self.mktemp()
+        write(os.path.join(self.repo, 'HEAD'), 'ref: refs/heads/master\n')
+        write(os.path.join(self.repo, 'refs', 'heads', 'master'),
+              SHA1 + '\n')
+
+    def test_stable(self):
+        self.assertEqual(ref_state_fingerprint(self.repo),
+                         ref_state_fingerprint(self.repo))
+
+    def test_ref_update(self):
+        before = ref_state_fingerprint(self.repo)
+        update_ref(os.path.join(self.repo, 'refs', 'heads', 'master'),
+                   SHA2 + '\n')
+        self.assertNotEqual(ref_state_fingerprint(self.repo), before)
+
+    def test_new_ref(self):
+        before = ref_state_fingerprint(self.repo)
+        write(os.path.join(self.repo, 'refs', 'tags', 'v1'), SHA2 + '\n')
+        self.assertNotEqual(ref_state_fingerprint(self.repo), before)
+
+    def test_pack_refs(self):
+        before = ref_state_fingerprint(self.repo)
+        write(os.path.join(self.repo, 'packed-refs'),
+              '%s refs/heads/master\n' % SHA1)
+        os.unlink(os.path.join(self.repo, 'refs', 'heads', 'master'))
+        self.assertNotEqual(ref_state_fingerprint(self.repo), before)
+
+    def test_lock_files_are_ignored(self):
+        before = ref_state_fingerprint(self.repo)
+        write(os.path.join(self.repo, 'refs', 'heads', 'master.lock'),
+              SHA2 + '\n')
+        self.assertEqual(ref_state_fingerprint(self.repo), before)
+
+
+class AdvertisementCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = AdvertisementCache(max_entries=2)
+
+    def test_hit(self):
+        self.cache.store('/a.git', 'upload-pack', 'f1', 'refs')
+        self.assertEqual(self.cache.get('/a.git', 'upload-pack', 'f1'),
+                         'refs')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 0))
+
+    def test_stale_fingerprint(self):
+        self.cache.store('/a.git', 'upload-pack', 'f1', 'refs')
+        self.assertIdentical(self.cache.get('/a.git', 'upload-pack', 'f2'),
+                             None)
+        self.assertIdentical(
+            self.cache.get('/a.git', 'receive-pack', 'f1'), None)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_encoded(self):
+        encoded = []
+
+        def encode(data):
+            encoded.append(data)
+            return data.upper()
+
+        self.cache.store('/a.git', 'upload-pack', 'f1', 'refs')
+        for unused in range(2):
+            self.assertEqual(self.cache.get_encoded(
+                    '/a.git', 'upload-pack', 'f1', 'gzip', encode), 'REFS')
+        self.assertEqual(encoded, ['refs'])
+        self.assertIdentical(self.cache.get_encoded(
+                    '/a.git', 'upload-pack', 'f2', 'gzip', encode), None)
+
+    def test_store_replaces_encodings(self):
+        self.cache.store('/a.git', 'upload-pack', 'f1', 'refs')
+        self.cache.get_encoded('/a.git', 'upload-pack', 'f1', 'gzip',
+                               lambda data: 'old')
+        self.cache.store('/a.git', 'upload-pack', 'f2', 'new refs')
+        self.assertEqual(self.cache.get_encoded(
+                '/a.git', 'upload-pack', 'f2', 'gzip', lambda data: data),
+                'new refs')
+
+    def test_lru_eviction(self):
+        self.cache.store('/a.git', 'upload-pack', 'f', 'a')
+        self.cache.store('/b.git', 'upload-pack', 'f', 'b')
+        self.cache.get('/a.git', 'upload-pack', 'f')
+        self.cache.store('/c.git', 'upload-pack', 'f', 'c')
+        self.assertEqual(self.cache.get('/a.git', 'upload-pack', 'f'), 'a')
+        self.assertIdentical(self.cache.get('/b.git', 'upload-pack', 'f'),
+                             None)
+        self.assertEqual(self.cache.get('/c.git', 'upload-pack', 'f'), 'c')
+
+
+def ref_lines(advertisement):
+    """The ref lines of an advertisement, without capabilities"""
+    return [payload.split('\0')[0].rstrip('\n')
+            for payload in iter_payloads(advertisement) if payload]
+
+
+def capabilities(advertisement):
+    """The capabilities of an advertisement except for the agent"""
+    first = next(iter_payloads(advertisement))
+    return [c for c in first.rstrip('\n').split('\0')[1].split(' ')
+            if not c.startswith('agent=')]
+
+
+class RefAdvertiserTests(unittest.TestCase):
+    if not which('git'):
+        skip = "git is not installed"
+
+    def setUp(self):
+        self.repo = os.path.abspath(self.mktemp())
+        self.git('init', '-q', self.repo)
+        self.git('commit', '-q', '--allow-empty', '-m', 'first')
+        self.git('tag', '-a', '-m', 'annotated', 'v1')
+        self.git('tag', 'v1-light')
+        self.git('commit', '-q', '--allow-empty', '-m', 'second')
+        self.git('tag', '-a', '-m', 'tag of a tag', 'v1-nested', 'v1')
+        self.git('branch', 'other', 'HEAD^')
+        self.repo = os.path.join(self.repo, '.git')
+        self.advertiser = RefAdvertiser()
+
+    def git(self, *args):
+        env = dict(os.environ, GIT_AUTHOR_NAME='test',
+                   GIT_AUTHOR_EMAIL='test@example.com',
+                   GIT_COMMITTER_NAME='test',
+                   GIT_COMMITTER_EMAIL='test@example.com')
+        if args[0] != 'init':
+            args = ('-C', self.repo) + args
+        return subprocess.check_output(('git',) + args, env=env)
+
+    def upload_pack(self):
+        """What upload-pack sends on git:// before the client's request"""
+        process = subprocess.Popen(['git', 'upload-pack', self.repo],
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        return process.communicate('')[0]  # it fails once the input ends
+
+    def assertAdvertisesLikeGit(self):
+        expected = self.upload_pack()
+        advertisement = self.advertiser.advertise(self.repo)
+        self.assertEqual(ref_lines(advertisement), ref_lines(expected))
+        self.assertEqual(capabilities(advertisement),
+                         capabilities(expected))
+        self.assertIn('symref=HEAD:refs/heads/',
+                      advertisement.split('\n')[0])
+
+    def test_loose_refs(self):
+        self.assertAdvertisesLikeGit()
+
+    def test_packed_refs(self):
+        self.git('pack-refs', '--all')
+        self.assertAdvertisesLikeGit()
+
+    def test_packed_objects(self):
+        self.git('repack', '-q', '-a', '-d', '--window=0')
+        self.assertAdvertisesLikeGit()
+
+    def test_deltified_objects(self):
+        # deltified tags are left to git, which is able to resolve them
+        self.git('repack', '-q', '-a', '-d', '-F')
+        if self.advertiser.advertise(self.repo) is not None:
+            self.assertAdvertisesLikeGit()
+
+    def test_cached_until_refs_change(self):
+        first = self.advertiser.advertise(self.repo)
+        self.assertIdentical(self.advertiser.advertise(self.repo), first)
+        self.git('branch', 'third')
+        self.assertEqual(self.advertiser.advertise(self.repo),
+                         self.advertiser.generate(self.repo))
+        self.assertNotEqual(self.advertiser.advertise(self.repo), first)
+
+    def test_shallow_repository(self):
+        with open(os.path.join(self.repo, 'shallow'), 'wb') as f:
+            f.write('a' * 40 + '\n')
+        self.assertIdentical(self.advertiser.advertise(self.repo), None)
+
+    def test_configured_capabilities(self):
+        self.git('config', 'uploadpack.allowFilter', 'true')
+        self.git('config', 'uploadpack.allowAnySHA1InWant', 'true')
+        self.assertAdvertisesLikeGit()
+        self.git('config', 'uploadpack.allowTipSHA1InWant', 'false')
+        self.assertAdvertisesLikeGit()
+
+    def test_empty_repository(self):
+        repo = os.path.abspath(self.mktemp())
+        self.git('init', '-q', '--bare', repo)
+        advertisement = self.advertiser.advertise(repo)
+        self.assertEqual(ref_lines(advertisement),
+                         ['0' * 40 + ' capabilities^{}'])
+        self.assertIn('object-format=sha1', capabilities(advertisement))
+
+    def test_included_config(self):
+        self.git('config', 'include.path', 'other')
+        self.assertIdentical(self.advertiser.advertise(self.repo), None)
+
+    def test_hidden_refs(self):
+        self.git('config', 'uploadpack.hideRefs', 'refs/tags')
+        self.assertIdentical(self.advertiser.advertise(self.repo), None)
+
+
+class AdvertisementSkipperTests(unittest.TestCase):
+    def test_skip(self):
+        advertisement = encode('%s HEAD\0caps\n' % SHA1) + FLUSH
+        skipper = AdvertisementSkipper()
+        output = []
+        for c in advertisement + 'PACK':
+            output.append(skipper.feed(c))
+        self.assertEqual(''.join(output), 'PACK')
+        self.assertEqual(skipper.feed('more'), 'more')
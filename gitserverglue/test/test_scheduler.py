@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from gitserverglue.scheduler import PRIORITY_FETCH, PRIORITY_PUSH, \
+    ProcessScheduler, ServerBusy
+
+
+class ProcessSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.scheduler = ProcessScheduler(max_processes=2,
+                                          max_per_repository=2,
+                                          max_per_user=1, max_queue=2,
+                                          max_wait=30, clock=self.clock)
+
+    def acquire(self, repository='/a.git', username=None,
+                priority=PRIORITY_FETCH):
+        return self.successResultOf(
+            self.scheduler.acquire(repository, username, priority))
+
+    def test_global_limit(self):
+        first = self.acquire('/a.git')
+        self.acquire('/b.git')
+        d = self.scheduler.acquire('/c.git')
+        self.assertNoResult(d)
+        self.assertEqual(self.scheduler.queued, 1)
+
+        first.release()
+        self.assertEqual(self.successResultOf(d).repository, '/c.git')
+        self.assertEqual((self.scheduler.running, self.scheduler.queued),
+                         (2, 0))
+
+    def test_release_twice(self):
+        slot = self.acquire()
+        slot.release()
+        slot.release()
+        self.assertEqual(self.scheduler.running, 0)
+
+    def test_per_repository_limit(self):
+        self.scheduler.max_processes = 10
+        self.acquire('/a.git')
+        self.acquire('/a.git')
+        self.assertNoResult(self.scheduler.acquire('/a.git'))
+        self.acquire('/b.git')
+
+    def test_per_user_limit(self):
+        self.scheduler.max_processes = 10
+        self.acquire('/a.git', 'alice')
+        self.assertNoResult(self.scheduler.acquire('/b.git', 'alice'))
+        self.acquire('/b.git', 'bob')
+
+    def test_priority(self):
+        slot = self.acquire()
+        self.acquire()
+        fetch = self.scheduler.acquire('/a.git')
+        push = self.scheduler.acquire('/a.git', priority=PRIORITY_PUSH)
+        slot.release()
+        self.assertNoResult(fetch)
+        self.assertEqual(self.successResultOf(push).repository, '/a.git')
+
+    def test_fifo_within_priority(self):
+        slot = self.acquire()
+        self.acquire()
+        first = self.scheduler.acquire('/b.git')
+        second = self.scheduler.acquire('/c.git')
+        slot.release()
+        self.successResultOf(first)
+        self.assertNoResult(second)
+
+    def test_queue_full(self):
+        self.acquire()
+        self.acquire()
+        self.scheduler.acquire('/a.git')
+        self.scheduler.acquire('/a.git')
+        busy = self.failureResultOf(self.scheduler.acquire('/a.git'),
+                                    ServerBusy)
+        self.assertEqual(busy.value.retry_after, 10)
+        self.assertEqual(self.scheduler.rejected, 1)
+
+    def test_queue_full_rejects_lower_priority(self):
+        self.acquire()
+        self.acquire()
+        self.scheduler.acquire('/a.git')
+        fetch = self.scheduler.acquire('/a.git')
+        push = self.scheduler.acquire('/a.git', priority=PRIORITY_PUSH)
+        self.failureResultOf(fetch, ServerBusy)
+        self.assertNoResult(push)
+        self.assertEqual(self.scheduler.queued, 2)
+
+    def test_timeout(self):
+        self.acquire()
+        self.acquire()
+        d = self.scheduler.acquire('/a.git')
+        self.clock.advance(29)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.failureResultOf(d, ServerBusy)
+        self.assertEqual(self.scheduler.queued, 0)
+
+    def test_cancel(self):
+        self.acquire()
+        self.acquire()
+        d = self.scheduler.acquire('/a.git')
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.scheduler.queued, 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
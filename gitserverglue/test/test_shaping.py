@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+import gc
+
+from twisted.internet import task
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from gitserverglue.shaping import BandwidthShaper, TokenBucket
+
+
+class TokenBucketTests(unittest.TestCase):
+    def test_refill(self):
+        bucket = TokenBucket(100, 200, now=0)
+        bucket.tokens = -50
+        bucket.refill(1)
+        self.assertEqual(bucket.tokens, 50)
+        bucket.refill(0.5)  # clocks going backwards are ignored
+        self.assertEqual(bucket.tokens, 50)
+        self.assertFalse(bucket.full(2))
+        self.assertTrue(bucket.full(10))
+        self.assertEqual(bucket.tokens, 200)
+
+
+class BandwidthShaperTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.shaper = BandwidthShaper(per_user=100000, clock=self.clock)
+
+    def shape(self, username='alice'):
+        transport = StringTransport()
+        return transport, self.shaper.shape(transport, username=username)
+
+    def advance(self, seconds):
+        for i in range(int(round(seconds / self.shaper.interval))):
+            self.clock.advance(self.shaper.interval)
+
+    def test_unlimited(self):
+        transport = StringTransport()
+        self.assertIdentical(self.shaper.shape(transport), transport)
+
+    def assertSent(self, transport, size):
+        """Buckets may be overdrawn by a quantum"""
+        sent = len(transport.value())
+        self.assertTrue(size <= sent <= size + self.shaper.quantum,
+                        "%d bytes sent, expected %d" % (sent, size))
+
+    def test_rate(self):
+        transport, consumer = self.shape()
+        consumer.write('x' * 400000)
+        self.assertSent(transport, 100000)  # the burst
+        self.advance(1)
+        self.assertSent(transport, 200000)
+        self.advance(1)
+        self.assertSent(transport, 300000)
+        self.advance(2)
+        self.assertEqual(len(transport.value()), 400000)
+        self.assertEqual(self.shaper.throttled, 1)
+
+    def test_overdraw(self):
+        transport, consumer = self.shape()
+        consumer.write('x' * 99999)
+        consumer.write('x' * 1000000)
+        bucket, = consumer.buckets
+        self.assertTrue(bucket.tokens > -self.shaper.quantum)
+        self.assertSent(transport, 99999)
+
+    def test_take_floor(self):
+        bucket = TokenBucket(100, 200, now=0)
+        self.shaper._take([bucket], 1000)
+        self.assertEqual(bucket.tokens, -200)
+
+    def test_users_share_nothing(self):
+        alice, alice_consumer = self.shape('alice')
+        bob, bob_consumer = self.shape('bob')
+        alice_consumer.write('x' * 100000)
+        bob_consumer.write('x' * 100000)
+        self.assertSent(alice, 100000)
+        self.assertSent(bob, 100000)
+
+    def test_bucket_outlives_responses(self):
+        transport, consumer = self.shape()
+        consumer.write('x' * 100000)
+        del consumer
+        gc.collect()
+
+        # a new response right away must not get a new burst
+        transport, consumer = self.shape()
+        consumer.write('x' * 100000)
+        self.assertEqual(transport.value(), '')
+
+    def test_refilled_buckets_are_dropped(self):
+        transport, consumer = self.shape()
+        consumer.write('x' * 1000)
+        del consumer
+        self.clock.advance(self.shaper.prune_interval)
+        transport, consumer = self.shape('bob')
+        gc.collect()
+        self.assertEqual(self.shaper._buckets.keys(), [('user', 'bob')])
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+from twisted.internet import task
+from twisted.internet.protocol import Factory, Protocol
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from gitserverglue.timeouts import HANDSHAKE, IDLE, TRANSFER, DURATION, \
+    ConnectionTimer, TimerWheel, Timeouts, connection_timer, untimed
+
+
+class Timer(object):
+    def __init__(self, deadline):
+        self.at = deadline
+        self.fired = []
+
+    def deadline(self):
+        return self.at
+
+    def expired(self):
+        self.fired.append(True)
+
+
+class TimerWheelTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = TimerWheel(resolution=1.0, slots=8, clock=self.clock)
+
+    def test_expiry(self):
+        timer = Timer(5)
+        self.wheel.schedule(timer)
+        self.clock.pump([1] * 4)
+        self.assertEqual(timer.fired, [])
+        self.clock.advance(1)
+        self.assertEqual(timer.fired, [True])
+        self.assertEqual(len(self.wheel), 0)
+        # the periodic call stops once no timers are left
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_resolution(self):
+        timer = Timer(4.2)
+        self.wheel.schedule(timer)
+        self.clock.pump([1] * 4)
+        self.assertEqual(timer.fired, [])
+        self.clock.advance(1)
+        self.assertEqual(timer.fired, [True])
+
+    def test_pushed_back(self):
+        timer = Timer(3)
+        self.wheel.schedule(timer)
+        self.clock.pump([1] * 2)
+        timer.at = 6  # without rescheduling, as on activity
+        self.clock.pump([1] * 3)
+        self.assertEqual(timer.fired, [])
+        self.clock.pump([1] * 3)
+        self.assertEqual(timer.fired, [True])
+
+    def test_brought_forward(self):
+        timer = Timer(6)
+        self.wheel.schedule(timer)
+        timer.at = 2
+        self.wheel.schedule(timer)
+        self.clock.pump([1] * 2)
+        self.assertEqual(timer.fired, [True])
+        self.clock.pump([1] * 6)
+        self.assertEqual(timer.fired, [True])
+
+    def test_beyond_the_wheel(self):
+        timer = Timer(20)
+        self.wheel.schedule(timer)
+        self.clock.pump([1] * 19)
+        self.assertEqual(timer.fired, [])
+        self.clock.advance(1)
+        self.assertEqual(timer.fired, [True])
+
+    def test_late_ticks(self):
+        timers = [Timer(2), Timer(30)]
+        for timer in timers:
+            self.wheel.schedule(timer)
+        self.clock.advance(40)  # one late call for many ticks
+        self.clock.advance(1)
+        self.assertEqual([t.fired for t in timers], [[True], [True]])
+
+    def test_cancel(self):
+        timer = Timer(2)
+        self.wheel.schedule(timer)
+        self.wheel.cancel(timer)
+        self.clock.pump([1] * 3)
+        self.assertEqual(timer.fired, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class Process(object):
+    def __init__(self):
+        self.signals = []
+
+    def signalProcess(self, signal):
+        self.signals.append(signal)
+
+
+class ConnectionTimerTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.timeouts = Timeouts(idle=60, handshake=30, inactivity=10,
+                                 duration=100, clock=self.clock)
+        self.expired = []
+
+    def timer(self, authenticating=False):
+        return ConnectionTimer(self.timeouts, self.expired.append,
+                               authenticating)
+
+    def test_idle(self):
+        timer = self.timer()
+        self.assertEqual(timer.phase, IDLE)
+        self.clock.pump([1] * 60)
+        self.assertEqual(self.expired, [IDLE])
+        self.assertEqual(self.timeouts.expirations[IDLE], 1)
+
+    def test_handshake(self):
+        timer = self.timer()
+        self.clock.advance(50)
+        timer.received()
+        self.assertEqual(timer.phase, HANDSHAKE)
+        self.clock.pump([1] * 29)
+        self.assertEqual(self.expired, [])
+        self.clock.advance(1)
+        self.assertEqual(self.expired, [HANDSHAKE])
+
+    def test_ssh(self):
+        timer = self.timer(authenticating=True)
+        self.assertEqual(timer.phase, HANDSHAKE)
+        timer.received()  # a keepalive
+        self.assertEqual(timer.phase, HANDSHAKE)
+        timer.authenticated()
+        self.assertEqual(timer.phase, IDLE)
+
+    def test_transfer(self):
+        timer = self.timer()
+        timer.received()
+        timer.request_started()
+        self.assertEqual(timer.phase, TRANSFER)
+        for i in range(5):
+            self.clock.pump([1] * 9)
+            timer.touch()
+        self.assertEqual(self.expired, [])
+        self.clock.pump([1] * 10)
+        self.assertEqual(self.expired, [TRANSFER])
+
+    def test_duration(self):
+        timer = self.timer()
+        process = Process()
+        timer.request_started()
+        timer.add_process(process)
+        for i in range(100):
+            self.clock.advance(1)
+            timer.touch()
+        self.assertEqual(self.expired, [DURATION])
+        self.assertEqual(process.signals, ['KILL'])
+        self.assertEqual(self.timeouts.kills, 1)
+
+    def test_request_finished(self):
+        timer = self.timer()
+        timer.request_started()
+        timer.request_started()
+        timer.request_finished()
+        self.assertEqual(timer.phase, TRANSFER)
+        timer.request_finished()
+        self.assertEqual(timer.phase, IDLE)
+        timer.request_finished()  # not reported as started
+        self.assertEqual(timer.requests, 0)
+
+    def test_cancel(self):
+        timer = self.timer()
+        timer.cancel()
+        self.clock.pump([1] * 60)
+        self.assertEqual(self.expired, [])
+
+
+class TimedProtocolTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.timeouts = Timeouts(idle=60, clock=self.clock)
+        factory = self.timeouts.wrap_factory(
+                        Factory.forProtocol(Protocol), 'git')
+        self.protocol = factory.buildProtocol(None)
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def test_connection_timer(self):
+        wrapped = self.protocol.wrappedProtocol
+        self.assertIdentical(connection_timer(wrapped.transport),
+                             self.protocol.timer)
+        self.assertIdentical(connection_timer(self.transport), untimed)
+
+    def test_expiry_aborts(self):
+        aborted = []
+        self.transport.abortConnection = lambda: aborted.append(True)
+        self.clock.pump([1] * 60)
+        self.assertEqual(aborted, [True])
+
+    def test_activity(self):
+        self.protocol.dataReceived('x')
+        self.assertEqual(self.protocol.timer.phase, HANDSHAKE)
+        self.protocol.timer.request_started()
+        self.clock.advance(500)
+        self.protocol.write('x')
+        self.assertEqual(self.protocol.timer.touched, 500)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+from twisted.internet import defer, task
+from twisted.internet.error import ConnectionDone, ProcessDone, \
+    ProcessTerminated
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from gitserverglue import workers
+from gitserverglue.workers import ControlError, ControlProtocol, Supervisor
+
+
+class Handler(object):
+    def __init__(self):
+        self.notified = []
+        self.pending = defer.Deferred()
+
+    def command_add(self, a, b):
+        return a + b
+
+    def command_later(self):
+        return self.pending
+
+    def command_fail(self):
+        raise ValueError("failed")
+
+    def command_updated(self, path):
+        self.notified.append(path)
+
+
+class ControlProtocolTests(unittest.TestCase):
+    def setUp(self):
+        self.handler = Handler()
+        self.local = ControlProtocol(None)
+        self.remote = ControlProtocol(self.handler)
+        for proto in (self.local, self.remote):
+            proto.makeConnection(StringTransport())
+
+    def pump(self):
+        for source, target in ((self.local, self.remote),
+                               (self.remote, self.local)):
+            data = source.transport.value()
+            source.transport.clear()
+            target.dataReceived(data)
+
+    def test_call(self):
+        d = self.local.call('add', a=1, b=2)
+        self.assertNoResult(d)
+        self.pump()
+        self.assertEqual(self.successResultOf(d), 3)
+        self.assertEqual(self.local.pending, {})
+
+    def test_deferred_result(self):
+        d = self.local.call('later')
+        self.pump()
+        self.assertNoResult(d)
+        self.handler.pending.callback({'rss': 1})
+        self.pump()
+        self.assertEqual(self.successResultOf(d), {'rss': 1})
+
+    def test_error(self):
+        d = self.local.call('fail')
+        self.pump()
+        self.assertEqual(self.failureResultOf(d, ControlError).value.args,
+                         ("failed",))
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_unknown_command(self):
+        d = self.local.call('missing')
+        self.pump()
+        self.failureResultOf(d, ControlError)
+        self.assertEqual(len(self.flushLoggedErrors(ControlError)), 1)
+
+    def test_notify(self):
+        self.local.notify('updated', path='/srv/a.git')
+        self.pump()
+        self.assertEqual(self.handler.notified, ['/srv/a.git'])
+        self.assertEqual(self.remote.transport.value(), '')
+
+    def test_connection_lost(self):
+        d = self.local.call('add', a=1, b=2)
+        self.local.connectionLost(Failure(ConnectionDone()))
+        self.failureResultOf(d, ConnectionDone)
+
+
+class SupervisorTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.patch(workers, 'reactor', self.clock)
+        self.supervisor = Supervisor('setup', {}, 2)
+        self.spawned = []
+        self.patch(self.supervisor, 'spawn', self.spawn)
+        for slot in range(2):
+            self.spawn(slot)
+
+    def spawn(self, slot):
+        self.supervisor.restarts.pop(slot, None)
+        worker = workers.WorkerProcess(self.supervisor, slot)
+        worker.makeConnection(StringTransport())
+        self.supervisor.workers[slot] = worker
+        self.spawned.append(slot)
+        return worker
+
+    def end(self, slot, reason=ProcessTerminated(1)):
+        self.supervisor.workers[slot].processEnded(Failure(reason))
+
+    def restarts(self, reason):
+        return self.supervisor.restart_count.labels(reason).value
+
+    def test_crash(self):
+        self.clock.advance(self.supervisor.min_uptime)
+        self.end(0)
+        self.assertNotIn(0, self.supervisor.workers)
+        self.clock.advance(0)
+        self.assertEqual(self.spawned, [0, 1, 0])
+        self.assertEqual(self.restarts('crash'), 1)
+
+    def test_backoff(self):
+        delays = []
+        for i in range(8):
+            self.end(0)
+            delays.append(self.supervisor.restarts[0].getTime() -
+                          self.clock.seconds())
+            self.clock.advance(delays[-1])
+        self.assertEqual(delays, [1, 2, 4, 8, 16, 32, 60, 60])
+        self.assertEqual(self.spawned.count(0), 9)
+
+    def test_rotated(self):
+        self.supervisor.workers[1].rotating = True
+        self.end(1, ProcessDone(0))
+        self.assertEqual(self.spawned, [0, 1, 1])
+        self.assertEqual(self.restarts('memory'), 1)
+        self.assertEqual(self.restarts('crash'), 0)
+
+    def test_stopping(self):
+        self.supervisor.stopping = d = defer.Deferred()
+        self.end(0, ProcessDone(0))
+        self.assertNoResult(d)
+        self.end(1, ProcessDone(0))
+        self.successResultOf(d)
+        self.assertEqual(self.spawned, [0, 1])
+        self.assertEqual(self.supervisor.restarts, {})
+
+    def test_updated(self):
+        self.supervisor.workers[0].control.stringReceived(
+            '{"command": "updated", "args": {"path": "/srv/a.git"}}')
+        self.assertEqual(self.supervisor.workers[0].transport.value(), '')
+        self.assertIn('/srv/a.git',
+                      self.supervisor.workers[1].transport.value())
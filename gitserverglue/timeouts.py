@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+"""Connection timeouts, see Timeouts"""
+
+import math
+
+from zope.interface import implements
+from twisted.internet import reactor
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.interfaces import IHalfCloseableProtocol
+from twisted.internet.task import LoopingCall
+from twisted.protocols.policies import ProtocolWrapper, WrappingFactory
+from twisted.python import log
+
+# the phases of a connection, each with a timeout of its own
+IDLE = 'idle'  # waiting for a request
+HANDSHAKE = 'handshake'  # receiving a request or authenticating
+TRANSFER = 'transfer'  # serving a request
+DURATION = 'duration'  # serving a request for too long
+
+
+class TimerWheel(object):
+    """Fires coarse timers from a single periodic call
+
+    Timers are kept in slots by the tick (of resolution seconds) they
+    are due in. A timer which was pushed back meanwhile is put into a
+    later slot when its slot comes up, so moving a deadline back is
+    cheap. Timers are objects with a deadline() method returning the
+    time they expire at and an expired() method."""
+
+    def __init__(self, resolution=1.0, slots=1024, clock=reactor):
+        self.resolution = resolution
+        self.clock = clock
+        self._slots = [[] for i in range(slots)]
+        self._tick = int(clock.seconds() // resolution)
+        self._ticks = {}  # timer -> tick of the slot it is in
+        self._call = None
+
+    def __len__(self):
+        return len(self._ticks)
+
+    def schedule(self, timer):
+        """Add a timer or move it to its current deadline"""
+        tick = int(math.ceil(timer.deadline() / self.resolution))
+        # far deadlines wait in the last slot and are moved on from there
+        tick = max(self._tick + 1,
+                   min(tick, self._tick + len(self._slots)))
+        if self._ticks.get(timer) == tick:
+            return
+        self._ticks[timer] = tick  # entries in other slots are stale
+        self._slots[tick % len(self._slots)].append((tick, timer))
+
+        if self._call is None:
+            self._call = LoopingCall(self._advance)
+            self._call.clock = self.clock
+            self._call.start(self.resolution, now=False)
+
+    def cancel(self, timer):
+        self._ticks.pop(timer, None)
+
+    def _advance(self):
+        now = self.clock.seconds()
+        tick = int(now // self.resolution)
+        due = []
+        last = min(tick, self._tick + len(self._slots))
+        for t in range(self._tick + 1, last + 1):
+            index = t % len(self._slots)
+            due.extend(self._slots[index])
+            self._slots[index] = []
+        self._tick = tick
+
+        for scheduled, timer in due:
+            if self._ticks.get(timer) != scheduled:
+                continue  # cancelled or moved
+            del self._ticks[timer]
+            if timer.deadline() > now:
+                self.schedule(timer)
+            else:
+                timer.expired()
+
+        if not self._ticks:
+            self._call.stop()
+            self._call = None
+
+
+class ConnectionTimer(object):
+    """Enforces the timeouts of a connection for Timeouts
+
+    A connection starts in the IDLE phase and moves to HANDSHAKE with
+    the first data received. SSH connections start in HANDSHAKE and
+    become IDLE once authenticated. While requests are served, it is
+    in the TRANSFER phase. The protocols report the requests and the
+    git processes serving them, which are killed on expiry."""
+
+    def __init__(self, timeouts, expired, authenticating=False):
+        self.timeouts = timeouts
+        self.clock = timeouts.clock
+        self._expired = expired
+        # SSH sessions are reported, data may be keepalives
+        self.explicit = authenticating
+        self.requests = 0
+        self.processes = set()
+        self.requestStarted = None
+        self.cancelled = False
+        self._enter(HANDSHAKE if authenticating else IDLE)
+
+    def _enter(self, phase):
+        self.phase = phase
+        self.phaseStarted = self.touched = self.clock.seconds()
+        self._schedule()
+
+    def _schedule(self):
+        if self.cancelled:
+            return
+        if self.deadline() == float('inf'):
+            self.timeouts.wheel.cancel(self)
+        else:
+            self.timeouts.wheel.schedule(self)
+
+    def deadline(self):
+        """Get the time the current phase times out at"""
+        if self.phase == IDLE:
+            return self.phaseStarted + (self.timeouts.idle or float('inf'))
+        if self.phase == HANDSHAKE:
+            return self.phaseStarted + (self.timeouts.handshake or
+                                        float('inf'))
+        deadline = self.touched + (self.timeouts.inactivity or float('inf'))
+        if self.timeouts.duration:
+            deadline = min(deadline,
+                           self.requestStarted + self.timeouts.duration)
+        return deadline
+
+    def received(self):
+        """Data was received"""
+        if self.phase == IDLE and not self.explicit:
+            self._enter(HANDSHAKE)
+        else:
+            self.touched = self.clock.seconds()
+
+    def touch(self):
+        """Data was sent"""
+        self.touched = self.clock.seconds()
+
+    def authenticated(self):
+        if self.phase == HANDSHAKE and not self.requests:
+            self._enter(IDLE)
+
+    def request_started(self):
+        self.requests += 1
+        if self.requests == 1:
+            self.requestStarted = self.clock.seconds()
+            self._enter(TRANSFER)
+
+    def request_finished(self):
+        if not self.requests:
+            return  # e.g. a request rejected before it was reported
+        self.requests -= 1
+        if not self.requests:
+            self._enter(IDLE)
+
+    def add_process(self, process):
+        """Add a process transport to kill on expiry"""
+        self.processes.add(process)
+
+    def remove_process(self, process):
+        self.processes.discard(process)
+
+    def cancel(self):
+        self.cancelled = True
+        self.timeouts.wheel.cancel(self)
+
+    def expired(self):
+        kind = self.phase
+        if kind == TRANSFER and self.timeouts.duration and \
+                self.clock.seconds() >= (self.requestStarted +
+                                         self.timeouts.duration):
+            kind = DURATION
+        self.timeouts.expirations[kind] += 1
+
+        for process in list(self.processes):
+            try:
+                process.signalProcess('KILL')
+                self.timeouts.kills += 1
+            except (OSError, ProcessExitedAlready):
+                pass
+        self.processes.clear()
+        self.cancelled = True
+        self._expired(kind)
+
+
+class Untimed(object):
+    """Stands in for a ConnectionTimer if there are no timeouts"""
+
+    def received(self):
+        pass
+
+    def touch(self):
+        pass
+
+    def authenticated(self):
+        pass
+
+    def request_started(self):
+        pass
+
+    def request_finished(self):
+        pass
+
+    def add_process(self, process):
+        pass
+
+    def remove_process(self, process):
+        pass
+
+    def cancel(self):
+        pass
+
+
+untimed = Untimed()
+
+
+def connection_timer(transport):
+    """Get the ConnectionTimer of the connection of a protocol from its
+    transport (ProtocolWrappers pass the lookup on), untimed if there
+    is none"""
+    return getattr(transport, 'timer', untimed)
+
+
+class TimedProtocol(ProtocolWrapper):
+    """Runs the ConnectionTimer of a connection and drops it on expiry
+
+    The wrapped protocols find the timer with connection_timer to
+    report requests and processes."""
+    implements(IHalfCloseableProtocol)
+
+    timer = untimed
+
+    def makeConnection(self, transport):
+        self.timer = ConnectionTimer(self.factory.timeouts, self.timedOut,
+                                     self.factory.authenticating)
+        ProtocolWrapper.makeConnection(self, transport)
+
+    def dataReceived(self, data):
+        self.timer.received()
+        ProtocolWrapper.dataReceived(self, data)
+
+    def write(self, data):
+        self.timer.touch()
+        ProtocolWrapper.write(self, data)
+
+    def writeSequence(self, data):
+        self.timer.touch()
+        ProtocolWrapper.writeSequence(self, data)
+
+    def connectionLost(self, reason):
+        self.timer.cancel()
+        ProtocolWrapper.connectionLost(self, reason)
+
+    def timedOut(self, kind):
+        log.msg("Dropping the connection of %s: %s timeout" % (
+                    self.getPeer().host, kind))
+        # a stalled client would keep loseConnection waiting
+        self.transport.abortConnection()
+
+    # IHalfCloseableProtocol, if the wrapped protocol supports it
+    def readConnectionLost(self):
+        wrapped = IHalfCloseableProtocol(self.wrappedProtocol, None)
+        if wrapped is None:
+            self.transport.loseConnection()
+        else:
+            wrapped.readConnectionLost()
+
+    def writeConnectionLost(self):
+        wrapped = IHalfCloseableProtocol(self.wrappedProtocol, None)
+        if wrapped is not None:
+            wrapped.writeConnectionLost()
+
+
+class TimedFactory(WrappingFactory):
+    protocol = TimedProtocol
+
+    def __init__(self, wrappedFactory, timeouts, authenticating):
+        WrappingFactory.__init__(self, wrappedFactory)
+        self.timeouts = timeouts
+        self.authenticating = authenticating
+
+
+class Timeouts(object):
+    """Drops connections which are stalled or take too long
+
+    Connections waiting for a request are dropped after idle seconds,
+    those taking longer than handshake seconds to send a request (or
+    to authenticate, for SSH) as well. While a request is served, the
+    connection is dropped after inactivity seconds without data sent
+    or received and once the request took duration seconds. None
+    disables a timeout. The git processes serving the connection are
+    killed when it is dropped.
+
+    All connections share one TimerWheel, there are no timer calls per
+    connection. Timeouts are enforced with a precision of resolution
+    seconds. Server factories are wrapped with wrap_factory."""
+
+    def __init__(self, idle=60, handshake=30, inactivity=600,
+                 duration=6 * 3600, resolution=1.0, clock=reactor):
+        self.idle = idle
+        self.handshake = handshake
+        self.inactivity = inactivity
+        self.duration = duration
+        self.clock = clock
+        self.wheel = TimerWheel(resolution, clock=clock)
+
+        self.expirations = dict((kind, 0) for kind in (IDLE, HANDSHAKE,
+                                                       TRANSFER, DURATION))
+        self.kills = 0
+
+    def wrap_factory(self, factory, protocol):
+        """Enforce the timeouts on the connections of a server factory
+        for protocol ('git', 'http' or 'ssh')"""
+        return TimedFactory(factory, self, protocol == 'ssh')
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+"""Timelines of the phases of single requests
+
+A Span is attached to each request. The code handling the request
+calls mark(phase) whenever a phase ended, so the phases of a request
+form a gapless timeline, e.g. lookup, authorize, queue, spawn,
+first_byte, stream. Once the request ended, the span is written to a
+sink if it was sampled."""
+
+import os
+import json
+import time
+import random
+
+from twisted.python import log
+
+from gitserverglue.metrics import monotonic
+
+
+class Span(object):
+    """Phases of one request with monotonic timestamps"""
+
+    ended = False
+
+    def __init__(self, tracer, protocol, started=None):
+        self.tracer = tracer
+        self.protocol = protocol
+        self.attributes = {}
+        self.phases = []  # (name, start, end)
+        self.wall_started = time.time()
+        now = monotonic()
+        if started is None:
+            started = now
+        else:
+            self.wall_started -= now - started
+        self.started = self.last = started
+
+    @property
+    def name(self):
+        return '%s %s' % (self.protocol, self.attributes.get('rpc',
+                                                             'request'))
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def mark(self, phase):
+        """Record that phase ended now and the next one starts"""
+        now = monotonic()
+        self.phases.append((phase, self.last, now))
+        self.last = now
+
+    def add_phase(self, phase, start, end):
+        """Record a phase with explicit monotonic timestamps, which must
+        not be before the start of the span"""
+        self.phases.append((phase, start, end))
+        self.last = max(self.last, end)
+
+    def end(self, ignored=None):
+        """Finish the span, further calls are ignored. Can be used as
+        callback and errback, ignored is passed through."""
+        if not self.ended:
+            self.ended = True
+            self.finished = monotonic()
+            self.tracer.finished(self)
+        return ignored
+
+    def wall_time(self, t):
+        """Convert a monotonic timestamp of this span to unix time"""
+        return self.wall_started + (t - self.started)
+
+
+class UnsampledSpan(object):
+    """Stands in for a Span if nothing is traced"""
+
+    ended = True
+
+    def set(self, key, value):
+        pass
+
+    def mark(self, phase):
+        pass
+
+    def add_phase(self, phase, start, end):
+        pass
+
+    def end(self, ignored=None):
+        return ignored
+
+
+unsampled = UnsampledSpan()
+
+
+def start_span(git_configuration, protocol, started=None):
+    """Get a new Span if git_configuration has a tracer, unsampled
+    otherwise"""
+    tracer = getattr(git_configuration, 'tracer', None)
+    if tracer is None:
+        return unsampled
+    return tracer.start(protocol, started)
+
+
+class Tracer(object):
+    """Creates spans and writes sampled ones to a sink
+
+    sample_rate is the fraction of requests written. If slow_threshold
+    is given (in seconds), all requests are timed and those taking
+    longer are written regardless of sample_rate. Otherwise requests
+    not sampled are not timed at all."""
+
+    def __init__(self, sink, sample_rate=1.0, slow_threshold=None):
+        self.sink = sink
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+
+    def start(self, protocol, started=None):
+        sampled = random.random() < self.sample_rate
+        if not sampled and self.slow_threshold is None:
+            return unsampled
+        span = Span(self, protocol, started)
+        span.sampled = sampled
+        return span
+
+    def finished(self, span):
+        if (span.sampled or
+                span.finished - span.started >= self.slow_threshold):
+            try:
+                self.sink.write(span)
+            except Exception:
+                log.err(None, "Writing a trace failed")
+
+
+class LogSink(object):
+    """Writes each span as a single line to the twisted log"""
+
+    def write(self, span):
+        fields = ['%s=%s' % (key, value)
+                  for key, value in sorted(span.attributes.items())]
+        fields.append('total=%.1fms' % ((span.finished - span.started) *
+                                        1000))
+        fields.extend('%s=%.1fms' % (phase, (end - start) * 1000)
+                      for phase, start, end in span.phases)
+        log.msg('trace %s %s' % (span.name, ' '.join(fields)))
+
+
+def _otlp_attributes(attributes):
+    converted = []
+    for key, value in sorted(attributes.items()):
+        if isinstance(value, bool):
+            value = {'boolValue': value}
+        elif isinstance(value, (int, long)):
+            value = {'intValue': str(value)}
+        else:
+            value = {'stringValue': str(value)}
+        converted.append({'key': key, 'value': value})
+    return converted
+
+
+def _nanos(t):
+    return str(int(t * 1e9))
+
+
+class OTLPFileSink(object):
+    """Appends spans in the OTLP JSON encoding to a file, one line each
+
+    The request is the root span and each phase a child span. The
+    lines can be read by the file receiver of the OpenTelemetry
+    collector."""
+
+    def __init__(self, fs_path, service_name='gitserverglue'):
+        self.file = open(fs_path, 'a')
+        self.resource = {'attributes': _otlp_attributes(
+                                        {'service.name': service_name})}
+
+    def write(self, span):
+        trace_id = os.urandom(16).encode('hex')
+        root_id = os.urandom(8).encode('hex')
+        attributes = dict(('git.' + key, value)
+                          for key, value in span.attributes.items())
+        spans = [{
+            'traceId': trace_id,
+            'spanId': root_id,
+            'name': span.name,
+            'kind': 2,  # SPAN_KIND_SERVER
+            'startTimeUnixNano': _nanos(span.wall_time(span.started)),
+            'endTimeUnixNano': _nanos(span.wall_time(span.finished)),
+            'attributes': _otlp_attributes(attributes),
+        }]
+        for phase, start, end in span.phases:
+            spans.append({
+                'traceId': trace_id,
+                'spanId': os.urandom(8).encode('hex'),
+                'parentSpanId': root_id,
+                'name': phase,
+                'kind': 1,  # SPAN_KIND_INTERNAL
+                'startTimeUnixNano': _nanos(span.wall_time(start)),
+                'endTimeUnixNano': _nanos(span.wall_time(end)),
+            })
+
+        self.file.write(json.dumps({'resourceSpans': [{
+            'resource': self.resource,
+            'scopeSpans': [{'scope': {'name': 'gitserverglue'},
+                            'spans': spans}],
+        }]}, separators=(',', ':')) + '\n')
+        self.file.flush()
@@ -0,0 +1,438 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 Manuel Stocker <mensi@mensi.ch>
+#
+# This file is part of GitServerGlue.
+#
+# GitServerGlue is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# GitServerGlue is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with GitServerGlue.  If not, see http://www.gnu.org/licenses
+
+"""Serving from several worker processes
+
+The Supervisor opens the listening sockets and passes them to worker
+processes, which accept connections on them independently. Workers are
+restarted when they crash and replaced when they use too much memory.
+
+Each worker builds its servers with a setup function given by its
+fully qualified name. It is called with the number of the worker slot
+and returns (git_configuration, metrics, factories) where factories
+maps the names of the listeners to server factories. Caches are local
+to each worker, pushes are announced to the other workers so they can
+drop what they cached for the repository.
+
+Supervisor and workers talk over the stdin and stdout of the worker,
+exchanging JSON messages as netstrings."""
+
+import os
+import sys
+import json
+import socket
+import resource
+
+from twisted.internet import reactor, defer, stdio, task
+from twisted.internet.protocol import ProcessProtocol
+from twisted.protocols.basic import NetstringReceiver
+from twisted.python import log
+from twisted.python.reflect import namedAny
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+
+from gitserverglue.common import invalidate_caches
+from gitserverglue.metrics import Registry, sum_rendered
+
+
+class ControlError(Exception):
+    """A command failed on the other end of a control channel"""
+
+
+class ControlProtocol(NetstringReceiver):
+    """Commands and replies as JSON messages
+
+    Commands are dispatched to command_<name> methods of handler,
+    which may return Deferreds. A command sent with call is answered,
+    one sent with notify is not."""
+
+    MAX_LENGTH = 2 ** 26
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.pending = {}
+        self.next_id = 0
+
+    def call(self, command, **args):
+        """Run a command on the other end, returns a Deferred firing
+        with its result"""
+        self.next_id += 1
+        self.pending[self.next_id] = d = defer.Deferred()
+        self._send({'id': self.next_id, 'command': command, 'args': args})
+        return d
+
+    def notify(self, command, **args):
+        self._send({'command': command, 'args': args})
+
+    def _send(self, message):
+        self.sendString(json.dumps(message))
+
+    def stringReceived(self, data):
+        message = json.loads(data)
+        if 'command' not in message:
+            d = self.pending.pop(message['id'], None)
+            if d is None:
+                return
+            if 'error' in message:
+                d.errback(ControlError(message['error']))
+            else:
+                d.callback(message['result'])
+            return
+
+        method = getattr(self.handler, 'command_' + message['command'],
+                         None)
+        if method is None:
+            d = defer.fail(ControlError("Unknown command %s" %
+                                        message['command']))
+        else:
+            d = defer.maybeDeferred(method,
+                                    **dict((str(k), v) for k, v in
+                                           message['args'].items()))
+        if 'id' in message:
+            d.addCallbacks(self._reply, self._error,
+                           callbackArgs=(message['id'],),
+                           errbackArgs=(message['id'],))
+        d.addErrback(log.err, "Control command %s failed" %
+                     message['command'])
+
+    def _reply(self, result, message_id):
+        self._send({'id': message_id, 'result': result})
+
+    def _error(self, failure, message_id):
+        self._send({'id': message_id,
+                    'error': failure.getErrorMessage()})
+        return failure
+
+    def connectionLost(self, reason):
+        pending, self.pending = self.pending, {}
+        for d in pending.values():
+            d.errback(reason)
+
+
+def current_rss():
+    """Get the resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        # the peak instead, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class WorkerStdio(ControlProtocol):
+    """The control channel of a worker on its stdin and stdout"""
+
+    def connectionLost(self, reason):
+        ControlProtocol.connectionLost(self, reason)
+        self.handler.lost()
+
+
+class Worker(object):
+    """The control channel end in a worker process
+
+    Set as git_configuration.worker, so repository_updated announces
+    pushes to the other workers."""
+
+    drain_interval = 1
+
+    def __init__(self, ports, metrics, git_configuration, drain_timeout):
+        self.ports = ports
+        self.metrics = metrics
+        self.git_configuration = git_configuration
+        self.drain_timeout = drain_timeout
+        self.stopping = False
+        self.control = WorkerStdio(self)
+
+    def repository_updated(self, repository_fs_path):
+        self.control.notify('updated', path=repository_fs_path)
+
+    def command_status(self):
+        return {'pid': os.getpid(), 'rss': current_rss(),
+                'connections': self.metrics.open_connection_count()}
+
+    def command_metrics(self):
+        return self.metrics.registry.render()
+
+    def command_updated(self, path):
+        invalidate_caches(self.git_configuration, path.encode('utf-8'))
+
+    def command_stop(self):
+        """Stop accepting connections and exit once the open ones are
+        done or drain_timeout passed"""
+        if self.stopping:
+            return
+        self.stopping = True
+        log.msg("Worker stops accepting connections")
+        for port in self.ports:
+            port.stopListening()
+
+        deadline = reactor.seconds() + self.drain_timeout
+
+        def drained():
+            if (self.metrics.open_connection_count() == 0 or
+                    reactor.seconds() >= deadline):
+                checker.stop()
+                reactor.stop()
+        checker = task.LoopingCall(drained)
+        checker.start(self.drain_interval)
+
+    def lost(self):
+        """The supervisor is gone"""
+        if reactor.running:
+            self.command_stop()
+
+
+def worker_main():
+    """Entry point of worker processes, see Supervisor.spawn"""
+    setup, slot, drain_timeout = sys.argv[1:4]
+    listeners = [arg.split('=') for arg in sys.argv[4:]]
+
+    log.startLogging(sys.stderr)
+    log.msg("Worker %s started with pid %d" % (slot, os.getpid()))
+    git_configuration, metrics, factories = namedAny(setup)(int(slot))
+
+    ports = []
+    for name, fd in listeners:
+        ports.append(reactor.adoptStreamPort(int(fd), socket.AF_INET,
+                                             factories[name]))
+        os.close(int(fd))
+
+    worker = Worker(ports, metrics, git_configuration, int(drain_timeout))
+    git_configuration.worker = worker
+    stdio.StandardIO(worker.control)
+    reactor.run()
+
+
+class WorkerProcess(ProcessProtocol):
+    """The supervisor's side of a worker process"""
+
+    rotating = False
+    ended = False
+
+    def __init__(self, supervisor, slot):
+        self.supervisor = supervisor
+        self.slot = slot
+        self.started = reactor.seconds()
+        self.control = ControlProtocol(self)
+
+    def connectionMade(self):
+        self.control.makeConnection(self.transport)
+
+    def outReceived(self, data):
+        self.control.dataReceived(data)
+
+    def processEnded(self, reason):
+        self.ended = True
+        self.control.connectionLost(reason)
+        self.supervisor.worker_ended(self, reason)
+
+    def call(self, command, timeout, **args):
+        if self.ended:
+            return defer.fail(ControlError("Worker ended"))
+        return self.control.call(command, **args).addTimeout(timeout,
+                                                             reactor)
+
+    def command_updated(self, path):
+        self.supervisor.repository_updated(self, path)
+
+
+class Supervisor(object):
+    """Runs a number of workers sharing listening sockets
+
+    listeners maps names to ports, the workers get the setup function's
+    factory of the same name for each. Crashed workers are restarted,
+    with increasing delay if they crash right after the start. Workers
+    with more than max_rss bytes resident are replaced once their open
+    connections are done."""
+
+    check_interval = 10
+    call_timeout = 5
+    min_uptime = 5
+    max_backoff = 60
+
+    def __init__(self, setup, listeners, workers, max_rss=None,
+                 interface='', drain_timeout=600):
+        self.setup = setup
+        self.listeners = listeners
+        self.count = workers
+        self.max_rss = max_rss
+        self.interface = interface
+        self.drain_timeout = drain_timeout
+
+        self.sockets = {}
+        self.workers = {}  # slot -> WorkerProcess
+        self.backoff = {}  # slot -> delay of the next restart
+        self.restarts = {}  # slot -> pending restart
+        self.stopping = None
+
+        self.registry = Registry()
+        self.registry.callback('gitserverglue_workers',
+                               'Running worker processes', 'gauge',
+                               lambda: len(self.workers))
+        self.restart_count = self.registry.counter(
+                'gitserverglue_worker_restarts_total',
+                'Worker processes restarted', ['reason'])
+
+    def start(self):
+        for name, port in self.listeners.items():
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind((self.interface, port))
+            s.listen(socket.SOMAXCONN)
+            s.setblocking(False)
+            self.sockets[name] = s
+            log.msg("Listening for %s on %d" % (name, port))
+
+        for slot in range(self.count):
+            self.spawn(slot)
+        self.checker = task.LoopingCall(self.check)
+        self.checker.start(self.check_interval, now=False)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def spawn(self, slot):
+        self.restarts.pop(slot, None)
+        worker = WorkerProcess(self, slot)
+        child_fds = {0: 'w', 1: 'r', 2: 2}
+        args = [sys.executable, '-c',
+                'from gitserverglue.workers import worker_main; '
+                'worker_main()',
+                self.setup, str(slot), str(self.drain_timeout)]
+        for i, (name, s) in enumerate(sorted(self.sockets.items())):
+            child_fds[3 + i] = s.fileno()
+            args.append('%s=%d' % (name, 3 + i))
+
+        reactor.spawnProcess(worker, sys.executable, args, env=os.environ,
+                             childFDs=child_fds)
+        self.workers[slot] = worker
+
+    def worker_ended(self, worker, reason):
+        if self.workers.get(worker.slot) is worker:
+            del self.workers[worker.slot]
+
+        if self.stopping is not None:
+            if not self.workers:
+                self.stopping.callback(None)
+            return
+
+        if worker.rotating:
+            self.restart_count.labels('memory').inc()
+            self.spawn(worker.slot)
+            return
+
+        log.msg("Worker %d ended unexpectedly: %s" % (
+                    worker.slot, reason.getErrorMessage()))
+        self.restart_count.labels('crash').inc()
+        delay = 0
+        if reactor.seconds() - worker.started < self.min_uptime:
+            delay = min(max(self.backoff.get(worker.slot, 0) * 2, 1),
+                        self.max_backoff)
+        self.backoff[worker.slot] = delay
+        self.restarts[worker.slot] = reactor.callLater(delay, self.spawn,
+                                                       worker.slot)
+
+    def check(self):
+        """Replace workers using too much memory"""
+        if self.max_rss is None:
+            return
+        for worker in self.workers.values():
+            if not worker.rotating:
+                d = worker.call('status', self.call_timeout)
+                d.addCallback(self._checkMemory, worker)
+                d.addErrback(log.err, "Status of worker %d" % worker.slot)
+
+    def _checkMemory(self, status, worker):
+        if status['rss'] <= self.max_rss or worker.rotating:
+            return
+        log.msg("Worker %d uses %d bytes, replacing it" % (worker.slot,
+                                                          status['rss']))
+        self.stop_worker(worker)
+
+    def stop_worker(self, worker):
+        """Let a worker finish its connections and exit, killing it if
+        it takes too long"""
+        worker.rotating = True
+        d = worker.call('stop', self.call_timeout)
+        d.addErrback(lambda failure: worker.transport.signalProcess('TERM'))
+        d.addErrback(lambda failure: None)  # already gone
+
+        def kill():
+            if not worker.ended:
+                worker.transport.signalProcess('KILL')
+        reactor.callLater(self.drain_timeout + self.call_timeout, kill)
+
+    def repository_updated(self, source, path):
+        for worker in self.workers.values():
+            if worker is not source and not worker.ended:
+                worker.control.notify('updated', path=path)
+
+    def metrics(self):
+        """Get the metrics of all workers summed up and those of the
+        supervisor, in the Prometheus text format"""
+        d = defer.DeferredList([worker.call('metrics', self.call_timeout)
+                                for worker in self.workers.values()])
+
+        def collected(results):
+            texts = [text.encode('utf-8')
+                     for success, text in results if success]
+            return sum_rendered(texts) + self.registry.render()
+        return d.addCallback(collected)
+
+    def stop(self):
+        """Stop all workers, the Deferred fires once they ended"""
+        self.checker.stop()
+        for call in self.restarts.values():
+            call.cancel()
+        self.restarts.clear()
+        if not self.workers:
+            return
+        self.stopping = defer.Deferred()
+        for worker in self.workers.values():
+            self.stop_worker(worker)
+        return self.stopping
+
+
+class SupervisorMetricsResource(Resource):
+    """Serves the metrics collected by a Supervisor"""
+    isLeaf = True
+
+    def __init__(self, supervisor):
+        Resource.__init__(self)
+        self.supervisor = supervisor
+
+    def render_GET(self, request):
+        def collected(text):
+            request.setHeader('Content-Type',
+                              'text/plain; version=0.0.4; charset=utf-8')
+            request.write(text)
+            request.finish()
+
+        def failed(failure):
+            log.err(failure, "Collecting metrics failed")
+            request.setResponseCode(500)
+            request.finish()
+
+        self.supervisor.metrics().addCallback(collected).addErrback(failed)
+        return NOT_DONE_YET
+
+
+def create_admin_factory(supervisor):
+    """Site serving the summed up /metrics of all workers"""
+    root = Resource()
+    root.putChild('metrics', SupervisorMetricsResource(supervisor))
+    return Site(root)